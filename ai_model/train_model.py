@@ -3,13 +3,22 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import accuracy_score
 import joblib
+import numpy as np
 import os
+import shutil
+import sys
+from compiled_forest import export_forest, CompiledForest
+import model_registry
 
 print("--- Starting Model Training ---")
 
 # Define the path for the output model
 output_model_path = 'species_classifier.pkl'
-data_path = 'sample_training_data.csv'
+output_forest_path = 'species_classifier_forest'
+data_path = os.getenv('TRAINING_DATA_PATH', 'sample_training_data.csv')
+# Versioned registry the workers hot-reload from (see model_registry.py)
+registry_path = os.getenv('MODEL_REGISTRY_PATH', 'registry')
+registry_keep = int(os.getenv('MODEL_REGISTRY_KEEP', '5'))
 
 # Check if data file exists
 if not os.path.exists(data_path):
@@ -38,6 +47,40 @@ print(f"Model trained with accuracy: {accuracy:.2f}")
 # Save the trained model using joblib
 joblib.dump(clf, output_model_path)
 print(f"Model saved to {output_model_path}")
+
+# Export the forest as flat arrays for the workers' compiled evaluator
+meta = export_forest(clf, output_forest_path)
+print(f"Compiled forest ({meta['n_trees']} trees, max depth {meta['max_depth']}) exported to {output_forest_path}")
+
+# Parity check: the compiled evaluator must agree with sklearn exactly, on the
+# training data and on random samples spread well beyond its range.
+compiled = CompiledForest(output_forest_path)
+rng = np.random.default_rng(42)
+low, high = X.min().to_numpy() * 0.5, X.max().to_numpy() * 1.5
+X_check = np.vstack([X.to_numpy(dtype=np.float64), rng.uniform(low, high, size=(10000, X.shape[1]))])
+X_check_df = pd.DataFrame(X_check, columns=X.columns)
+mismatches = int((compiled.predict(X_check) != clf.predict(X_check_df)).sum())
+max_proba_diff = float(np.abs(compiled.predict_proba(X_check) - clf.predict_proba(X_check_df)).max())
+if mismatches or max_proba_diff > 1e-12:
+    print(f"Error: compiled forest disagrees with sklearn ({mismatches} mismatches, max proba diff {max_proba_diff:.3g})")
+    sys.exit(1)
+print(f"Compiled forest parity check passed on {len(X_check)} samples.")
+
+# Publish the verified artifacts as a new registry version. Running workers
+# pick it up between batches without a restart.
+version = model_registry.new_version_name()
+staged = model_registry.staging_path(registry_path, version)
+shutil.copy2(output_model_path, os.path.join(staged, model_registry.PICKLE_NAME))
+shutil.copytree(output_forest_path, os.path.join(staged, model_registry.FOREST_NAME))
+model_registry.publish(registry_path, version, staged, manifest={
+    'accuracy': accuracy,
+    'n_trees': meta['n_trees'],
+    'max_depth': meta['max_depth'],
+    'features': list(X.columns),
+    'classes': meta['classes'],
+    'training_rows': len(X_train),
+}, keep=registry_keep)
+print(f"Published model version {version} to {registry_path}")
 print("--- Model Training Script Finished ---")
 
 
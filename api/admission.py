@@ -0,0 +1,180 @@
+"""Admission control for the ingest endpoints.
+
+Uploads are only as fast as the workers that drain them. Without a limit, a
+field campaign can push ``otolith_queue`` far enough that RabbitMQ pages
+messages to disk and every new image waits behind hours of backlog.
+``Admission`` refuses new work early instead:
+
+- **Queue depth (503).** A background thread reads the depth and consumer
+  count of each work queue every ``ADMISSION_POLL_SECONDS`` (passive
+  ``queue_declare`` on its own connection), so requests only read cached
+  numbers. A queue starts shedding at ``ADMISSION_HIGH_WATERMARK`` messages
+  and admits again once it has drained to ``ADMISSION_LOW_WATERMARK``. With
+  no consumer attached, it sheds from the low watermark. ``Retry-After`` is
+  the time the backlog above the low watermark takes to drain at the last
+  observed rate, or ``ADMISSION_RETRY_AFTER`` if it is not draining.
+- **Per-client rate (429).** Each client (remote address) has a token bucket
+  holding ``ADMISSION_CLIENT_BURST`` requests and refilled at
+  ``ADMISSION_CLIENT_RATE`` per second. ``Retry-After`` is the time until
+  the next token.
+
+When queue depths are unknown (broker unreachable, or not polled for
+``3 * ADMISSION_POLL_SECONDS``), requests are admitted and publishing
+reports its own failure.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pika
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+ADMISSION_POLL_SECONDS = float(os.getenv('ADMISSION_POLL_SECONDS', '2'))
+ADMISSION_HIGH_WATERMARK = int(os.getenv('ADMISSION_HIGH_WATERMARK', '10000'))
+ADMISSION_LOW_WATERMARK = int(os.getenv('ADMISSION_LOW_WATERMARK', '5000'))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '30'))
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv('ADMISSION_MAX_RETRY_AFTER', '600'))
+ADMISSION_CLIENT_RATE = float(os.getenv('ADMISSION_CLIENT_RATE', '20'))
+ADMISSION_CLIENT_BURST = float(os.getenv('ADMISSION_CLIENT_BURST', '100'))
+# Least recently seen clients beyond this are forgotten (and start with a full bucket).
+ADMISSION_MAX_CLIENTS = int(os.getenv('ADMISSION_MAX_CLIENTS', '10000'))
+
+
+class QueueState:
+    """Last polled depth of one queue, with its shedding flag and drain rate."""
+
+    __slots__ = ('messages', 'consumers', 'polled_at', 'drain_rate', 'shedding')
+
+    def __init__(self):
+        self.messages = 0
+        self.consumers = 0
+        self.polled_at = None
+        self.drain_rate = 0.0  # messages per second, from the last two polls
+        self.shedding = False
+
+    def update(self, messages, consumers, now):
+        if self.polled_at is not None and now > self.polled_at:
+            self.drain_rate = max(self.messages - messages, 0) / (now - self.polled_at)
+        self.messages, self.consumers, self.polled_at = messages, consumers, now
+        if self.shedding:
+            self.shedding = messages > ADMISSION_LOW_WATERMARK
+        else:
+            high = ADMISSION_HIGH_WATERMARK if consumers else ADMISSION_LOW_WATERMARK
+            self.shedding = messages >= high
+
+    def retry_after(self):
+        if self.drain_rate <= 0:
+            return ADMISSION_RETRY_AFTER
+        seconds = (self.messages - ADMISSION_LOW_WATERMARK) / self.drain_rate
+        return min(max(math.ceil(seconds), 1), ADMISSION_MAX_RETRY_AFTER)
+
+
+class TokenBuckets:
+    """Per-client token buckets in a bounded LRU map."""
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client, now=None):
+        """Spend one token; returns 0 if granted, else seconds until the next token."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class Admission:
+    """Queue-depth and per-client admission, owned by the application lifespan."""
+
+    def __init__(self, queues, host=RABBITMQ_HOST):
+        self.params = pika.ConnectionParameters(host=host)
+        self.queues = {name: QueueState() for name in queues}
+        self.clients = TokenBuckets(ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST, ADMISSION_MAX_CLIENTS)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- Lifecycle ---
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='amqp-admission', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    # --- Requests ---
+    def admit(self, request, queues=()):
+        """Raise a 429 or 503 ``HTTPException`` unless the request may enqueue work on ``queues``."""
+        client = request.client.host if request.client else 'unknown'
+        wait = self.clients.take(client)
+        if wait:
+            raise HTTPException(
+                status_code=429, detail="Too many requests from this client.",
+                headers={'Retry-After': str(math.ceil(wait))},
+            )
+        fresh_after = time.monotonic() - 3 * ADMISSION_POLL_SECONDS
+        for name in queues:
+            state = self.queues[name]
+            if state.shedding and state.polled_at is not None and state.polled_at >= fresh_after:
+                logger.warning(f"Shedding ingest: {name} holds {state.messages} messages, {state.consumers} consumers.")
+                raise HTTPException(
+                    status_code=503,
+                    detail={'message': f"{name} is backlogged; retry later.", 'queue': name,
+                            'messages': state.messages, 'consumers': state.consumers},
+                    headers={'Retry-After': str(state.retry_after())},
+                )
+
+    def status(self):
+        return {
+            name: {'messages': state.messages, 'consumers': state.consumers, 'shedding': state.shedding}
+            for name, state in self.queues.items()
+        }
+
+    # --- Polling ---
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = pika.BlockingConnection(self.params)
+                channel = connection.channel()
+                while not self._stop.is_set():
+                    for name, state in self.queues.items():
+                        try:
+                            result = channel.queue_declare(queue=name, passive=True)
+                        except pika.exceptions.ChannelClosedByBroker:
+                            # Not declared yet: nothing queued, but the channel is gone.
+                            state.update(0, 0, time.monotonic())
+                            channel = connection.channel()
+                            continue
+                        state.update(result.method.message_count, result.method.consumer_count, time.monotonic())
+                    connection.sleep(ADMISSION_POLL_SECONDS)
+            except Exception as e:
+                logger.warning(f"Queue depth poll failed: {e}. Retrying in {ADMISSION_POLL_SECONDS * 5:g} seconds...")
+            finally:
+                if connection is not None and connection.is_open:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            self._stop.wait(ADMISSION_POLL_SECONDS * 5)
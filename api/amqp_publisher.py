@@ -0,0 +1,189 @@
+"""Long-lived RabbitMQ publisher shared by the API request handlers.
+
+Opening a ``pika.BlockingConnection`` per request costs a TCP + AMQP handshake
+and a queue declaration on every upload. ``AMQPPublisher`` instead keeps a small
+pool of connections, each with a single confirm-mode channel, declares the work
+queues once (with their retry and dead-letter queues, see shared/work_queues.py)
+and lends a slot to one request thread at a time (pika's blocking adapter is
+not thread-safe). Async handlers use ``publish_async`` so the event loop never
+waits on a socket.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+
+import pika
+
+from work_queues import declare_work_queue
+
+logger = logging.getLogger(__name__)
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+AMQP_POOL_SIZE = int(os.getenv('AMQP_POOL_SIZE', '4'))
+AMQP_ACQUIRE_TIMEOUT = float(os.getenv('AMQP_ACQUIRE_TIMEOUT', '5'))
+AMQP_HEARTBEAT = int(os.getenv('AMQP_HEARTBEAT', '60'))
+
+WORK_QUEUES = ('otolith_queue', 'ai_queue', 'taxonomy_queue', 'edna_queue')
+
+
+class PublisherUnavailable(Exception):
+    """Raised when a message could not be confirmed by the broker."""
+
+
+class _ChannelSlot:
+    """One pooled connection with its confirm-mode channel."""
+
+    def __init__(self, params):
+        self.params = params
+        self.connection = None
+        self.channel = None
+
+    @property
+    def is_open(self):
+        return (self.connection is not None and self.connection.is_open
+                and self.channel is not None and self.channel.is_open)
+
+    def ensure_open(self):
+        if self.is_open:
+            return
+        self.close()
+        self.connection = pika.BlockingConnection(self.params)
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except Exception as e:
+                logger.debug(f"Ignoring error while closing AMQP connection: {e}")
+        self.connection = None
+        self.channel = None
+
+
+class AMQPPublisher:
+    """Pool of confirm-mode channels owned by the application lifespan."""
+
+    def __init__(self, host=RABBITMQ_HOST, pool_size=AMQP_POOL_SIZE, queues=WORK_QUEUES):
+        self.params = pika.ConnectionParameters(host=host, heartbeat=AMQP_HEARTBEAT)
+        self.queues = tuple(queues)
+        self.pool_size = pool_size
+        self._slots = queue.Queue()
+        for _ in range(pool_size):
+            self._slots.put(_ChannelSlot(self.params))
+        self._declared = False
+        self._declare_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    # --- Lifecycle ---
+    def start(self):
+        """Warm one slot and declare the queues; failures are retried lazily."""
+        self._stop.clear()
+        slot = self._acquire()
+        try:
+            slot.ensure_open()
+            self._declare_queues(slot.channel)
+            logger.info(f"AMQP publisher ready ({self.pool_size} slots, queues declared).")
+        except pika.exceptions.AMQPError as e:
+            slot.close()
+            logger.warning(f"AMQP publisher could not connect at startup, will retry on first publish: {e}")
+        finally:
+            self._release(slot)
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name='amqp-keepalive', daemon=True)
+        self._keepalive_thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._keepalive_thread is not None:
+            self._keepalive_thread.join(timeout=AMQP_ACQUIRE_TIMEOUT)
+        while True:
+            try:
+                slot = self._slots.get_nowait()
+            except queue.Empty:
+                break
+            slot.close()
+        logger.info("AMQP publisher closed.")
+
+    # --- Publishing ---
+    def publish(self, queue_name, body, properties=None):
+        """Publish ``body`` to ``queue_name`` and wait for the broker confirm.
+
+        Blocking; call it from a worker thread (sync route, background task)
+        or use ``publish_async`` from ``async def`` handlers.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if properties is None:
+            properties = pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE)
+
+        slot = self._acquire()
+        try:
+            for attempt in range(2):
+                try:
+                    slot.ensure_open()
+                    self._declare_queues(slot.channel)
+                    slot.channel.basic_publish(
+                        exchange='', routing_key=queue_name, body=body,
+                        properties=properties, mandatory=True,
+                    )
+                    return
+                except pika.exceptions.NackError as e:
+                    raise PublisherUnavailable(f"Broker rejected message for '{queue_name}': {e}") from e
+                except (pika.exceptions.UnroutableError,
+                        pika.exceptions.AMQPConnectionError,
+                        pika.exceptions.AMQPChannelError) as e:
+                    # Stale connection (missed heartbeats, broker restart) or a
+                    # queue that disappeared: reconnect, redeclare and retry once.
+                    logger.warning(f"Publish to '{queue_name}' failed ({type(e).__name__}: {e}); reconnecting.")
+                    slot.close()
+                    self._declared = False
+                    if attempt:
+                        raise PublisherUnavailable(f"Could not publish to '{queue_name}': {e}") from e
+        finally:
+            self._release(slot)
+
+    async def publish_async(self, queue_name, body, properties=None):
+        """Non-blocking wrapper around ``publish`` for ``async def`` handlers."""
+        await asyncio.to_thread(self.publish, queue_name, body, properties)
+
+    # --- Internals ---
+    def _acquire(self):
+        try:
+            return self._slots.get(timeout=AMQP_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise PublisherUnavailable("All AMQP publisher channels are busy.")
+
+    def _release(self, slot):
+        self._slots.put(slot)
+
+    def _declare_queues(self, channel):
+        if self._declared:
+            return
+        with self._declare_lock:
+            if self._declared:
+                return
+            for name in self.queues:
+                declare_work_queue(channel, name)
+            self._declared = True
+
+    def _keepalive_loop(self):
+        """Service heartbeats on idle slots so they are not dropped by the broker."""
+        interval = max(AMQP_HEARTBEAT / 2, 1)
+        while not self._stop.wait(interval):
+            # Borrow slots one at a time so publishers are never starved.
+            for _ in range(self.pool_size):
+                try:
+                    slot = self._slots.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if slot.is_open:
+                        slot.connection.process_data_events(time_limit=0)
+                except pika.exceptions.AMQPError as e:
+                    logger.debug(f"Dropping stale AMQP slot: {e}")
+                    slot.close()
+                finally:
+                    self._slots.put(slot)
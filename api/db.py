@@ -0,0 +1,59 @@
+"""Async, pooled database access for the API.
+
+One SQLAlchemy ``AsyncEngine`` on asyncpg per process. Queries run on the event
+loop instead of holding a threadpool slot or a shared psycopg2 connection, so
+concurrent reads scale with ``DB_POOL_SIZE`` (+ ``DB_MAX_OVERFLOW``).
+
+asyncpg prepares every statement and caches it per connection
+(``DB_STATEMENT_CACHE_SIZE``). Hot queries should therefore be module-level
+``text()`` constants with bound parameters: the same SQL string is then
+prepared once per pooled connection and reused on every request.
+"""
+import os
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/cmlre_data")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+
+def async_url(url):
+    """Point a ``postgresql://`` URL at the asyncpg driver."""
+    scheme, rest = url.split("://", 1)
+    return f"postgresql+asyncpg://{rest}" if scheme in ("postgresql", "postgres", "postgresql+psycopg2") else url
+
+
+engine = create_async_engine(
+    async_url(DATABASE_URL),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    # SQLAlchemy's cache of asyncpg prepared statements, per connection.
+    connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+)
+
+
+async def fetch_all(statement, params=None):
+    async with engine.connect() as connection:
+        result = await connection.execute(statement, params or {})
+        return result.mappings().fetchall()
+
+
+async def fetch_one(statement, params=None):
+    async with engine.connect() as connection:
+        result = await connection.execute(statement, params or {})
+        return result.mappings().first()
+
+
+async def stream(statement, params=None, chunk_size=1000):
+    """Yield rows from a server-side cursor, ``chunk_size`` at a time."""
+    async with engine.connect() as connection:
+        result = await connection.stream(statement, params or {}, execution_options={"yield_per": chunk_size})
+        async for row in result.mappings():
+            yield row
+
+
+async def dispose():
+    await engine.dispose()
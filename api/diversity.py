@@ -0,0 +1,102 @@
+"""Alpha and beta diversity over a sparse sample x taxon abundance matrix.
+
+Abundances come from the ``sample_taxon_abundance`` view (shared/schema.py):
+eDNA read counts per sample and taxon, and identified otoliths per UTC day and
+species, both maintained incrementally by the workers. ``abundance_matrix``
+turns those long-format rows into a CSR matrix with one row per sample, so
+every index below is a handful of array operations over the non-zero entries
+instead of a Python loop per sample or per pair:
+
+- richness, Shannon entropy (natural log), Gini-Simpson (1 - sum p^2) and
+  Pielou evenness per sample;
+- Bray-Curtis dissimilarity between samples (``scipy.spatial.distance.pdist``)
+  or Jaccard distance on presence/absence (one sparse product).
+"""
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+
+# Beta diversity is quadratic in the number of samples.
+DIVERSITY_MAX_SAMPLES = int(os.getenv('DIVERSITY_MAX_SAMPLES', '2000'))
+BETA_METRICS = ('braycurtis', 'jaccard')
+
+
+def abundance_matrix(rows):
+    """``(samples, taxa, matrix)`` from ``(sample_id, taxon, abundance)`` rows.
+
+    ``samples`` and ``taxa`` are sorted; ``matrix`` is a float CSR matrix of
+    shape ``(len(samples), len(taxa))`` with duplicate entries summed.
+    """
+    if not rows:
+        return [], [], sparse.csr_matrix((0, 0))
+    sample_ids, taxon_names, abundance = zip(*rows)
+    samples, sample_codes = np.unique(np.array(sample_ids, dtype=str), return_inverse=True)
+    taxa, taxon_codes = np.unique(np.array(taxon_names, dtype=str), return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.asarray(abundance, dtype=np.float64), (sample_codes, taxon_codes)),
+        shape=(len(samples), len(taxa)),
+    )
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    return samples.tolist(), taxa.tolist(), matrix
+
+
+def alpha_diversity(matrix):
+    """Per-sample richness, total abundance, Shannon, Simpson and evenness arrays."""
+    n_samples = matrix.shape[0]
+    richness = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(n_samples), richness)
+    totals = np.bincount(rows, weights=matrix.data, minlength=n_samples)
+    p = matrix.data / totals[rows]
+    shannon = -np.bincount(rows, weights=p * np.log(p), minlength=n_samples)
+    simpson = 1.0 - np.bincount(rows, weights=p * p, minlength=n_samples)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        evenness = np.where(richness > 1, shannon / np.log(richness), np.nan)
+    return {'richness': richness, 'total': totals, 'shannon': shannon, 'simpson': simpson, 'evenness': evenness}
+
+
+def beta_diversity(matrix, metric='braycurtis'):
+    """Square distance matrix between the samples (rows) of ``matrix``."""
+    if metric == 'jaccard':
+        presence = (matrix > 0).astype(np.float64)
+        shared = (presence @ presence.T).toarray()
+        richness = np.diff(presence.indptr).astype(np.float64)
+        union = richness[:, None] + richness[None, :] - shared
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(union > 0, 1.0 - shared / union, 0.0)
+        np.fill_diagonal(distances, 0.0)
+        return distances
+    if metric != 'braycurtis':
+        raise ValueError(f"Unknown beta diversity metric {metric!r}; expected one of {BETA_METRICS}.")
+    if matrix.shape[0] < 2:
+        return np.zeros((matrix.shape[0], matrix.shape[0]))
+    # Keep only the taxa present in these samples before densifying.
+    present = np.unique(matrix.indices)
+    return squareform(pdist(matrix[:, present].toarray(), 'braycurtis'))
+
+
+def _rounded(values):
+    return [None if np.isnan(v) else round(float(v), 6) for v in values]
+
+
+def alpha_report(rows):
+    """JSON-able alpha diversity per sample from abundance rows."""
+    samples, taxa, matrix = abundance_matrix(rows)
+    alpha = alpha_diversity(matrix)
+    columns = {name: _rounded(values) for name, values in alpha.items() if name != 'richness'}
+    return {
+        'taxa': len(taxa),
+        'samples': [
+            {'sample_id': sample, 'richness': int(alpha['richness'][i]), **{name: values[i] for name, values in columns.items()}}
+            for i, sample in enumerate(samples)
+        ],
+    }
+
+
+def beta_report(rows, metric):
+    """JSON-able distance matrix between the samples in abundance rows."""
+    samples, taxa, matrix = abundance_matrix(rows)
+    distances = beta_diversity(matrix, metric)
+    return {'metric': metric, 'taxa': len(taxa), 'samples': samples, 'distances': np.round(distances, 6).tolist()}
@@ -0,0 +1,117 @@
+"""Push finished otolith analyses to clients over server-sent events.
+
+``EventHub`` maps subscribed ``image_id``s to per-client asyncio queues. The
+NOTIFY listener thread (see ``response_cache.ChangeListener``) calls
+``notify_threadsafe`` with the ids from each ``otolith_changes`` message; the
+hub wakes only the clients watching those ids, on the event loop. Each client
+then reads its row once, so database load follows completed images rather
+than poll frequency.
+
+An image whose message was dead-lettered (see shared/work_queues.py) has a
+row in ``otolith_failures`` and ends with a ``failed`` event. Failures the
+workers could not record (the database being down, say) are covered by
+``SSE_MAX_WAIT_SECONDS``: the stream then ends with an explicit ``timeout``
+listing the images still pending.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_MAX_IMAGE_IDS = int(os.getenv('SSE_MAX_IMAGE_IDS', '100'))
+SSE_MAX_WAIT_SECONDS = float(os.getenv('SSE_MAX_WAIT_SECONDS', '900'))
+
+
+class EventHub:
+    """Fan-out of change notifications from the listener thread to SSE clients."""
+
+    def __init__(self):
+        self._loop = None
+        self._subscribers = {}
+
+    def start(self):
+        """Bind to the running event loop; call from the app's lifespan."""
+        self._loop = asyncio.get_running_loop()
+
+    def subscribe(self, image_ids):
+        queue = asyncio.Queue(maxsize=1)
+        for image_id in image_ids:
+            self._subscribers.setdefault(image_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, image_ids, queue):
+        for image_id in image_ids:
+            queues = self._subscribers.get(image_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[image_id]
+
+    def notify_threadsafe(self, image_ids):
+        """Wake subscribers of ``image_ids`` (None wakes everyone). Thread-safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake, image_ids)
+
+    def _wake(self, image_ids):
+        if image_ids is None:
+            queues = set().union(*self._subscribers.values())
+        else:
+            queues = set().union(*(self._subscribers.get(i, ()) for i in image_ids))
+        for queue in queues:
+            # One pending wake-up is enough: the client re-reads current state.
+            if queue.empty():
+                queue.put_nowait(True)
+
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def row_status(row):
+    if row.get('predicted_species'):
+        return 'complete'
+    if row.get('failure') is not None:
+        return 'failed'
+    return 'analysed'
+
+
+async def otolith_event_stream(hub, image_ids, fetch_state, max_wait=SSE_MAX_WAIT_SECONDS):
+    """Yield SSE messages until every image in ``image_ids`` is complete or failed.
+
+    ``fetch_state(image_ids)`` returns ``{image_id: row}`` for the images that
+    were analysed or failed; a row counts as complete once
+    ``predicted_species`` is set, and as failed once ``failure`` is. The
+    subscription is taken before the first read so no commit is missed.
+    After ``max_wait`` seconds the stream ends with a ``timeout`` event.
+    """
+    queue = hub.subscribe(image_ids)
+    sent, pending = {}, set(image_ids)
+    deadline = time.monotonic() + max_wait
+    try:
+        while True:
+            for image_id, row in (await fetch_state(sorted(pending))).items():
+                status = row_status(row)
+                if sent.get(image_id) != status:
+                    sent[image_id] = status
+                    yield sse_message(status, row)
+                if status != 'analysed':
+                    pending.discard(image_id)
+            if not pending:
+                failed = sorted(i for i, status in sent.items() if status == 'failed')
+                yield sse_message('done', {'image_ids': image_ids, 'failed': failed})
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                yield sse_message('timeout', {'image_ids': image_ids, 'pending': sorted(pending)})
+                return
+            try:
+                await asyncio.wait_for(queue.get(), timeout=min(SSE_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing the idle connection.
+                yield ": heartbeat\n\n"
+    finally:
+        hub.unsubscribe(image_ids, queue)
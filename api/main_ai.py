@@ -1,72 +1,55 @@
-import pika
 import json
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
-import time
+from sqlalchemy import text
+from amqp_publisher import AMQPPublisher
+import db
+from response_cache import ResponseCache, otolith_cache_listener
 
 # ... (Database setup and FastAPI lifespan is identical to main_db.py) ...
-DB_HOST = os.getenv("POSTGRES_HOST", "db")
-DB_NAME = os.getenv("POSTGRES_DB", "cmlre_data")
-DB_USER = os.getenv("POSTGRES_USER", "postgres")
-DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
-db_connection = None
+# Requests go through the async pool in db.py (DATABASE_URL, DB_POOL_SIZE); the
+# schema comes from the migration step (shared/migrate.py).
+publisher = AMQPPublisher(os.getenv('RABBITMQ_HOST', 'rabbitmq'))
+response_cache = ResponseCache()
+change_listener = otolith_cache_listener(db.DATABASE_URL, response_cache)
 
-def get_db_connection():
-    return psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
-
-def setup_database():
-    global db_connection
-    # ... (setup_database logic is identical) ...
-    db_connection = get_db_connection()
-    with db_connection.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS otolith_morphometrics (
-                id SERIAL PRIMARY KEY, image_id VARCHAR(255) UNIQUE NOT NULL,
-                area_px REAL, perimeter_px REAL, width_px INT, height_px INT,
-                aspect_ratio REAL, analysis_timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        db_connection.commit()
+TAXONOMY_TRENDS = text("SELECT common_name, sighting_count AS count FROM taxonomy LIMIT 10")
+OTOLITH_RESULT = text("SELECT * FROM otolith_morphometrics WHERE image_id = :image_id")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    setup_database()
+    publisher.start()
+    change_listener.start()
     yield
-    if db_connection: db_connection.close()
+    change_listener.stop()
+    publisher.close()
+    await db.dispose()
 
 app = FastAPI(lifespan=lifespan)
 # ... (All ingestion endpoints are identical to main_db.py) ...
 @app.post("/api/ingest/otolith")
 async def ingest_otolith(data: dict):
     # ... (identical) ...
-    channel = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST', 'rabbitmq'))).channel()
-    channel.queue_declare(queue='otolith_queue', durable=True)
-    channel.basic_publish(exchange='', routing_key='otolith_queue', body=json.dumps(data))
+    await publisher.publish_async('otolith_queue', json.dumps(data))
     return JSONResponse(content={"message": "Otolith data queued for analysis."})
 
 @app.get("/api/trends/biodiversity")
 async def get_biodiversity_trends():
     # ... (identical) ...
-    with db_connection.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT common_name, sighting_count AS count FROM taxonomy LIMIT 10;")
-        return cur.fetchall()
+    return [dict(row) for row in await db.fetch_all(TAXONOMY_TRENDS)]
 
-@app.get("/api/otolith/results/{image_id}")
-async def get_otolith_results(image_id: str):
-    """UPDATED: Now also fetches the predicted_species field."""
-    with db_connection.cursor(cursor_factory=RealDictCursor) as cur:
-        # The ai_worker adds this column, so we select it.
-        # Use a LEFT JOIN to ensure we get a result even before the prediction is ready.
-        cur.execute("""
-            SELECT *, COALESCE(predicted_species, 'Pending Prediction...') as predicted_species
-            FROM otolith_morphometrics 
-            WHERE image_id = %s;
-        """, (image_id,))
-        result = cur.fetchone()
+async def fetch_otolith_results(image_id):
+    result = await db.fetch_one(OTOLITH_RESULT, {"image_id": image_id})
     if not result:
         raise HTTPException(status_code=404, detail="Results not found for this image ID.")
+    # The ai_worker adds predicted_species; rows still awaiting it show as pending.
+    result = dict(result)
+    result["predicted_species"] = result.get("predicted_species") or "Pending Prediction..."
     return result
+
+@app.get("/api/otolith/results/{image_id}")
+async def get_otolith_results(image_id: str, request: Request):
+    """UPDATED: Now also fetches the predicted_species field; cached until a worker writes the image."""
+    return await response_cache.respond_async(request, [f"image:{image_id}"], lambda: fetch_otolith_results(image_id))
@@ -1,13 +1,29 @@
 import os
-import time
+import asyncio
 import logging
 import json # <--- THIS IS THE FIX
-from fastapi import FastAPI, HTTPException
+import base64
+import binascii
+import math
+from datetime import datetime
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, File, Form, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import pika
-from sqlalchemy import create_engine, text, inspect
+from sqlalchemy import text
 from contextlib import asynccontextmanager
+from admission import Admission
+from amqp_publisher import AMQPPublisher, PublisherUnavailable
+import db
+from response_cache import (
+    EDNA_CHANGES_CHANNEL, OTOLITH_CHANGES_CHANNEL, ChangeListener, ResponseCache, changed_image_ids,
+    invalidate_otolith_changes,
+)
+from diversity import BETA_METRICS, DIVERSITY_MAX_SAMPLES, alpha_report, beta_report
+from events import SSE_MAX_IMAGE_IDS, EventHub, otolith_event_stream
+from schema import ABUNDANCE_SOURCES, GEO_MAX_ZOOM, IMAGE_ID_MAX_LENGTH, MAX_LATITUDE, ROLLUP_METRICS, SCHEMA_VERSION, SCHEMA_VERSION_QUERY
 
 # --- Basic Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -15,85 +31,513 @@ logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/cmlre_data")
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-
-# --- Database Setup on Startup ---
-def setup_database_and_tables():
-    logger.info("Attempting to connect to the database...")
-    max_retries = 20
-    for attempt in range(max_retries):
-        try:
-            with engine.connect() as connection:
-                logger.info("Database connection successful.")
-                inspector = inspect(engine)
-                if not inspector.has_table("otolith_morphometrics"):
-                    logger.info("Table 'otolith_morphometrics' does not exist. Creating it now.")
-                    create_table_query = text("""
-                        CREATE TABLE otolith_morphometrics (
-                            id SERIAL PRIMARY KEY,
-                            image_id VARCHAR(255) UNIQUE NOT NULL,
-                            area FLOAT, perimeter FLOAT, width FLOAT, height FLOAT, aspect_ratio FLOAT,
-                            predicted_species VARCHAR(255), latitude FLOAT, longitude FLOAT,
-                            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                        );
-                    """)
-                    connection.execute(create_table_query)
-                    connection.commit()
-                    logger.info("Table 'otolith_morphometrics' created successfully.")
-                else:
-                    logger.info("Table 'otolith_morphometrics' already exists.")
-                return
-        except Exception as e:
-            logger.warning(f"Database connection failed (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(5)
-            else:
-                raise RuntimeError("Failed to connect to the database after multiple retries.")
+DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '500'))
+DASHBOARD_MAX_PAGE_SIZE = int(os.getenv('DASHBOARD_MAX_PAGE_SIZE', '5000'))
+DASHBOARD_STREAM_CHUNK = int(os.getenv('DASHBOARD_STREAM_CHUNK', '1000'))
+publisher = AMQPPublisher(RABBITMQ_HOST)
+# Otolith uploads are refused while their queue, or the AI stage after it, is backlogged.
+OTOLITH_INGEST_QUEUES = ('otolith_queue', 'ai_queue')
+admission = Admission(OTOLITH_INGEST_QUEUES, RABBITMQ_HOST)
+response_cache = ResponseCache()
+event_hub = EventHub()
+
+# --- Change notifications ---
+# Worker commits invalidate cached responses and wake SSE subscribers.
+def on_otolith_changes(payload):
+    invalidate_otolith_changes(response_cache, payload)
+    event_hub.notify_threadsafe(changed_image_ids(payload))
+
+def on_listener_connected():
+    response_cache.set_enabled(True)
+    # Notifications may have been missed while disconnected.
+    event_hub.notify_threadsafe(None)
+
+change_listener = ChangeListener(
+    DATABASE_URL, {
+        OTOLITH_CHANGES_CHANNEL: on_otolith_changes,
+        EDNA_CHANGES_CHANNEL: lambda payload: response_cache.invalidate(["edna"]),
+    },
+    on_connected=on_listener_connected,
+    on_disconnected=lambda: response_cache.set_enabled(False),
+)
+
+# --- Schema ---
+# Tables are created by the migration step (shared/migrate.py) before the API
+# starts; here we only compare versions, in one query.
+SCHEMA_VERSION_CHECK = text(SCHEMA_VERSION_QUERY)
+
+async def applied_schema_version():
+    """Applied schema version, or None if the database cannot be queried."""
+    try:
+        return (await db.fetch_one(SCHEMA_VERSION_CHECK))["version"]
+    except Exception as e:
+        logger.warning(f"Schema version check failed: {e}")
+        return None
+
+# --- Map bins ---
+# Per slippy-map tile, zoom and species; tile expressions live in shared/schema.py.
+def tile_of(latitude, longitude, zoom):
+    """Slippy-map tile containing a point (used for bounding boxes only)."""
+    n = 1 << zoom
+    lat = math.radians(min(max(latitude, -MAX_LATITUDE), MAX_LATITUDE))
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    setup_database_and_tables()
+    version = await applied_schema_version()
+    if version != SCHEMA_VERSION:
+        logger.warning(f"Database schema is at version {version}, expected {SCHEMA_VERSION}; run migrate.py.")
+    publisher.start()
+    admission.start()
+    event_hub.start()
+    change_listener.start()
     yield
+    change_listener.stop()
+    admission.stop()
+    publisher.close()
+    await db.dispose()
 
 # --- FastAPI App ---
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 class OtolithIngest(BaseModel):
     image_data: str
     image_id: str
 
+def otolith_message_properties(image_id, content_type, latitude=None, longitude=None):
+    """AMQP properties for the binary otolith format.
+
+    The message body is the raw image file; everything else travels in headers
+    so the worker can hand the body buffer straight to OpenCV.
+    """
+    headers = {"image_id": image_id}
+    if latitude is not None and longitude is not None:
+        headers["latitude"] = float(latitude)
+        headers["longitude"] = float(longitude)
+    return pika.BasicProperties(
+        content_type=content_type or "application/octet-stream",
+        headers=headers,
+        delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+    )
+
+def check_image_id(image_id):
+    # Checked here so one bad id cannot fail the worker's batched write.
+    if len(image_id) > IMAGE_ID_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"image_id is longer than {IMAGE_ID_MAX_LENGTH} characters.")
+
+def queue_otolith_image(image_id, image_bytes, content_type, latitude=None, longitude=None):
+    check_image_id(image_id)
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Empty image payload.")
+    properties = otolith_message_properties(image_id, content_type, latitude, longitude)
+    try:
+        publisher.publish('otolith_queue', image_bytes, properties)
+    except PublisherUnavailable as e:
+        logger.error(f"Message broker unavailable for {image_id}: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+    logger.info(f"Successfully queued {len(image_bytes)} bytes for image_id: {image_id}")
+    return {"status": "success", "message": "Image queued for processing."}
+
+def split_data_url(image_data):
+    """``(content_type, payload)`` of plain base64 or a ``data:<type>;base64,`` URL."""
+    if not image_data.startswith("data:"):
+        return None, image_data
+    header, _, payload = image_data.partition(",")
+    if not header.endswith(";base64"):
+        raise HTTPException(status_code=400, detail="Only base64 data URLs are supported.")
+    return header[len("data:"):].split(";")[0] or None, payload
+
 @app.post("/api/ingest/otolith")
-def ingest_otolith(item: OtolithIngest):
-    clean_image_data = "iVBORw0KGgoAAAANSUhEUgAAAGAAAABgCAYAAADimHc4AAAAAXNSR0IArs4c6QAAAARnQU1BAACxjwv8YQUAAAAJcEhZcwAALiIAAC4iAari3ZIAAAHNSURBVHhe7dixTkJBFEbhD18gIgaJkUijaGRAZ4CiC4gkxcY0pC1JAY0tYAEH4ACwpCwJDRpERQNo2BgTNIFRg4kBMnlB4n/mB16a2Z35v9k3s59whQoVOrw+F9z6vD4XmF7fL37w5/VL32/d8TevP/d8wB/8+b43PK//nlv4l8y/P/91/s+L3/nwB7/56y/vl/6/BQD8v5sF+NkLAuBnbQiAn7UgAH7WggD4WQsC4GctCIDf/l386Pcr/28JAGB/LQgA/LwFAXBaswD4WQsC4GctCIDf/i0A4GctCICsLQGAf0gLAuBnbQiAn1UgAH7WggD4GgBgLQiA3/4d/ej3K/9vCQBgf1sQAPh5CgLgtGYB8LMWAuBnbQiA3/4tAMA+LQiArC0BgH9ICgLgZ20IgJ+1IChY/v0tAH7WggD4WQsC4GctCIB/SAYAYC0IgJ+1IAC+BgBYCwLgZy0IgJ+1IAC+BgB4v7YgAH7WggD4WQsC4GctCICsLQiAn7UgAH7WggD4WQsC4GctCICvtYEA+FkLAuBnbQiAn7UgAH7WggD4WQuB3/4d/ej3K/9vCQB4//oV+qV3gUKFCp0/rw+hTwA2H2qLRMdWbAAAAABJRU5ErkJggg=="
+def ingest_otolith(item: OtolithIngest, request: Request):
+    """Legacy base64-in-JSON ingest; decoded once here and queued as binary."""
+    admission.admit(request, OTOLITH_INGEST_QUEUES)
+    content_type, payload = split_data_url(item.image_data.strip())
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-        channel = connection.channel()
-        channel.queue_declare(queue='otolith_queue', durable=True)
-        message_data = {"image_id": item.image_id, "image_data": clean_image_data}
-        message_body = json.dumps(message_data)
-        channel.basic_publish(
-            exchange='', routing_key='otolith_queue', body=message_body,
-            properties=pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE)
-        )
-        connection.close()
-        logger.info(f"Successfully queued message for image_id: {item.image_id}")
-        return {"status": "success", "message": "Image queued for processing."}
-    except Exception as e:
-        logger.error(f"Failed to queue message for {item.image_id}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        image_bytes = base64.b64decode(payload, validate=True)
+    except binascii.Error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid base64 image data: {e}")
+    return queue_otolith_image(item.image_id, image_bytes, content_type)
 
-@app.get("/api/dashboard/data")
-def get_dashboard_data():
+@app.post("/api/ingest/otolith/upload")
+def upload_otolith(
+    request: Request,
+    file: UploadFile = File(...),
+    image_id: Optional[str] = Form(None),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
+):
+    """Multipart upload; the file bytes become the AMQP body unchanged."""
+    admission.admit(request, OTOLITH_INGEST_QUEUES)
+    image_id = image_id or file.filename
+    if not image_id:
+        raise HTTPException(status_code=400, detail="image_id is required.")
+    return queue_otolith_image(image_id, file.file.read(), file.content_type, latitude, longitude)
+
+@app.post("/api/ingest/otolith/raw")
+async def ingest_otolith_raw(
+    request: Request,
+    image_id: str,
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+):
+    """Raw ``application/octet-stream`` body with metadata in the query string."""
+    # Before reading the body, so a refused upload is not buffered first.
+    admission.admit(request, OTOLITH_INGEST_QUEUES)
+    check_image_id(image_id)
+    image_bytes = await request.body()
+    content_type = request.headers.get("content-type", "application/octet-stream")
+    return await asyncio.to_thread(queue_otolith_image, image_id, image_bytes, content_type, latitude, longitude)
+
+# --- Dashboard data ---
+# Constant statements, so asyncpg prepares each once per pooled connection.
+DASHBOARD_COLUMNS = "image_id, predicted_species, area, perimeter, width, height, aspect_ratio, latitude, longitude, created_at, id"
+DASHBOARD_FIRST_PAGE = text(f"""
+    SELECT {DASHBOARD_COLUMNS} FROM otolith_morphometrics
+    WHERE created_at IS NOT NULL
+    ORDER BY created_at DESC, id DESC LIMIT :limit
+""")
+DASHBOARD_NEXT_PAGE = text(f"""
+    SELECT {DASHBOARD_COLUMNS} FROM otolith_morphometrics
+    WHERE created_at IS NOT NULL
+      AND (created_at, id) < (CAST(:cursor_created_at AS TIMESTAMPTZ), CAST(:cursor_id AS INTEGER))
+    ORDER BY created_at DESC, id DESC LIMIT :limit
+""")
+
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+def dashboard_query(cursor, limit=None):
+    """Newest-first keyset query: rows strictly after ``cursor`` in (created_at, id) order.
+
+    ``limit=None`` binds ``LIMIT NULL``, i.e. no limit.
+    """
+    if not cursor:
+        return DASHBOARD_FIRST_PAGE, {"limit": limit}
+    created_at, row_id = decode_cursor(cursor)
+    return DASHBOARD_NEXT_PAGE, {"cursor_created_at": created_at, "cursor_id": row_id, "limit": limit}
+
+def dashboard_record(row):
+    record = dict(row)
+    record.pop("id")
+    record["created_at"] = record["created_at"].isoformat()
+    return record
+
+async def stream_dashboard_rows(cursor, limit, fmt):
+    """Yield the rows as NDJSON lines or one incrementally written JSON array.
+
+    A server-side cursor fetches DASHBOARD_STREAM_CHUNK rows at a time, so API
+    memory stays flat however large the archive is.
+    """
+    statement, params = dashboard_query(cursor, limit)
+    rows = db.stream(statement, params, chunk_size=DASHBOARD_STREAM_CHUNK)
+    if fmt == "ndjson":
+        async for row in rows:
+            yield json.dumps(dashboard_record(row)) + "\n"
+        return
+    yield "["
+    separator = ""
+    async for row in rows:
+        yield separator + json.dumps(dashboard_record(row))
+        separator = ","
+    yield "]"
+
+async def fetch_dashboard_page(cursor, limit):
+    statement, params = dashboard_query(cursor, limit + 1)
     try:
-        with engine.connect() as connection:
-            query = text("SELECT image_id, predicted_species, area, perimeter, width, height, aspect_ratio, latitude, longitude, created_at FROM otolith_morphometrics ORDER BY created_at DESC;")
-            result = connection.execute(query)
-            rows = result.fetchall()
-            return [dict(row._mapping) for row in rows]
+        rows = await db.fetch_all(statement, params)
     except Exception as e:
         logger.error(f"Error fetching dashboard data: {e}")
         raise HTTPException(status_code=500, detail="Could not fetch data from database.")
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return [dashboard_record(row) for row in rows], headers
+
+@app.get("/api/dashboard/data")
+async def get_dashboard_data(
+    request: Request,
+    limit: int = Query(DASHBOARD_PAGE_SIZE, ge=1, le=DASHBOARD_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: Optional[str] = Query(None, pattern="^(ndjson|json)$"),
+):
+    """Newest-first otolith records.
+
+    Paged by default: returns ``limit`` rows and, when more exist, an
+    ``X-Next-Cursor`` header to pass back as ``cursor``. With ``stream=ndjson``
+    or ``stream=json`` every row after ``cursor`` is streamed instead.
+    """
+    if stream:
+        media_type = "application/x-ndjson" if stream == "ndjson" else "application/json"
+        # Validate the cursor before the response starts streaming.
+        if cursor:
+            decode_cursor(cursor)
+        return StreamingResponse(stream_dashboard_rows(cursor, None, stream), media_type=media_type)
+    return await response_cache.respond_async(request, ["otolith"], lambda: fetch_dashboard_page(cursor, limit))
+
+async def fetch_dashboard_aggregates(bucket, since, until):
+    where, params = "WHERE bucket_size = :bucket AND sample_count > 0", {"bucket": bucket}
+    if since is not None:
+        where += " AND bucket_start >= :since"
+        params["since"] = since
+    if until is not None:
+        where += " AND bucket_start < :until"
+        params["until"] = until
+    sums = ", ".join(f"{m}_sum" for m in ROLLUP_METRICS)
+    query = text(f"SELECT bucket_start, species, sample_count, {sums} FROM otolith_rollups {where} ORDER BY bucket_start, species;")
+    try:
+        rows = await db.fetch_all(query, params)
+    except Exception as e:
+        logger.error(f"Error fetching dashboard aggregates: {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch aggregates from database.")
+
+    sum_columns = ("sample_count",) + tuple(f"{m}_sum" for m in ROLLUP_METRICS)
+
+    def summarise(sums):
+        count = sums["sample_count"]
+        return {"count": count, **{f"mean_{m}": (sums[f"{m}_sum"] / count if count else None) for m in ROLLUP_METRICS}}
+
+    buckets, per_species = [], {}
+    overall = dict.fromkeys(sum_columns, 0)
+    for row in rows:
+        species = row["species"] or None
+        buckets.append({"bucket_start": row["bucket_start"], "species": species, **summarise(row)})
+        species_sums = per_species.setdefault(species, dict.fromkeys(sum_columns, 0))
+        for column in sum_columns:
+            species_sums[column] += row[column]
+            overall[column] += row[column]
+    return {
+        "bucket": bucket,
+        "totals": {**summarise(overall), "unique_species": sum(1 for s in per_species if s)},
+        "species": [{"species": s, **summarise(sums)} for s, sums in per_species.items()],
+        "buckets": buckets,
+    }
+
+@app.get("/api/dashboard/aggregates")
+async def get_dashboard_aggregates(
+    request: Request,
+    bucket: str = Query("day", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Counts and mean morphometrics per time bucket and species, from the rollups.
+
+    Cost depends on the number of buckets in range, not on the number of
+    otoliths. ``species`` is null for samples still awaiting a prediction.
+    """
+    return await response_cache.respond_async(request, ["otolith"], lambda: fetch_dashboard_aggregates(bucket, since, until))
+
+async def fetch_map_bins(zoom, west, south, east, north):
+    x_min, y_min = tile_of(north, west, zoom)
+    x_max, y_max = tile_of(south, east, zoom)
+    params = {"zoom": zoom, "x_min": x_min, "x_max": x_max, "y_min": y_min, "y_max": y_max}
+    # A box crossing the antimeridian (west > east) wraps around the tile grid.
+    x_filter = "tile_x BETWEEN :x_min AND :x_max" if west <= east else "(tile_x >= :x_min OR tile_x <= :x_max)"
+    query = text(f"""
+        SELECT tile_x, tile_y, species, sample_count, latitude_sum, longitude_sum
+        FROM otolith_geo_bins
+        WHERE zoom = :zoom AND {x_filter} AND tile_y BETWEEN :y_min AND :y_max AND sample_count > 0
+        ORDER BY tile_x, tile_y;
+    """)
+    try:
+        rows = await db.fetch_all(query, params)
+    except Exception as e:
+        logger.error(f"Error fetching map bins: {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch map bins from database.")
+
+    tiles = {}
+    for row in rows:
+        tile = tiles.setdefault((row["tile_x"], row["tile_y"]), {"count": 0, "latitude_sum": 0.0, "longitude_sum": 0.0, "species": {}})
+        tile["count"] += row["sample_count"]
+        tile["latitude_sum"] += row["latitude_sum"]
+        tile["longitude_sum"] += row["longitude_sum"]
+        if row["species"]:
+            tile["species"][row["species"]] = row["sample_count"]
+    return [
+        {
+            "zoom": zoom, "x": x, "y": y, "count": tile["count"],
+            "latitude": tile["latitude_sum"] / tile["count"],
+            "longitude": tile["longitude_sum"] / tile["count"],
+            "dominant_species": max(tile["species"], key=tile["species"].get) if tile["species"] else None,
+            "species": tile["species"],
+        }
+        for (x, y), tile in tiles.items()
+    ]
+
+@app.get("/api/map/bins")
+async def get_map_bins(
+    request: Request,
+    zoom: int = Query(3, ge=0, le=GEO_MAX_ZOOM),
+    west: float = Query(-180.0, ge=-180.0, le=180.0),
+    south: float = Query(-90.0, ge=-90.0, le=90.0),
+    east: float = Query(180.0, ge=-180.0, le=180.0),
+    north: float = Query(90.0, ge=-90.0, le=90.0),
+):
+    """Pre-clustered map points: one per occupied tile at ``zoom`` in the bounding box.
+
+    Each bin carries the sample count, the centroid of its samples, the
+    dominant species and the per-species counts. Reads only the bins table
+    through its primary key, so cost follows the number of tiles in view.
+    """
+    if south > north:
+        raise HTTPException(status_code=400, detail="south must not exceed north.")
+    return await response_cache.respond_async(request, ["otolith"], lambda: fetch_map_bins(zoom, west, south, east, north))
+
+# --- Diversity ---
+# Computed over the sample x taxon abundance view (see diversity.py); cached
+# per sample set until the otolith or eDNA workers commit.
+SOURCE_PATTERN = f"^({'|'.join(ABUNDANCE_SOURCES)})$"
+
+async def fetch_abundance(sample_ids, source):
+    where, params = [], {}
+    if sample_ids:
+        where.append("sample_id = ANY(:sample_ids)")
+        params["sample_ids"] = sample_ids
+    if source:
+        where.append("source = :source")
+        params["source"] = source
+    query = text(
+        "SELECT sample_id, taxon, abundance FROM sample_taxon_abundance"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+    )
+    try:
+        rows = await db.fetch_all(query, params)
+    except Exception as e:
+        logger.error(f"Error fetching abundances: {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch abundances from database.")
+    return [(row["sample_id"], row["taxon"], row["abundance"]) for row in rows]
+
+def diversity_cache_key(request, sample_ids, *options):
+    """Same key for the same sample set, whatever the order or repetition of ``sample_id``."""
+    return request.url.path + "?" + "&".join(map(str, options)) + "&" + ",".join(sample_ids)
+
+def requested_samples(sample_id):
+    return sorted({s for value in sample_id or [] for s in value.split(",") if s})
+
+@app.get("/api/diversity/alpha")
+async def get_alpha_diversity(
+    request: Request,
+    sample_id: Optional[List[str]] = Query(None),
+    source: Optional[str] = Query(None, pattern=SOURCE_PATTERN),
+):
+    """Richness, Shannon, Simpson (1 - sum p^2) and evenness per sample.
+
+    Repeat or comma-separate ``sample_id`` to choose samples (default: all);
+    ``source`` limits them to eDNA or otolith samples.
+    """
+    sample_ids = requested_samples(sample_id)
+
+    async def build():
+        return await asyncio.to_thread(alpha_report, await fetch_abundance(sample_ids, source))
+
+    key = diversity_cache_key(request, sample_ids, source)
+    return await response_cache.respond_async(request, ["otolith", "edna"], build, key=key)
+
+@app.get("/api/diversity/beta")
+async def get_beta_diversity(
+    request: Request,
+    sample_id: Optional[List[str]] = Query(None),
+    source: Optional[str] = Query(None, pattern=SOURCE_PATTERN),
+    metric: str = Query("braycurtis", pattern=f"^({'|'.join(BETA_METRICS)})$"),
+):
+    """Pairwise distance matrix between samples: Bray-Curtis, or Jaccard on presence.
+
+    ``samples`` lists the matrix order; samples without abundances are left out.
+    """
+    sample_ids = requested_samples(sample_id)
+    if len(sample_ids) > DIVERSITY_MAX_SAMPLES:
+        raise HTTPException(status_code=400, detail=f"Compare at most {DIVERSITY_MAX_SAMPLES} samples.")
+
+    async def build():
+        rows = await fetch_abundance(sample_ids, source)
+        if len({row[0] for row in rows}) > DIVERSITY_MAX_SAMPLES:
+            raise HTTPException(status_code=400, detail=f"Compare at most {DIVERSITY_MAX_SAMPLES} samples; pass sample_id.")
+        return await asyncio.to_thread(beta_report, rows, metric)
+
+    key = diversity_cache_key(request, sample_ids, source, metric)
+    return await response_cache.respond_async(request, ["otolith", "edna"], build, key=key)
+
+# --- Per-image results ---
+OTOLITH_RESULT = text("""
+    SELECT image_id, area, perimeter, width, height, aspect_ratio, latitude, longitude, created_at,
+           model_version, COALESCE(predicted_species, 'Pending Prediction...') AS predicted_species
+    FROM otolith_morphometrics
+    WHERE image_id = :image_id
+""")
+# Rows for the images that were analysed or failed (dead-lettered) so far.
+OTOLITH_STATES = text("""
+    SELECT i.image_id, m.area, m.perimeter, m.width, m.height, m.aspect_ratio, m.latitude, m.longitude,
+           m.predicted_species, m.model_version, m.created_at,
+           f.stage AS failed_stage, f.reason AS failure, f.failed_at
+    FROM unnest(CAST(:image_ids AS TEXT[])) AS i(image_id)
+    LEFT JOIN otolith_morphometrics AS m ON m.image_id = i.image_id
+    LEFT JOIN otolith_failures AS f ON f.image_id = i.image_id
+    WHERE m.image_id IS NOT NULL OR f.image_id IS NOT NULL
+""")
+
+async def fetch_otolith_result(image_id):
+    try:
+        row = await db.fetch_one(OTOLITH_RESULT, {"image_id": image_id})
+    except Exception as e:
+        logger.error(f"Error fetching results for {image_id}: {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch results from database.")
+    if row is None:
+        raise HTTPException(status_code=404, detail="Results not found for this image ID.")
+    return dict(row)
+
+@app.get("/api/otolith/results/{image_id}")
+async def get_otolith_results(image_id: str, request: Request):
+    """Morphometrics and prediction for one image; cached until a worker updates it."""
+    return await response_cache.respond_async(request, [f"image:{image_id}"], lambda: fetch_otolith_result(image_id))
+
+async def fetch_otolith_states(image_ids):
+    rows = await db.fetch_all(OTOLITH_STATES, {"image_ids": image_ids})
+    return {row["image_id"]: dict(row) for row in rows}
+
+@app.get("/api/otolith/events")
+async def otolith_events(image_id: List[str] = Query(...)):
+    """Server-sent events for one or more images (repeat ``image_id`` or comma-separate).
+
+    Emits ``analysed`` when the morphometrics are committed, ``complete`` when
+    the prediction is, ``failed`` if the image's message was dead-lettered,
+    and ``done`` once every image is complete or failed. A stream still
+    waiting after ``SSE_MAX_WAIT_SECONDS`` ends with ``timeout``.
+    """
+    image_ids = sorted({i for value in image_id for i in value.split(",") if i})
+    if not image_ids or len(image_ids) > SSE_MAX_IMAGE_IDS:
+        raise HTTPException(status_code=400, detail=f"Subscribe to between 1 and {SSE_MAX_IMAGE_IDS} image IDs.")
+
+    return StreamingResponse(
+        otolith_event_stream(event_hub, image_ids, fetch_otolith_states),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Health ---
+@app.get("/api/health/live")
+def health_live():
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+async def health_ready():
+    """Ready once the database answers at the schema version this code expects."""
+    version = await applied_schema_version()
+    if version != SCHEMA_VERSION:
+        raise HTTPException(status_code=503, detail={"schema_version": version, "expected": SCHEMA_VERSION})
+    return {"status": "ready", "schema_version": version}
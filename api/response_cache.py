@@ -0,0 +1,223 @@
+"""In-process response cache for the read endpoints, invalidated by Postgres NOTIFY.
+
+Rows only change when a worker commits a batch, and the workers send
+``pg_notify('otolith_changes', '{"image_ids": [...]}')`` inside that
+transaction. ``ChangeListener`` LISTENs on a dedicated psycopg2 connection and
+drops the affected entries, so between commits polling clients are answered
+from memory. Clients that send the ETag back in ``If-None-Match`` get a 304
+with no body.
+
+Each entry carries tags: ``otolith`` for anything derived from the whole
+table, ``image:<image_id>`` for single-image lookups, ``taxonomy`` for
+reads invalidated by the taxonomy worker's ``taxonomy_changes`` and ``edna``
+for reads of the eDNA worker's counts (``edna_changes``). A TTL bounds
+staleness if a notification is ever lost. While the listener is disconnected the cache
+is bypassed, since invalidations could be missed.
+"""
+import hashlib
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '256'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '30'))
+OTOLITH_CHANGES_CHANNEL = 'otolith_changes'
+TAXONOMY_CHANGES_CHANNEL = 'taxonomy_changes'
+EDNA_CHANGES_CHANNEL = 'edna_changes'
+
+
+class CachedResponse:
+    def __init__(self, body, headers, tags, expires):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.headers = dict(headers or {}, ETag=self.etag)
+        self.tags = tags
+        self.expires = expires
+
+    def to_response(self, if_none_match=None):
+        if if_none_match and self.etag in [t.strip() for t in if_none_match.split(',')]:
+            return Response(status_code=304, headers=self.headers)
+        return Response(content=self.body, media_type='application/json', headers=self.headers)
+
+
+class ResponseCache:
+    """Thread-safe TTL/LRU of serialised JSON responses."""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = False
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a response built from a read that
+        # started before the bump is not stored.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def respond(self, request, tags, build, key=None):
+        """Serve ``request`` from the cache, or call ``build()`` and cache its result.
+
+        ``build`` returns the JSON-able payload, or ``(payload, headers)``.
+        ``key`` defaults to the request's path and query string; pass one when
+        equivalent queries can be spelled differently.
+        """
+        key, cached, generation = self._lookup(request, key)
+        if cached is not None:
+            return cached
+        return self._store(request, key, tags, generation, build())
+
+    async def respond_async(self, request, tags, build, key=None):
+        """``respond`` for an async ``build`` coroutine function."""
+        key, cached, generation = self._lookup(request, key)
+        if cached is not None:
+            return cached
+        return self._store(request, key, tags, generation, await build())
+
+    def _lookup(self, request, key=None):
+        if key is None:
+            key = request.url.path + '?' + str(request.query_params)
+        with self._lock:
+            entry = self._entries.get(key) if self.enabled else None
+            if entry is not None and entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, entry.to_response(request.headers.get('if-none-match')), None
+            self.misses += 1
+            return key, None, self._generation
+
+    def _store(self, request, key, tags, generation, result):
+        payload, headers = result if isinstance(result, tuple) else (result, None)
+        body = json.dumps(jsonable_encoder(payload)).encode()
+        entry = CachedResponse(body, headers, set(tags), time.monotonic() + self.ttl)
+        with self._lock:
+            # Skip storing if an invalidation raced with the read.
+            if self.enabled and generation == self._generation:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry.to_response(request.headers.get('if-none-match'))
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        with self._lock:
+            self._generation += 1
+            for key in [k for k, entry in self._entries.items() if entry.tags & tags]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def set_enabled(self, enabled):
+        with self._lock:
+            self._generation += 1
+            self.enabled = enabled
+            self._entries.clear()
+
+
+def changed_image_ids(payload):
+    """``image_id``s in an ``otolith_changes`` payload, or None for "everything"."""
+    try:
+        return json.loads(payload)['image_ids']
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def otolith_change_tags(payload):
+    """Cache tags touched by one ``otolith_changes`` notification, or None for all."""
+    image_ids = changed_image_ids(payload)
+    if image_ids is None:
+        return None
+    return ['otolith'] + [f'image:{image_id}' for image_id in image_ids]
+
+
+def invalidate_otolith_changes(cache, payload):
+    tags = otolith_change_tags(payload)
+    if tags is None:
+        cache.clear()
+    else:
+        cache.invalidate(tags)
+
+
+class ChangeListener:
+    """Background thread LISTENing on Postgres channels.
+
+    ``handlers`` maps a channel to ``callback(payload)``. ``on_connected`` and
+    ``on_disconnected`` let the cache switch itself on and off with the
+    connection.
+    """
+
+    def __init__(self, dsn, handlers, on_connected=None, on_disconnected=None, retry_delay=5):
+        # libpq does not understand SQLAlchemy's '+driver' suffix.
+        self.dsn = dsn.replace('postgresql+psycopg2://', 'postgresql://')
+        self.handlers = handlers
+        self.on_connected = on_connected
+        self.on_disconnected = on_disconnected
+        self.retry_delay = retry_delay
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    for channel in self.handlers:
+                        cur.execute(f'LISTEN {channel};')
+                logger.info(f"Listening for {', '.join(self.handlers)} notifications.")
+                if self.on_connected:
+                    self.on_connected()
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            self.handlers[notify.channel](notify.payload)
+            except Exception as e:
+                logger.warning(f"Change listener disconnected: {e}. Retrying in {self.retry_delay} seconds...")
+            finally:
+                if self.on_disconnected:
+                    self.on_disconnected()
+                if conn is not None:
+                    conn.close()
+            self._stop.wait(self.retry_delay)
+
+
+def cache_listener(dsn, cache, handlers):
+    """Listener whose connection state switches ``cache`` on and off."""
+    return ChangeListener(
+        dsn, handlers,
+        on_connected=lambda: cache.set_enabled(True),
+        on_disconnected=lambda: cache.set_enabled(False),
+    )
+
+
+def otolith_cache_listener(dsn, cache):
+    """Listener that keeps ``cache`` in step with ``otolith_changes``."""
+    return cache_listener(dsn, cache, {
+        OTOLITH_CHANGES_CHANNEL: lambda payload: invalidate_otolith_changes(cache, payload),
+    })
@@ -0,0 +1,198 @@
+"""Streaming FASTQ/FASTA ingestion with dereplication for eDNA runs.
+
+An upload is consumed chunk by chunk and never held in memory:
+
+- ``decompress`` inflates gzip input on the fly (detected from the magic bytes);
+- ``parse_records`` is a generator of ``(sequence, quality)`` records; quality
+  is None for FASTA;
+- ``reject_reason`` drops reads outside the length bounds, with ambiguous
+  bases or with a low mean Phred score;
+- identical reads are counted in a dictionary of at most
+  ``EDNA_DEREP_MAX_UNIQUE`` sequences. When it fills up, and at the end of the
+  upload, it is drained to ``edna_queue`` as batches of
+  ``EDNA_BATCH_SEQUENCES`` ``[sequence, count]`` pairs (see
+  ``workers/edna_worker.py``).
+
+Memory is therefore bounded by the dictionary, whatever the file size, and the
+queue carries each distinct sequence once per drain instead of every read.
+
+Because batches are published while the upload streams in, a format error
+late in a large file can come after some batches were already queued; those
+are not withdrawn. ``SequenceFormatError.stats`` then reports them, and the
+endpoint answers with a partial acceptance rather than a plain 400. Batch
+IDs depend only on ``upload_id`` and the reads before each drain, so
+re-sending the corrected file with the same ``upload_id`` does not count the
+queued batches twice. The worker tracks batch IDs per sample, so reusing an
+``upload_id`` for another sample is harmless.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+EDNA_MIN_LENGTH = int(os.getenv('EDNA_MIN_LENGTH', '80'))
+EDNA_MAX_LENGTH = int(os.getenv('EDNA_MAX_LENGTH', '1000'))
+EDNA_MIN_MEAN_QUALITY = float(os.getenv('EDNA_MIN_MEAN_QUALITY', '20'))
+EDNA_MAX_AMBIGUOUS = int(os.getenv('EDNA_MAX_AMBIGUOUS', '0'))
+EDNA_DEREP_MAX_UNIQUE = int(os.getenv('EDNA_DEREP_MAX_UNIQUE', '100000'))
+EDNA_BATCH_SEQUENCES = int(os.getenv('EDNA_BATCH_SEQUENCES', '2000'))
+PHRED_OFFSET = 33
+
+
+class SequenceFormatError(ValueError):
+    """Raised when an upload is not valid FASTQ or FASTA.
+
+    ``stats`` holds the upload's statistics up to the error once at least one
+    batch has been published (``batches`` and ``unique_sequences`` count only
+    what was queued), and is None otherwise.
+    """
+    stats = None
+
+
+# --- Parsing ---
+def iterate_in_thread(chunks, loop):
+    """Blocking iterator over the async iterator ``chunks`` running on ``loop``.
+
+    Lets the parser run in a worker thread while the request body is still
+    read on the event loop, one chunk at a time.
+    """
+    iterator = chunks.__aiter__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(iterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def decompress(chunks):
+    """Pass ``chunks`` through, inflating them if the stream is gzipped."""
+    chunks = iter(chunks)
+    first = b''
+    for first in chunks:
+        if first:
+            break
+    if first[:2] != b'\x1f\x8b':
+        if first:
+            yield first
+        yield from chunks
+        return
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    try:
+        for chunk in itertools.chain([first], chunks):
+            while chunk:
+                yield inflater.decompress(chunk)
+                # Concatenated gzip members (e.g. bgzip) each need a new inflater.
+                chunk = inflater.unused_data
+                if chunk:
+                    yield inflater.flush()
+                    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        yield inflater.flush()
+    except zlib.error as e:
+        raise SequenceFormatError(f"Corrupt gzip stream: {e}")
+
+
+def _lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def parse_records(chunks):
+    """Yield ``(sequence, quality)`` byte strings from FASTQ or FASTA chunks."""
+    lines = (line.rstrip(b'\r') for line in _lines(decompress(chunks)))
+    first = next((line for line in lines if line.strip()), None)
+    if first is None:
+        return
+    if first.startswith(b'@'):
+        header = first
+        while header is not None:
+            sequence, separator, quality = next(lines, None), next(lines, None), next(lines, None)
+            if quality is None or not separator.startswith(b'+'):
+                raise SequenceFormatError(f"Truncated FASTQ record {header[:80]!r}")
+            if len(quality) != len(sequence):
+                raise SequenceFormatError(f"Sequence and quality lengths differ in {header[:80]!r}")
+            yield sequence, quality
+            header = next((line for line in lines if line.strip()), None)
+            if header is not None and not header.startswith(b'@'):
+                raise SequenceFormatError(f"Expected a FASTQ header, got {header[:80]!r}")
+    elif first.startswith(b'>'):
+        parts = []
+        for line in lines:
+            if line.startswith(b'>'):
+                yield b''.join(parts), None
+                parts = []
+            else:
+                parts.append(line.strip())
+        yield b''.join(parts), None
+    else:
+        raise SequenceFormatError("Upload is neither FASTQ ('@') nor FASTA ('>').")
+
+
+# --- Filtering ---
+def reject_reason(sequence, quality):
+    """Why a read is dropped ('length', 'ambiguous', 'quality'), or None to keep it."""
+    if not EDNA_MIN_LENGTH <= len(sequence) <= EDNA_MAX_LENGTH:
+        return 'length'
+    if len(sequence.translate(None, b'ACGTacgt')) > EDNA_MAX_AMBIGUOUS:
+        return 'ambiguous'
+    if quality is not None and sum(quality) / len(quality) - PHRED_OFFSET < EDNA_MIN_MEAN_QUALITY:
+        return 'quality'
+    return None
+
+
+# --- Dereplication ---
+def ingest_sequences(chunks, publish, sample_id, upload_id):
+    """Parse, filter and dereplicate ``chunks``, passing batches to ``publish``.
+
+    ``publish(message)`` receives the ``edna_queue`` message dicts. Returns
+    the upload's statistics.
+    """
+    counts = {}
+    stats = {
+        'reads': 0, 'passed': 0, 'unique_sequences': 0, 'batches': 0,
+        'filtered': {'length': 0, 'ambiguous': 0, 'quality': 0},
+    }
+
+    def drain():
+        ordered = sorted(counts.items(), key=lambda item: -item[1])
+        for start in range(0, len(ordered), EDNA_BATCH_SEQUENCES):
+            batch = ordered[start:start + EDNA_BATCH_SEQUENCES]
+            publish({
+                'sample_id': sample_id,
+                'batch_id': f"{upload_id}-{stats['batches']}",
+                'sequences': [[sequence.decode('ascii', 'replace'), count] for sequence, count in batch],
+            })
+            stats['batches'] += 1
+        stats['unique_sequences'] += len(counts)
+        counts.clear()
+
+    try:
+        for sequence, quality in parse_records(chunks):
+            stats['reads'] += 1
+            reason = reject_reason(sequence, quality)
+            if reason:
+                stats['filtered'][reason] += 1
+                continue
+            stats['passed'] += 1
+            sequence = sequence.upper()
+            counts[sequence] = counts.get(sequence, 0) + 1
+            if len(counts) >= EDNA_DEREP_MAX_UNIQUE:
+                drain()
+    except SequenceFormatError as e:
+        # Reads still in ``counts`` are dropped; drained batches stay queued.
+        if stats['batches']:
+            e.stats = stats
+            logger.warning(f"eDNA upload {upload_id} ({sample_id}) failed after {stats['batches']} queued batches: {e}")
+        raise
+    drain()
+
+    stats['dereplication_factor'] = round(stats['passed'] / stats['unique_sequences'], 2) if stats['unique_sequences'] else None
+    logger.info(f"eDNA upload {upload_id} ({sample_id}): {stats}")
+    return stats
@@ -0,0 +1,224 @@
+"""Bulk import of species checklists into ``taxonomies``.
+
+A checklist is a CSV or TSV file with a header row (the delimiter is taken
+from the header). It needs a ``name`` column (``scientificName`` /
+``scientific_name`` also work), and either a ``classification`` lineage or
+rank columns (``kingdom``, ``phylum``, ... ``genus``, as in Darwin Core
+exports), which are joined into one.
+
+Rows are parsed as the upload streams in and fed straight to ``COPY`` into a
+temporary staging table, so memory holds one block of rows whatever the file
+size. One ``INSERT ... SELECT ... ON CONFLICT (name) DO NOTHING`` then merges
+the staging table into ``taxonomies``; as with the taxonomy worker, the first
+classification for a name wins. The new taxa are added to the hierarchy
+(``index_taxa``) and announced on ``taxonomy_changes`` in the same
+transaction.
+
+Usage::
+
+    python taxonomy_import.py checklist.tsv [more.csv ...]
+    curl --data-binary @checklist.tsv http://localhost:8000/api/ingest/taxonomy/checklist
+"""
+import argparse
+import codecs
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from schema import TAXON_RANKS
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/cmlre_data")
+# Rows formatted per read by COPY.
+COPY_BLOCK_BYTES = 1 << 16
+NAME_COLUMNS = ('name', 'scientificname', 'scientific_name')
+LINEAGE_RANKS = TAXON_RANKS[:-1]
+# Same limit as the workers' NOTIFY payloads (db_writer.NOTIFY_MAX_PAYLOAD).
+NOTIFY_MAX_PAYLOAD = 7900
+
+CREATE_STAGING = """
+    CREATE TEMPORARY TABLE taxonomy_staging (
+        line BIGINT NOT NULL,
+        name TEXT NOT NULL,
+        classification TEXT
+    ) ON COMMIT DROP
+"""
+COPY_STAGING = "COPY taxonomy_staging (line, name, classification) FROM STDIN WITH (FORMAT csv)"
+MERGE_STAGING = """
+    INSERT INTO taxonomies (name, classification)
+    SELECT DISTINCT ON (name) name, classification
+    FROM taxonomy_staging
+    ORDER BY name, line
+    ON CONFLICT (name) DO NOTHING
+    RETURNING id, name
+"""
+
+
+class ChecklistFormatError(ValueError):
+    """Raised when an upload is not a usable CSV/TSV checklist."""
+
+
+# --- Parsing ---
+def _lines(chunks):
+    """Text lines (newline kept, for quoted multi-line fields) from byte chunks."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def parse_checklist(chunks, stats):
+    """Read the header, then return an iterator of ``(line, name, classification)`` rows.
+
+    Header problems raise ``ChecklistFormatError`` here, before any ``COPY``
+    starts; a malformed row raises it from the iterator, with its line
+    number. Rows without a name are counted in ``stats``.
+    """
+    lines = _lines(chunks)
+    header, header_lines = None, 0
+    for line in lines:
+        header_lines += 1
+        if line.strip():
+            header = line
+            break
+    if header is None:
+        raise ChecklistFormatError("Empty checklist.")
+    delimiter = '\t' if '\t' in header else ','
+    columns = [column.strip().lower() for column in next(csv.reader([header], delimiter=delimiter))]
+    name_index = next((columns.index(c) for c in NAME_COLUMNS if c in columns), None)
+    if name_index is None:
+        raise ChecklistFormatError(f"No name column; expected one of {', '.join(NAME_COLUMNS)}.")
+    if 'classification' in columns:
+        lineage = [columns.index('classification')]
+    else:
+        lineage = [columns.index(rank) for rank in LINEAGE_RANKS if rank in columns]
+
+    reader = csv.reader(lines, delimiter=delimiter)
+
+    def rows():
+        try:
+            for fields in reader:
+                if not fields:
+                    continue
+                if any('\0' in field for field in fields):
+                    # Postgres text cannot hold NUL; a csv.Error on some Python versions.
+                    raise ChecklistFormatError(f"Line {header_lines + reader.line_num}: NUL byte in a field.")
+                name = fields[name_index].strip() if name_index < len(fields) else ''
+                if not name:
+                    stats['rejected'] += 1
+                    continue
+                parts = [fields[i].strip() for i in lineage if i < len(fields)]
+                stats['rows'] += 1
+                yield reader.line_num, name, ' > '.join(part for part in parts if part) or None
+        except csv.Error as e:
+            # Malformed quoting, a field over csv.field_size_limit(), ...
+            raise ChecklistFormatError(f"Line {header_lines + reader.line_num}: {e}") from e
+
+    return rows()
+
+
+class CsvStream:
+    """Read-only file over ``rows`` in CSV, for ``copy_expert``; one block in memory.
+
+    ``error`` keeps a ``ChecklistFormatError`` raised by ``rows``, which
+    psycopg2 only reports as a cancelled ``COPY``.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self.error = None
+
+    def read(self, size=-1):
+        size = size if size and size > 0 else COPY_BLOCK_BYTES
+        while self._buffer.tell() < size:
+            try:
+                row = next(self._rows, None)
+            except ChecklistFormatError as e:
+                self.error = e
+                raise
+            if row is None:
+                break
+            self._writer.writerow(row)
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+# --- Loading ---
+def import_checklist(chunks, engine, source='upload'):
+    """COPY a checklist into staging and merge it into ``taxonomies``; returns statistics."""
+    stats = {'rows': 0, 'rejected': 0, 'inserted': 0}
+    started = time.monotonic()
+    stream = CsvStream(parse_checklist(chunks, stats))
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING)
+            cursor.copy_expert(COPY_STAGING, stream)
+            copied = time.monotonic()
+            cursor.execute(MERGE_STAGING)
+            inserted = cursor.fetchall()
+            if inserted:
+                cursor.execute("SELECT index_taxa(%s)", ([row[0] for row in inserted],))
+                payload = json.dumps({'names': [row[1] for row in inserted]})
+                if len(payload) > NOTIFY_MAX_PAYLOAD:
+                    # Listeners treat null as "everything changed".
+                    payload = json.dumps({'names': None})
+                cursor.execute("SELECT pg_notify('taxonomy_changes', %s)", (payload,))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if stream.error is not None:
+            raise stream.error
+        raise
+    finally:
+        connection.close()
+    stats['inserted'] = len(inserted)
+    # Already in ``taxonomies``, or repeated in the file.
+    stats['skipped'] = stats['rows'] - stats['inserted']
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    logger.info(
+        f"Imported checklist {source}: {stats}; COPY {copied - started:.2f}s, merge {time.monotonic() - copied:.2f}s"
+    )
+    return stats
+
+
+def read_file(path, block_size=1 << 20):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(block_size), b'')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help="CSV/TSV checklist files")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL)
+    for path in args.paths:
+        try:
+            print(json.dumps({'path': path, **import_checklist(read_file(path), engine, source=path)}))
+        except ChecklistFormatError as e:
+            logger.error(f"{path}: {e}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
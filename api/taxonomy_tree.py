@@ -0,0 +1,210 @@
+"""In-memory taxon hierarchy with subtree counts, for drill-down queries.
+
+The hierarchy itself lives in ``taxon_nodes`` / ``taxon_closure`` (built by
+``index_taxa``, see shared/schema.py). ``TaxonomyTree`` loads it once and keeps,
+for every node, totals over its whole subtree:
+
+- ``taxa``: ``taxonomies`` entries;
+- ``otoliths``: identified otoliths, by predicted species;
+- ``edna_reads``: eDNA reads assigned to the taxon.
+
+Occurrences are matched to ``taxonomies.name`` and come from the
+``sample_taxon_abundance`` view. Adding a count walks the node's ancestors,
+so a drill-down reads precomputed totals and costs O(subtree) at most.
+
+Updates are incremental. The NOTIFY listener thread only records what changed
+(``taxa_changed`` with the inserted names, ``occurrences_changed``); the next
+request applies it in ``refresh``. New taxa load just their lineage through
+the closure table. Occurrence totals are recomputed from the aggregate tables
+at most every ``TAXONOMY_COUNTS_MAX_AGE`` seconds.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TAXONOMY_COUNTS_MAX_AGE = float(os.getenv('TAXONOMY_COUNTS_MAX_AGE', '5'))
+OCCURRENCE_COUNTS = {'otolith': 'otoliths', 'edna': 'edna_reads'}
+COUNTS = ('taxa',) + tuple(OCCURRENCE_COUNTS.values())
+
+ALL_NODES = "SELECT id, parent_id, rank, name FROM taxon_nodes"
+ALL_TAXA = "SELECT name, node_id FROM taxonomies WHERE node_id IS NOT NULL"
+LINEAGE_NODES = """
+    SELECT n.id, n.parent_id, n.rank, n.name
+    FROM taxon_nodes AS n
+    WHERE n.id IN (
+        SELECT c.ancestor_id
+        FROM taxonomies AS t
+        JOIN taxon_closure AS c ON c.descendant_id = t.node_id
+        WHERE t.name = ANY(:names)
+    )
+"""
+NAMED_TAXA = "SELECT name, node_id FROM taxonomies WHERE node_id IS NOT NULL AND name = ANY(:names)"
+OCCURRENCES = """
+    SELECT source, taxon, SUM(abundance) AS abundance
+    FROM sample_taxon_abundance
+    GROUP BY source, taxon
+"""
+
+
+class TaxonNode:
+    __slots__ = ('id', 'parent', 'rank', 'name', 'taxon', 'children', 'totals')
+
+    def __init__(self, node_id, rank, name):
+        self.id = node_id
+        self.parent = None
+        self.rank = rank
+        self.name = name
+        self.taxon = None  # the ``taxonomies`` entry this node is the leaf of, if any
+        self.children = []
+        self.totals = dict.fromkeys(COUNTS, 0)
+
+    def lineage(self):
+        node, lineage = self, []
+        while node is not None:
+            lineage.append({'id': node.id, 'rank': node.rank, 'name': node.name})
+            node = node.parent
+        return lineage[::-1]
+
+
+class TaxonomyTree:
+    """Cached taxon hierarchy; mutated only by ``refresh`` on the event loop."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.roots = []
+        self._by_name = {}
+        self._taxa = {}
+        self._occurrences = {}
+        self._pending = threading.Lock()
+        self._reload = True
+        self._new_names = set()
+        self._occurrences_stale = True
+        self._counted_at = 0.0
+        self._refreshing = None
+
+    # --- Change notifications (listener thread) ---
+    def taxa_changed(self, names):
+        """Record inserted taxon names; None means reload everything."""
+        with self._pending:
+            if names is None:
+                self._reload = True
+            else:
+                self._new_names.update(names)
+
+    def occurrences_changed(self):
+        with self._pending:
+            self._occurrences_stale = True
+
+    def reset(self):
+        """Reload on the next refresh, e.g. after notifications may have been missed."""
+        with self._pending:
+            self._reload = True
+
+    # --- Loading ---
+    async def refresh(self, database):
+        """Apply pending changes; call before reading the tree."""
+        if self._refreshing is None:
+            # Created here so it binds to the server's event loop.
+            self._refreshing = asyncio.Lock()
+        async with self._refreshing:
+            with self._pending:
+                reload, self._reload = self._reload, False
+                names, self._new_names = self._new_names, set()
+                count_occurrences = reload or (
+                    self._occurrences_stale and time.monotonic() - self._counted_at >= TAXONOMY_COUNTS_MAX_AGE
+                )
+                if count_occurrences:
+                    self._occurrences_stale = False
+            try:
+                if reload:
+                    self._clear()
+                    self._add_nodes(await database.fetch_all(ALL_NODES))
+                    self._add_taxa(await database.fetch_all(ALL_TAXA))
+                elif names:
+                    names = sorted(names)
+                    self._add_nodes(await database.fetch_all(LINEAGE_NODES, {'names': names}))
+                    self._add_taxa(await database.fetch_all(NAMED_TAXA, {'names': names}))
+                if count_occurrences:
+                    self._count_occurrences(await database.fetch_all(OCCURRENCES))
+                    self._counted_at = time.monotonic()
+            except Exception:
+                # Retry the whole load next time rather than serve a partial tree.
+                self.reset()
+                raise
+            if reload:
+                logger.info(f"Loaded taxonomy tree: {len(self.nodes)} nodes, {len(self._taxa)} taxa.")
+
+    def _clear(self):
+        self.nodes, self.roots, self._by_name, self._taxa, self._occurrences = {}, [], {}, {}, {}
+
+    def _add_nodes(self, rows):
+        rows = [row for row in rows if row['id'] not in self.nodes]
+        for row in rows:
+            node = TaxonNode(row['id'], row['rank'], row['name'])
+            self.nodes[node.id] = node
+            self._by_name.setdefault(node.name.lower(), []).append(node)
+        # Link in a second pass: rows arrive in no particular order.
+        for row in rows:
+            node, parent = self.nodes[row['id']], self.nodes.get(row['parent_id'])
+            if parent is None:
+                self.roots.append(node)
+            else:
+                node.parent = parent
+                parent.children.append(node)
+
+    def _add(self, node, count, amount):
+        while node is not None:
+            node.totals[count] += amount
+            node = node.parent
+
+    def _add_taxa(self, rows):
+        for row in rows:
+            node = self.nodes.get(row['node_id'])
+            if node is None or row['name'] in self._taxa:
+                continue
+            self._taxa[row['name']] = node
+            node.taxon = row['name']
+            self._add(node, 'taxa', 1)
+            # Occurrences recorded before the taxon was known.
+            for count, amount in self._occurrences.get(row['name'], {}).items():
+                self._add(node, count, amount)
+
+    def _count_occurrences(self, rows):
+        for node in self.nodes.values():
+            for count in OCCURRENCE_COUNTS.values():
+                node.totals[count] = 0
+        self._occurrences = {}
+        for row in rows:
+            count = OCCURRENCE_COUNTS.get(row['source'])
+            if count is None:
+                continue
+            amount = int(row['abundance'])
+            self._occurrences.setdefault(row['taxon'], {})[count] = amount
+            node = self._taxa.get(row['taxon'])
+            if node is not None:
+                self._add(node, count, amount)
+
+    # --- Queries ---
+    def find(self, name, rank=None):
+        return [node for node in self._by_name.get(name.lower(), []) if rank is None or node.rank == rank]
+
+    def describe(self, node, depth=1):
+        """Node summary with its subtree totals and ``depth`` levels of children."""
+        summary = {'id': node.id, 'rank': node.rank, 'name': node.name, **node.totals}
+        if depth > 0:
+            summary['children'] = [self.describe(child, depth - 1) for child in sorted(node.children, key=lambda c: c.name)]
+        return summary
+
+    def taxa_under(self, node):
+        """``taxonomies`` entries in the subtree of ``node``, with their own totals."""
+        stack, taxa = [node], []
+        while stack:
+            current = stack.pop()
+            stack.extend(current.children)
+            if current.taxon is not None:
+                taxa.append({'name': current.taxon, 'rank': current.rank, 'node_id': current.id, **current.totals})
+        return sorted(taxa, key=lambda taxon: taxon['name'])
@@ -0,0 +1,94 @@
+"""Apply pending schema migrations (shared/schema.py), then exit.
+
+Run once per deployment before the API and workers start::
+
+    python migrate.py            # wait for the database, migrate
+    python migrate.py --check    # exit 1 unless the schema is current
+
+Each migration runs in its own transaction together with its
+``schema_migrations`` row. A session advisory lock lets several copies run at
+once: the others wait, then find nothing left to do.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from schema import MIGRATIONS, SCHEMA_VERSION, schema_version
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('migrate')
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/cmlre_data")
+# Arbitrary key shared by every copy of this script.
+MIGRATION_LOCK_KEY = 41012
+
+
+def connect(engine, timeout):
+    """Open a connection, retrying until the database accepts one or ``timeout`` expires."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return engine.connect()
+        except Exception as e:
+            if time.monotonic() >= deadline:
+                raise
+            logger.info(f"Database not reachable yet ({e.__class__.__name__}), retrying...")
+            time.sleep(1)
+
+
+def migrate(connection):
+    """Apply every migration newer than the recorded version; return the new version."""
+    connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_KEY})")
+    try:
+        connection.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        connection.commit()
+        current = schema_version(connection)
+        for version, name, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.monotonic()
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(
+                "INSERT INTO schema_migrations (version, name) VALUES (%(version)s, %(name)s)",
+                {'version': version, 'name': name},
+            )
+            connection.commit()
+            logger.info(f"Applied migration {version} ({name}) in {time.monotonic() - started:.2f}s.")
+            current = version
+        return current
+    finally:
+        connection.rollback()
+        connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_KEY})")
+        connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='store_true', help="only report whether the schema is current")
+    parser.add_argument('--wait', type=float, default=60, help="seconds to wait for the database (default 60)")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL)
+    with connect(engine, args.wait) as connection:
+        if args.check:
+            version = schema_version(connection)
+            logger.info(f"Schema version {version}, expected {SCHEMA_VERSION}.")
+            return 0 if version == SCHEMA_VERSION else 1
+        version = migrate(connection)
+    logger.info(f"Schema is at version {version}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
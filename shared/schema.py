@@ -0,0 +1,421 @@
+"""Canonical database schema shared by the API, the workers and ``migrate.py``.
+
+``MIGRATIONS`` is the ordered history of the schema. ``migrate.py`` applies the
+pending ones once, in a dedicated step before any service starts, and records
+each in ``schema_migrations``. Services only compare the recorded version with
+``SCHEMA_VERSION`` (one query, see ``wait_for_schema``) instead of creating
+tables themselves.
+
+Migrations are plain SQL with no bind parameters, executed with
+``exec_driver_sql``. Only ever append new ones: an applied migration must not
+change.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long a service waits at startup for the migration step to finish.
+SCHEMA_WAIT_SECONDS = float(os.getenv('SCHEMA_WAIT_SECONDS', '120'))
+
+# --- Canonical columns ---
+OTOLITH_METRICS = ('area', 'perimeter', 'width', 'height', 'aspect_ratio')
+OTOLITH_COLUMNS = (
+    'id', 'image_id', *OTOLITH_METRICS, 'predicted_species', 'latitude', 'longitude',
+    'created_at', 'content_hash', 'model_version',
+)
+# image_id is VARCHAR(255) in otolith_morphometrics and otolith_failures.
+IMAGE_ID_MAX_LENGTH = 255
+# Column names used by the early prototypes (main_ai.py, otolith_worker_db.py).
+LEGACY_COLUMN_NAMES = {
+    'area_px': 'area',
+    'perimeter_px': 'perimeter',
+    'width_px': 'width',
+    'height_px': 'height',
+    'analysis_timestamp': 'created_at',
+}
+
+# --- Rollups and map bins ---
+ROLLUP_BUCKET_SIZES = ('hour', 'day')
+ROLLUP_METRICS = OTOLITH_METRICS
+
+# Web-mercator tile of (``lat``, ``longitude``) at ``zoom``, clamped to the
+# grid; ``lat`` is the latitude clamped to the projection's range.
+GEO_MAX_ZOOM = 12
+MAX_LATITUDE = 85.05112878
+TILE_X = "LEAST(GREATEST(floor((longitude + 180.0) / 360.0 * (1 << zoom))::int, 0), (1 << zoom) - 1)"
+TILE_Y = (
+    "LEAST(GREATEST(floor((1.0 - ln(tan(radians(lat)) + 1.0 / cos(radians(lat))) / pi()) / 2.0"
+    " * (1 << zoom))::int, 0), (1 << zoom) - 1)"
+)
+CLAMPED_LATITUDE = f"LEAST(GREATEST(latitude, -{MAX_LATITUDE}), {MAX_LATITUDE})"
+
+# --- Abundance ---
+# Otolith samples are the identified otoliths of one UTC day, from the day
+# rollups; eDNA samples are the uploads' ``sample_id``s.
+ABUNDANCE_SOURCES = ('edna', 'otolith')
+OTOLITH_SAMPLE_ID = "'otolith:' || to_char(bucket_start AT TIME ZONE 'UTC', 'YYYY-MM-DD')"
+
+# --- Taxon hierarchy ---
+# ``taxonomies.classification`` is a lineage such as
+# "Animalia > Chordata > Actinopterygii > Gadiformes > Gadidae > Gadus", split
+# on '>', ';' or '|'. Parts may carry a rank prefix ("f__Gadidae", as in
+# QIIME/SILVA exports); unprefixed parts take their rank counting back from the
+# taxon's own name, which is the species. ``index_taxa(ids)`` (migration 7)
+# turns lineages into ``taxon_nodes`` and the ``taxon_closure`` table.
+TAXON_RANKS = ('kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+TAXON_RANK_PREFIXES = 'kpcofgs'
+LINEAGE_SEPARATORS = '[>;|]'
+
+
+def _rename_legacy_columns():
+    renames = "\n".join(
+        f"""
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'otolith_morphometrics' AND column_name = '{old}')
+           AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_name = 'otolith_morphometrics' AND column_name = '{new}') THEN
+            ALTER TABLE otolith_morphometrics RENAME COLUMN {old} TO {new};
+        END IF;"""
+        for old, new in LEGACY_COLUMN_NAMES.items()
+    )
+    return f"DO $$\nBEGIN{renames}\nEND\n$$;"
+
+
+_ROLLUP_SUMS = ", ".join(f"{m}_sum" for m in ROLLUP_METRICS)
+
+MIGRATIONS = [
+    (1, 'canonical otolith_morphometrics', [
+        """
+        CREATE TABLE IF NOT EXISTS otolith_morphometrics (
+            id SERIAL PRIMARY KEY,
+            image_id VARCHAR(255) UNIQUE NOT NULL,
+            area DOUBLE PRECISION, perimeter DOUBLE PRECISION, width DOUBLE PRECISION,
+            height DOUBLE PRECISION, aspect_ratio DOUBLE PRECISION,
+            predicted_species VARCHAR(255), latitude DOUBLE PRECISION, longitude DOUBLE PRECISION,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        _rename_legacy_columns(),
+        *[f"ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS {m} DOUBLE PRECISION;" for m in OTOLITH_METRICS],
+        *[f"ALTER TABLE otolith_morphometrics ALTER COLUMN {m} TYPE DOUBLE PRECISION;" for m in OTOLITH_METRICS],
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS predicted_species VARCHAR(255);",
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION;",
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION;",
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;",
+        # Content hash of the uploaded image, used by the workers' dedup cache
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);",
+        "CREATE INDEX IF NOT EXISTS idx_otolith_content_hash ON otolith_morphometrics (content_hash);",
+        # Registry version of the model that produced predicted_species
+        "ALTER TABLE otolith_morphometrics ADD COLUMN IF NOT EXISTS model_version VARCHAR(64);",
+        # Keyset pagination of the dashboard walks this index newest-first
+        "CREATE INDEX IF NOT EXISTS idx_otolith_created_at_id ON otolith_morphometrics (created_at DESC, id DESC);",
+    ]),
+    (2, 'otolith_rollups', [
+        # Writers block until the backfill commits, so none is counted twice or missed.
+        "LOCK TABLE otolith_morphometrics IN SHARE ROW EXCLUSIVE MODE;",
+        f"""
+        CREATE TABLE IF NOT EXISTS otolith_rollups (
+            bucket_size VARCHAR(8) NOT NULL,
+            bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+            species VARCHAR(255) NOT NULL,
+            sample_count BIGINT NOT NULL DEFAULT 0,
+            {", ".join(f"{m}_sum DOUBLE PRECISION NOT NULL DEFAULT 0" for m in ROLLUP_METRICS)},
+            PRIMARY KEY (bucket_size, bucket_start, species)
+        );
+        """,
+        # Tables created by earlier API versions are already maintained.
+        f"""
+        INSERT INTO otolith_rollups (bucket_size, bucket_start, species, sample_count, {_ROLLUP_SUMS})
+        SELECT b.size, date_trunc(b.size, created_at, 'UTC'), COALESCE(predicted_species, ''), COUNT(*),
+               {", ".join(f"COALESCE(SUM({m}), 0)" for m in ROLLUP_METRICS)}
+        FROM otolith_morphometrics
+        CROSS JOIN (VALUES {", ".join(f"('{size}')" for size in ROLLUP_BUCKET_SIZES)}) AS b(size)
+        WHERE created_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM otolith_rollups)
+        GROUP BY 1, 2, 3;
+        """,
+    ]),
+    (3, 'otolith_geo_bins', [
+        "LOCK TABLE otolith_morphometrics IN SHARE ROW EXCLUSIVE MODE;",
+        """
+        CREATE TABLE IF NOT EXISTS otolith_geo_bins (
+            zoom SMALLINT NOT NULL,
+            tile_x INTEGER NOT NULL,
+            tile_y INTEGER NOT NULL,
+            species VARCHAR(255) NOT NULL,
+            sample_count BIGINT NOT NULL DEFAULT 0,
+            latitude_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            longitude_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (zoom, tile_x, tile_y, species)
+        );
+        """,
+        f"""
+        INSERT INTO otolith_geo_bins (zoom, tile_x, tile_y, species, sample_count, latitude_sum, longitude_sum)
+        SELECT z.zoom, {TILE_X}, {TILE_Y}, COALESCE(predicted_species, ''), COUNT(*), SUM(latitude), SUM(longitude)
+        FROM otolith_morphometrics
+        CROSS JOIN LATERAL (SELECT {CLAMPED_LATITUDE} AS lat) AS c
+        CROSS JOIN generate_series(0, {GEO_MAX_ZOOM}) AS z(zoom)
+        WHERE created_at IS NOT NULL AND latitude IS NOT NULL AND longitude IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM otolith_geo_bins)
+        GROUP BY 1, 2, 3, 4;
+        """,
+    ]),
+    (4, 'taxonomies', [
+        """
+        CREATE TABLE IF NOT EXISTS taxonomies (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR UNIQUE,
+            classification VARCHAR
+        );
+        """,
+    ]),
+    (5, 'edna_taxon_counts', [
+        # Per sample and taxon ('' for unassigned reads), accumulated by edna_worker.
+        """
+        CREATE TABLE IF NOT EXISTS edna_taxon_counts (
+            sample_id VARCHAR(255) NOT NULL,
+            taxon VARCHAR(255) NOT NULL,
+            read_count BIGINT NOT NULL DEFAULT 0,
+            sequence_count BIGINT NOT NULL DEFAULT 0,
+            confidence_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (sample_id, taxon)
+        );
+        """,
+        # Batches already counted, so a redelivered message is not counted twice.
+        """
+        CREATE TABLE IF NOT EXISTS edna_batches (
+            batch_id VARCHAR(255) PRIMARY KEY,
+            sample_id VARCHAR(255) NOT NULL,
+            processed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (6, 'sample_taxon_abundance', [
+        # Long-format sample x taxon abundances read by the diversity endpoints.
+        # Both sources are tables the workers already maintain incrementally.
+        f"""
+        CREATE OR REPLACE VIEW sample_taxon_abundance AS
+        SELECT sample_id, '{ABUNDANCE_SOURCES[0]}'::text AS source, taxon, read_count::double precision AS abundance
+        FROM edna_taxon_counts
+        WHERE taxon <> '' AND read_count > 0
+        UNION ALL
+        SELECT {OTOLITH_SAMPLE_ID} AS sample_id, '{ABUNDANCE_SOURCES[1]}'::text AS source,
+               species AS taxon, sample_count::double precision AS abundance
+        FROM otolith_rollups
+        WHERE bucket_size = 'day' AND species <> '' AND sample_count > 0;
+        """,
+    ]),
+    (7, 'taxon hierarchy', [
+        # One node per distinct lineage prefix, e.g. ['Animalia', 'Chordata'].
+        """
+        CREATE TABLE IF NOT EXISTS taxon_nodes (
+            id SERIAL PRIMARY KEY,
+            parent_id INTEGER REFERENCES taxon_nodes (id),
+            rank VARCHAR(32) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            path TEXT[] NOT NULL UNIQUE
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_taxon_nodes_parent ON taxon_nodes (parent_id);",
+        # Every (ancestor, descendant) pair, including each node with itself.
+        """
+        CREATE TABLE IF NOT EXISTS taxon_closure (
+            ancestor_id INTEGER NOT NULL REFERENCES taxon_nodes (id),
+            descendant_id INTEGER NOT NULL REFERENCES taxon_nodes (id),
+            distance SMALLINT NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_taxon_closure_descendant ON taxon_closure (descendant_id);",
+        "ALTER TABLE taxonomies ADD COLUMN IF NOT EXISTS node_id INTEGER REFERENCES taxon_nodes (id);",
+        f"""
+        CREATE OR REPLACE FUNCTION taxon_lineage(taxonomy_ids INTEGER[])
+        RETURNS TABLE (taxonomy_id INTEGER, level INTEGER, rank TEXT, name TEXT, path TEXT[])
+        LANGUAGE sql STABLE AS $$
+            WITH parts AS (
+                SELECT t.id, p.ord, btrim(p.part) AS part
+                FROM taxonomies AS t
+                CROSS JOIN LATERAL unnest(
+                    regexp_split_to_array(COALESCE(t.classification, ''), '{LINEAGE_SEPARATORS}') || ARRAY[t.name::text]
+                ) WITH ORDINALITY AS p(part, ord)
+                WHERE taxonomy_ids IS NULL OR t.id = ANY(taxonomy_ids)
+            ),
+            named AS (
+                SELECT id, ord,
+                       NULLIF(btrim(regexp_replace(part, '^[a-z]__', '')), '') AS name,
+                       substring(part FROM '^([a-z])__') AS prefix
+                FROM parts
+            ),
+            -- The taxon's own name is appended unless the classification already ends with it.
+            deduplicated AS (
+                SELECT id, ord, name, prefix, lag(name) OVER (PARTITION BY id ORDER BY ord) AS previous
+                FROM named
+                WHERE name IS NOT NULL
+            ),
+            levels AS (
+                SELECT id, name, prefix,
+                       row_number() OVER (PARTITION BY id ORDER BY ord) AS level,
+                       count(*) OVER (PARTITION BY id) AS levels
+                FROM deduplicated
+                WHERE previous IS DISTINCT FROM name
+            )
+            SELECT id, level::integer,
+                   COALESCE(
+                       (ARRAY{list(TAXON_RANKS)})[NULLIF(position(prefix IN '{TAXON_RANK_PREFIXES}'), 0)],
+                       (ARRAY{list(TAXON_RANKS)})[{len(TAXON_RANKS)} - (levels - level)],
+                       'no rank'
+                   ),
+                   name,
+                   array_agg(name) OVER (PARTITION BY id ORDER BY level)
+            FROM levels;
+        $$;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION index_taxa(taxonomy_ids INTEGER[] DEFAULT NULL)
+        RETURNS INTEGER
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            indexed INTEGER;
+        BEGIN
+            INSERT INTO taxon_nodes (rank, name, path)
+            SELECT DISTINCT ON (l.path) l.rank, l.name, l.path
+            FROM taxon_lineage(taxonomy_ids) AS l
+            ORDER BY l.path
+            ON CONFLICT (path) DO NOTHING;
+
+            UPDATE taxon_nodes AS child SET parent_id = parent.id
+            FROM (SELECT DISTINCT l.path FROM taxon_lineage(taxonomy_ids) AS l WHERE l.level > 1) AS lineage
+            JOIN taxon_nodes AS parent ON parent.path = lineage.path[1:cardinality(lineage.path) - 1]
+            WHERE child.path = lineage.path AND child.parent_id IS NULL;
+
+            INSERT INTO taxon_closure (ancestor_id, descendant_id, distance)
+            SELECT ancestor.id, node.id, cardinality(node.path) - cardinality(ancestor.path)
+            FROM (SELECT DISTINCT l.path FROM taxon_lineage(taxonomy_ids) AS l) AS lineage
+            JOIN taxon_nodes AS node ON node.path = lineage.path
+            CROSS JOIN LATERAL generate_series(1, cardinality(lineage.path)) AS prefix(length)
+            JOIN taxon_nodes AS ancestor ON ancestor.path = lineage.path[1:prefix.length]
+            ON CONFLICT DO NOTHING;
+
+            UPDATE taxonomies AS t SET node_id = node.id
+            FROM (
+                SELECT DISTINCT ON (l.taxonomy_id) l.taxonomy_id, l.path
+                FROM taxon_lineage(taxonomy_ids) AS l
+                ORDER BY l.taxonomy_id, l.level DESC
+            ) AS leaf
+            JOIN taxon_nodes AS node ON node.path = leaf.path
+            WHERE t.id = leaf.taxonomy_id AND t.node_id IS DISTINCT FROM node.id;
+            GET DIAGNOSTICS indexed = ROW_COUNT;
+            RETURN indexed;
+        END
+        $$;
+        """,
+        "SELECT index_taxa(NULL);",
+    ]),
+    (8, 'index_taxa from one lineage pass', [
+        """
+        CREATE OR REPLACE FUNCTION index_taxa(taxonomy_ids INTEGER[] DEFAULT NULL)
+        RETURNS INTEGER
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            indexed INTEGER;
+        BEGIN
+            -- Parse once; the planner gets real row counts instead of a function estimate.
+            DROP TABLE IF EXISTS pg_temp.indexed_lineage;
+            CREATE TEMPORARY TABLE indexed_lineage ON COMMIT DROP AS
+                SELECT * FROM taxon_lineage(taxonomy_ids);
+            ANALYZE indexed_lineage;
+
+            INSERT INTO taxon_nodes (rank, name, path)
+            SELECT DISTINCT ON (l.path) l.rank, l.name, l.path
+            FROM indexed_lineage AS l
+            ORDER BY l.path
+            ON CONFLICT (path) DO NOTHING;
+
+            UPDATE taxon_nodes AS child SET parent_id = parent.id
+            FROM (SELECT DISTINCT l.path FROM indexed_lineage AS l WHERE l.level > 1) AS lineage
+            JOIN taxon_nodes AS parent ON parent.path = lineage.path[1:cardinality(lineage.path) - 1]
+            WHERE child.path = lineage.path AND child.parent_id IS NULL;
+
+            INSERT INTO taxon_closure (ancestor_id, descendant_id, distance)
+            SELECT ancestor.id, node.id, cardinality(node.path) - cardinality(ancestor.path)
+            FROM (SELECT DISTINCT l.path FROM indexed_lineage AS l) AS lineage
+            JOIN taxon_nodes AS node ON node.path = lineage.path
+            CROSS JOIN LATERAL generate_series(1, cardinality(lineage.path)) AS prefix(length)
+            JOIN taxon_nodes AS ancestor ON ancestor.path = lineage.path[1:prefix.length]
+            -- Nodes indexed earlier already have all their rows, starting with their own.
+            WHERE NOT EXISTS (
+                SELECT 1 FROM taxon_closure AS c WHERE c.ancestor_id = node.id AND c.descendant_id = node.id
+            )
+            ON CONFLICT DO NOTHING;
+
+            UPDATE taxonomies AS t SET node_id = node.id
+            FROM (
+                SELECT DISTINCT ON (l.taxonomy_id) l.taxonomy_id, l.path
+                FROM indexed_lineage AS l
+                ORDER BY l.taxonomy_id, l.level DESC
+            ) AS leaf
+            JOIN taxon_nodes AS node ON node.path = leaf.path
+            WHERE t.id = leaf.taxonomy_id AND t.node_id IS DISTINCT FROM node.id;
+            GET DIAGNOSTICS indexed = ROW_COUNT;
+            RETURN indexed;
+        END
+        $$;
+        """,
+    ]),
+    # Images whose message was dead-lettered (shared/work_queues.py), so
+    # clients waiting on them get a final answer instead of waiting forever.
+    (9, 'otolith failures', [
+        """
+        CREATE TABLE IF NOT EXISTS otolith_failures (
+            image_id VARCHAR(255) PRIMARY KEY,
+            stage VARCHAR(64) NOT NULL,
+            reason TEXT,
+            failed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    # Batch IDs derive from a client-chosen upload_id, so they are only
+    # unique within a sample.
+    (10, 'edna_batches per sample', [
+        "ALTER TABLE edna_batches DROP CONSTRAINT IF EXISTS edna_batches_pkey;",
+        "ALTER TABLE edna_batches ADD PRIMARY KEY (sample_id, batch_id);",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Fails (rather than returning 0) when no migration has ever run.
+SCHEMA_VERSION_QUERY = "SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations"
+
+
+def schema_version(connection):
+    """Applied schema version on a sync SQLAlchemy connection, or 0 if none."""
+    try:
+        return connection.exec_driver_sql(SCHEMA_VERSION_QUERY).scalar()
+    except Exception:
+        connection.rollback()
+        return 0
+
+
+def wait_for_schema(engine, timeout=SCHEMA_WAIT_SECONDS, interval=2):
+    """Block until the database is reachable and migrated to ``SCHEMA_VERSION``.
+
+    Returns the version; raises RuntimeError after ``timeout`` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        version, error = 0, None
+        try:
+            with engine.connect() as connection:
+                version = schema_version(connection)
+        except Exception as e:
+            error = e
+        if version >= SCHEMA_VERSION:
+            if version > SCHEMA_VERSION:
+                logger.warning(f"Database schema is at version {version}, newer than this code's {SCHEMA_VERSION}.")
+            return version
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"Database schema not at version {SCHEMA_VERSION} (found {version}): {error or 'run migrate.py'}")
+        logger.info(f"Waiting for schema version {SCHEMA_VERSION} (found {version})...")
+        time.sleep(interval)
@@ -0,0 +1,107 @@
+"""Work queue topology shared by the API publisher and the workers.
+
+Every work queue ``<queue>`` is declared together with:
+
+- ``<queue>.retry.<n>`` for attempts 1..``AMQP_MAX_RETRIES``: holding queues
+  with a TTL of ``AMQP_RETRY_DELAY_MS * AMQP_RETRY_BACKOFF ** (n - 1)`` whose
+  expired messages are dead-lettered back to ``<queue>``;
+- ``<queue>.dead``: the dead-letter queue. ``<queue>`` dead-letters rejected
+  messages to it, so ``basic_reject(requeue=False)`` parks a message there
+  with the broker's ``x-death`` record instead of dropping it.
+
+A worker that fails on a message for a reason that may pass (database down,
+analysis pool crashed) calls ``schedule_retry``, which republishes it to the
+next retry queue with ``x-retry-count`` incremented, and then acks the
+delivery. The message waits out its delay off the work queue, so it neither
+hot-loops nor holds up the messages behind it. Messages that can never succeed
+(undecodable, invalid), and those out of retries, go to ``<queue>.dead``
+through ``dead_letter``.
+
+Queue arguments are fixed when a queue is created, and RabbitMQ refuses to
+redeclare one with different arguments (``PRECONDITION_FAILED``). Queues
+created before dead-lettering was added must therefore be drained and deleted
+once, e.g. ``rabbitmqctl delete_queue otolith_queue``. For the same reason
+the ``AMQP_RETRY_*`` settings must be the same for the API and the workers.
+"""
+import copy
+import logging
+import os
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+AMQP_MAX_RETRIES = int(os.getenv('AMQP_MAX_RETRIES', '5'))
+AMQP_RETRY_DELAY_MS = int(os.getenv('AMQP_RETRY_DELAY_MS', '1000'))
+AMQP_RETRY_BACKOFF = int(os.getenv('AMQP_RETRY_BACKOFF', '4'))
+
+RETRY_COUNT_HEADER = 'x-retry-count'
+LAST_ERROR_HEADER = 'x-last-error'
+
+
+def retry_queue(queue, attempt):
+    return f"{queue}.retry.{attempt}"
+
+
+def dead_letter_queue(queue):
+    return f"{queue}.dead"
+
+
+def retry_delay_ms(attempt):
+    return AMQP_RETRY_DELAY_MS * AMQP_RETRY_BACKOFF ** (attempt - 1)
+
+
+def declare_work_queue(channel, queue):
+    """Declare ``queue`` with its retry queues and dead-letter queue."""
+    channel.queue_declare(queue=dead_letter_queue(queue), durable=True)
+    for attempt in range(1, AMQP_MAX_RETRIES + 1):
+        channel.queue_declare(queue=retry_queue(queue, attempt), durable=True, arguments={
+            'x-message-ttl': retry_delay_ms(attempt),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue,
+        })
+    channel.queue_declare(queue=queue, durable=True, arguments={
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': dead_letter_queue(queue),
+    })
+
+
+def retry_count(properties):
+    """How many times the message has already been retried."""
+    headers = getattr(properties, 'headers', None) or {}
+    return int(headers.get(RETRY_COUNT_HEADER, 0))
+
+
+def schedule_retry(channel, queue, properties, body, reason):
+    """Republish a failed message to its next retry queue.
+
+    Returns False, without publishing, once the message is out of retries.
+    The caller settles the original delivery either way: ack it after a
+    retry was scheduled, ``dead_letter`` it otherwise.
+    """
+    attempt = retry_count(properties) + 1
+    if attempt > AMQP_MAX_RETRIES:
+        return False
+    retried = copy.copy(properties) if properties is not None else pika.BasicProperties()
+    retried.headers = {**(retried.headers or {}), RETRY_COUNT_HEADER: attempt, LAST_ERROR_HEADER: str(reason)[:200]}
+    retried.delivery_mode = pika.spec.PERSISTENT_DELIVERY_MODE
+    # A per-message TTL would override the retry queue's.
+    retried.expiration = None
+    channel.basic_publish(exchange='', routing_key=retry_queue(queue, attempt), body=body, properties=retried)
+    logger.warning(f"Retrying message from {queue} in {retry_delay_ms(attempt) / 1000:g}s (attempt {attempt}/{AMQP_MAX_RETRIES}): {reason}")
+    return True
+
+
+def dead_letter(channel, queue, delivery_tag, reason):
+    """Reject a delivery so ``queue`` dead-letters it to ``<queue>.dead``."""
+    logger.error(f"Dead-lettering message from {queue} to {dead_letter_queue(queue)}: {reason}")
+    channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+
+
+def retry_or_dead_letter(channel, queue, delivery_tag, properties, body, reason):
+    """Settle one failed delivery on its own: retry it later (True), or dead-letter it (False)."""
+    if schedule_retry(channel, queue, properties, body, reason):
+        channel.basic_ack(delivery_tag=delivery_tag)
+        return True
+    dead_letter(channel, queue, delivery_tag, f"out of retries; {reason}")
+    return False
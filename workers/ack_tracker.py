@@ -0,0 +1,39 @@
+"""Delivery-tag bookkeeping for consumers that complete messages out of order.
+
+With a pool, or a write-behind buffer, messages finish in a different order
+than they were delivered. ``basic_ack(multiple=True)`` acks *every* outstanding
+tag up to the one given, so it is only safe up to the oldest delivery that is
+still in flight. ``AckTracker`` tracks that watermark.
+"""
+
+
+class AckTracker:
+    """Track in-flight delivery tags for one channel."""
+
+    def __init__(self):
+        self._in_flight = set()
+        self._completed = set()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def delivered(self, tag):
+        self._in_flight.add(tag)
+
+    def complete(self, tags):
+        """Mark ``tags`` done; return the tag to ack with ``multiple=True`` or None."""
+        for tag in tags:
+            self._in_flight.discard(tag)
+            self._completed.add(tag)
+        oldest = min(self._in_flight) if self._in_flight else None
+        ready = [tag for tag in self._completed if oldest is None or tag < oldest]
+        if not ready:
+            return None
+        self._completed.difference_update(ready)
+        return max(ready)
+
+    def forget(self, tags):
+        """Drop tags that were settled another way (nack/reject)."""
+        for tag in tags:
+            self._in_flight.discard(tag)
+            self._completed.discard(tag)
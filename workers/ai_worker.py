@@ -2,11 +2,13 @@ import pika
 import json
 import time
 import os
-import joblib
-import pandas as pd
-from sqlalchemy import create_engine, text
 import sys
 import logging
+from db_writer import BulkWriter, get_engine, notify_changes, record_failure, update_from_values_statement
+from schema import wait_for_schema
+from work_queues import declare_work_queue, dead_letter, retry_or_dead_letter
+import rollups
+import species_model
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,30 +16,14 @@ logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 RABBITMQ_HOST = 'rabbitmq'
-DATABASE_URL = "postgresql://postgres:postgres@db:5432/cmlre_data"
-MODEL_PATH = "/app/ai_model/species_classifier.pkl"
 AI_QUEUE = 'ai_queue'
 
-# Global variable to hold the model
-model = None
-
-def load_model():
-    """Load the trained model from disk with a retry mechanism."""
-    global model
-    max_retries = 12
-    retry_delay = 5  # seconds
-
-    for attempt in range(max_retries):
-        if os.path.exists(MODEL_PATH):
-            logger.info(f"Loading model from {MODEL_PATH}")
-            model = joblib.load(MODEL_PATH)
-            logger.info("Model loaded successfully.")
-            return
-        else:
-            logger.warning(f"Model file not found at {MODEL_PATH}. Retrying in {retry_delay} seconds... ({attempt + 1}/{max_retries})")
-            time.sleep(retry_delay)
-
-    raise Exception("Could not load AI model after multiple retries. Shutting down.")
+# --- Batching ---
+# Up to AI_BATCH_SIZE messages are collected, waiting at most AI_BATCH_LINGER_MS
+# after the first one, and classified with a single model.predict call.
+AI_BATCH_SIZE = int(os.getenv('AI_BATCH_SIZE', '32'))
+AI_BATCH_LINGER_MS = int(os.getenv('AI_BATCH_LINGER_MS', '50'))
+AI_PREFETCH = int(os.getenv('AI_PREFETCH', str(AI_BATCH_SIZE * 2)))
 
 def connect_to_rabbitmq():
     """Connect to RabbitMQ with a retry mechanism."""
@@ -50,69 +36,131 @@ def connect_to_rabbitmq():
             logger.error(f"RabbitMQ not ready: {e}. Retrying in 5 seconds...")
             time.sleep(5)
 
-def predict_species(data):
-    """Predicts species based on morphometric data."""
-    if model is None:
-        logger.error("Model is not loaded. Cannot predict.")
-        return "Error: Model not loaded"
+def parse_message(body):
+    """Return ``(record, None)`` for a usable message, ``(None, reason)`` otherwise."""
     try:
-        df = pd.DataFrame([data])
-        df = df[['area', 'perimeter', 'width', 'height', 'aspect_ratio']]
-        prediction = model.predict(df)
-        logger.info(f"Prediction made: {prediction[0]}")
-        return prediction[0]
-    except Exception as e:
-        logger.error(f"Error during prediction: {e}")
-        return "Error: Prediction failed"
-
-def update_prediction_in_db(image_id, species):
-    """Updates the database record with the predicted species."""
+        data = json.loads(body)
+    except ValueError as e:
+        return None, f"non-JSON message: {e}"
+    if not isinstance(data, dict) or not data.get('image_id'):
+        return None, "message without image_id"
     try:
-        engine = create_engine(DATABASE_URL)
-        with engine.connect() as conn:
-            stmt = text("UPDATE otolith_morphometrics SET predicted_species = :species WHERE image_id = :image_id;")
-            conn.execute(stmt, {'species': species, 'image_id': image_id})
-            conn.commit()
-            logger.info(f"Updated DB for {image_id} with prediction: {species}")
-    except Exception as e:
-        logger.error(f"Database update failed for {image_id}: {e}")
-
-def callback(ch, method, properties, body):
-    """Callback function to process messages from the queue."""
-    logger.info(f"Received message: {body}")
+        species_model.feature_vector(data)
+    except (KeyError, TypeError, ValueError) as e:
+        return None, f"{data['image_id']}: missing or invalid feature {e}"
+    return data, None
+
+def message_image_id(body):
     try:
-        data = json.loads(body)
-        image_id = data.get('image_id')
-        if not image_id:
-            logger.warning("Received message without image_id.")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
-            
-        logger.info(f"Processing data for {image_id}")
-        predicted_species = predict_species(data)
-        if "Error" not in predicted_species:
-            update_prediction_in_db(image_id, predicted_species)
-    except Exception as e:
-        logger.error(f"Exception in callback: {e}")
-    finally:
+        return json.loads(body).get('image_id')
+    except (ValueError, AttributeError):
+        return None
+
+def fail(channel, tag, properties, body, reason):
+    """Retry a failed delivery later; once out of retries, record its image as failed."""
+    if not retry_or_dead_letter(channel, AI_QUEUE, tag, properties, body, reason):
+        record_failure(message_image_id(body), AI_QUEUE, reason)
+
+def write_predictions(conn, rows):
+    """Writes predicted species back with a single UPDATE ... FROM (VALUES ...)."""
+    stmt, params = update_from_values_statement(
+        'otolith_morphometrics', 'image_id', ['predicted_species', 'model_version'], rows
+    )
+    image_ids = [row['image_id'] for row in rows]
+    with rollups.track_changes(conn, image_ids):
+        conn.execute(stmt, params)
+    notify_changes(conn, image_ids)
+
+def make_writer(channel, deliveries):
+    """Prediction writer for one channel; messages are acked only after commit.
+
+    ``deliveries`` maps the delivery tags of the current batch to their
+    ``(properties, body)``, to retry the messages whose rows failed to write.
+    Acks are per delivery: when a batch is bisected, the failed deliveries
+    are settled by ``fail`` instead.
+    """
+    def on_flushed(rows, tags):
+        for tag in tags:
+            channel.basic_ack(delivery_tag=tag)
+
+    def on_failed(rows, tags, error):
+        for tag in tags:
+            fail(channel, tag, *deliveries[tag], error)
+
+    return BulkWriter(
+        'predictions', write_predictions, max_rows=AI_BATCH_SIZE, key='image_id',
+        on_flushed=on_flushed, on_failed=on_failed,
+    )
+
+def process_batch(channel, writer, batch):
+    """Classify a batch of deliveries (tag -> (properties, body)) and write them back together."""
+    started = time.monotonic()
+    records, tags = [], []
+    for tag, (properties, body) in batch.items():
+        record, reason = parse_message(body)
+        if record:
+            records.append(record)
+            tags.append(tag)
+        else:
+            dead_letter(channel, AI_QUEUE, tag, reason)
+            record_failure(message_image_id(body), AI_QUEUE, reason)
+
+    predict_ms = 0.0
+    if records:
         try:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except Exception as ack_err:
-            logger.error(f"Failed to ack message: {ack_err}")
+            species_model.maybe_reload()
+            predict_start = time.monotonic()
+            species = species_model.predict_species_batch(records)
+            predict_ms = (time.monotonic() - predict_start) * 1000
+        except Exception as e:
+            logger.error(f"Failed to predict batch of {len(records)} records: {e}")
+            for tag in tags:
+                fail(channel, tag, *batch[tag], e)
+        else:
+            version = species_model.model_version
+            for record, tag, sp in zip(records, tags, species):
+                writer.add({'image_id': record['image_id'], 'predicted_species': sp, 'model_version': version}, tag)
+    db_start = time.monotonic()
+    writer.flush()
+    db_ms = (time.monotonic() - db_start) * 1000
+    total_ms = (time.monotonic() - started) * 1000
+    logger.info(
+        f"Batch size={len(batch)} predicted={len(records)} "
+        f"predict={predict_ms:.1f}ms db={db_ms:.1f}ms total={total_ms:.1f}ms"
+    )
+
+def consume_batches(channel):
+    """Collect messages into batches by size or linger time and process them."""
+    linger = AI_BATCH_LINGER_MS / 1000
+    batch = {}
+    writer = make_writer(channel, batch)
+    deadline = 0.0
+    for method, properties, body in channel.consume(AI_QUEUE, inactivity_timeout=linger):
+        if method is None and not batch:
+            # Idle: pick up a newly published model before the next batch arrives.
+            species_model.maybe_reload()
+            continue
+        if method is not None:
+            if not batch:
+                deadline = time.monotonic() + linger
+            batch[method.delivery_tag] = (properties, body)
+        if batch and (len(batch) >= AI_BATCH_SIZE or time.monotonic() >= deadline):
+            process_batch(channel, writer, batch)
+            batch.clear()
 
 def main():
     """Main function to start the AI worker."""
     logger.info("Starting AI worker...")
-    load_model()
+    wait_for_schema(get_engine())
+    species_model.load_model()
     while True:
         try:
             connection = connect_to_rabbitmq()
             channel = connection.channel()
-            channel.queue_declare(queue=AI_QUEUE, durable=True)
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=AI_QUEUE, on_message_callback=callback)
-            logger.info('Waiting for messages. To exit press CTRL+C')
-            channel.start_consuming()
+            declare_work_queue(channel, AI_QUEUE)
+            channel.basic_qos(prefetch_count=max(AI_PREFETCH, AI_BATCH_SIZE))
+            logger.info(f'Waiting for messages (batch size {AI_BATCH_SIZE}, linger {AI_BATCH_LINGER_MS} ms). To exit press CTRL+C')
+            consume_batches(channel)
         except pika.exceptions.StreamLostError as e:
             logger.error(f"Lost connection to RabbitMQ ({e}). Reconnecting in 5 seconds...")
             time.sleep(5)
@@ -0,0 +1,112 @@
+"""Array-backed evaluator for the species RandomForest.
+
+``export_forest`` flattens every tree of a fitted sklearn
+``RandomForestClassifier`` into shared, contiguous NumPy arrays:
+
+- ``feature``, ``threshold``, ``left`` and ``right`` per node;
+- ``value``, the normalised class distribution per node;
+- ``roots``, the first node of each tree.
+
+Leaves point to themselves, so every sample can walk every tree for
+``max_depth`` vectorised steps without branching.
+
+``CompiledForest`` memory-maps those ``.npy`` files. Replicas share the pages
+through the OS cache, cold start skips unpickling 100 estimator objects, and a
+prediction is a handful of array operations instead of sklearn's input
+validation plus per-tree dispatch. Comparisons happen in float32 and the
+per-tree probabilities are summed in tree order, as sklearn does, so
+predictions are identical. ``train_model.py`` checks that on every build.
+
+Only NumPy is needed at load time; ``export_forest`` reads sklearn's
+``tree_`` attributes but does not import sklearn.
+"""
+import json
+import os
+
+import numpy as np
+
+ARRAYS = ('feature', 'threshold', 'left', 'right', 'value', 'roots')
+META_FILE = 'forest.json'
+
+
+def export_forest(clf, out_dir):
+    """Write the flattened forest of ``clf`` to ``out_dir``."""
+    os.makedirs(out_dir, exist_ok=True)
+    trees = [estimator.tree_ for estimator in clf.estimators_]
+    sizes = [tree.node_count for tree in trees]
+    roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+
+    feature, threshold, left, right, value = [], [], [], [], []
+    for tree, offset in zip(trees, roots):
+        is_leaf = tree.children_left == -1
+        own_index = np.arange(tree.node_count, dtype=np.int64) + offset
+        feature.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+        threshold.append(tree.threshold.astype(np.float64))
+        left.append(np.where(is_leaf, own_index, tree.children_left + offset))
+        right.append(np.where(is_leaf, own_index, tree.children_right + offset))
+        # Same normalisation as DecisionTreeClassifier.predict_proba.
+        proba = tree.value[:, 0, :].astype(np.float64)
+        normalizer = proba.sum(axis=1)[:, None]
+        normalizer[normalizer == 0.0] = 1.0
+        value.append(proba / normalizer)
+
+    arrays = {
+        'feature': np.concatenate(feature),
+        'threshold': np.concatenate(threshold),
+        'left': np.concatenate(left).astype(np.int64),
+        'right': np.concatenate(right).astype(np.int64),
+        'value': np.ascontiguousarray(np.concatenate(value)),
+        'roots': roots,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, f'{name}.npy'), array)
+
+    meta = {
+        'classes': [str(c) for c in clf.classes_],
+        'n_features': int(clf.n_features_in_),
+        'feature_names': [str(f) for f in getattr(clf, 'feature_names_in_', [])],
+        'max_depth': int(max(tree.max_depth for tree in trees)),
+        'n_trees': len(trees),
+    }
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def is_compiled_forest(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class CompiledForest:
+    """Vectorised ``predict`` / ``predict_proba`` over an exported forest."""
+
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode))
+        self.classes_ = np.array(meta['classes'], dtype=object)
+        self.n_features_in_ = meta['n_features']
+        self.feature_names_in_ = meta['feature_names']
+        self.max_depth = meta['max_depth']
+        self.n_trees = meta['n_trees']
+
+    def _leaves(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected a (n_samples, {self.n_features_in_}) feature matrix, got {X.shape}")
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.repeat(np.asarray(self.roots)[None, :], X.shape[0], axis=0)
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+    def predict_proba(self, X):
+        leaf_values = self.value[self._leaves(X)]
+        # cumsum accumulates tree by tree, matching sklearn's summation order.
+        proba = np.cumsum(leaf_values, axis=1)[:, -1, :]
+        return proba / self.n_trees
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
@@ -0,0 +1,97 @@
+"""Content-hash deduplication for otolith images.
+
+Lab users re-upload the same scans under new ``image_id``s. The otolith worker
+hashes the raw image bytes and looks the digest up here before running OpenCV.
+On a hit it reuses the stored morphometrics, and the prediction when one is
+known and was made by the live model version, under the new ``image_id``.
+A prediction from an older version is left out, so the image is classified
+again by the current model.
+
+Two tiers:
+- an in-process LRU bounded by ``max_entries``;
+- optionally (``shared=True``), the indexed ``content_hash`` column of
+  ``otolith_morphometrics``. Every replica sees every analysed image there,
+  including predictions written later by ``ai_worker``.
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from db_writer import get_engine
+
+logger = logging.getLogger(__name__)
+
+CACHED_FIELDS = ('area', 'perimeter', 'width', 'height', 'aspect_ratio', 'predicted_species', 'model_version')
+
+SHARED_LOOKUP = text("""
+    SELECT area, perimeter, width, height, aspect_ratio, predicted_species, model_version
+    FROM otolith_morphometrics
+    WHERE content_hash = :content_hash AND area IS NOT NULL
+    ORDER BY predicted_species IS NULL, id DESC
+    LIMIT 1;
+""")
+
+
+def content_hash(image_data):
+    """Hex digest identifying the image bytes."""
+    return hashlib.blake2b(image_data, digest_size=20).hexdigest()
+
+
+class ContentCache:
+    """Bounded LRU of analysis results keyed by content hash."""
+
+    def __init__(self, max_entries=10000, shared=False):
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, digest, model_version=None):
+        """Return the cached analysis for ``digest`` or None.
+
+        With ``model_version``, a prediction made by another version is
+        dropped from the result; the morphometrics are still returned.
+        """
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+        elif self.shared:
+            entry = self._lookup_shared(digest)
+            if entry is not None:
+                self._put(digest, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if model_version is not None and entry.get('model_version') != model_version:
+            entry = {key: value for key, value in entry.items() if key not in ('predicted_species', 'model_version')}
+        return entry
+
+    def store(self, digest, record):
+        """Remember the analysis in ``record``; keeps a known prediction."""
+        entry = {key: record[key] for key in CACHED_FIELDS if record.get(key) is not None}
+        previous = self._entries.get(digest)
+        if previous and 'predicted_species' in previous and 'predicted_species' not in entry:
+            entry['predicted_species'] = previous['predicted_species']
+            entry['model_version'] = previous.get('model_version')
+        self._put(digest, entry)
+
+    def _put(self, digest, entry):
+        self._entries[digest] = entry
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup_shared(self, digest):
+        try:
+            with get_engine().connect() as conn:
+                row = conn.execute(SHARED_LOOKUP, {'content_hash': digest}).mappings().first()
+        except Exception as e:
+            logger.warning(f"Shared content cache lookup failed: {e}")
+            return None
+        if row is None:
+            return None
+        return {key: row[key] for key in CACHED_FIELDS if row[key] is not None}
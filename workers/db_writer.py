@@ -0,0 +1,261 @@
+"""Pooled, write-behind database writer shared by the workers.
+
+Each worker process keeps one SQLAlchemy engine (``get_engine``) instead of
+building a new engine and connection per message. ``BulkWriter`` buffers rows
+together with their AMQP delivery tags and writes them in a single transaction
+once ``max_rows`` rows are pending or ``max_delay`` seconds have passed since the
+first one. The ``on_flushed`` callback (normally the ack) only runs after the
+transaction has committed, so a message is never acked before its row is
+durable. A batch that fails on its data is split in halves, each written in
+a fresh transaction, until the failing rows are isolated: only their
+deliveries reach ``on_failed``, and the rest of the batch commits.
+
+The statement builders turn a list of row dicts into one multi-row
+``INSERT ... ON CONFLICT`` or ``UPDATE ... FROM (VALUES ...)``.
+
+``notify_changes`` queues a Postgres NOTIFY in the write transaction; it is
+delivered only on commit, which lets the API invalidate cached responses.
+"""
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import create_engine, exc, text
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/cmlre_data")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+
+# Failures that say nothing about the rows (database unreachable, connection
+# lost): the whole batch is failed rather than bisected.
+CONNECTION_ERRORS = (exc.OperationalError, exc.InterfaceError)
+
+_engine = None
+_engine_pid = None
+
+
+def get_engine():
+    """Return the process-wide pooled engine, creating it on first use.
+
+    The pid check keeps forked pool processes from sharing the parent's
+    sockets.
+    """
+    global _engine, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        _engine = create_engine(
+            DATABASE_URL, pool_pre_ping=True,
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+        )
+        _engine_pid = os.getpid()
+    return _engine
+
+
+# --- Statement builders ---
+def _placeholder(name, index, casts):
+    param = f":{name}_{index}"
+    return f"CAST({param} AS {casts[name]})" if name in casts else param
+
+
+def _values_clause(columns, rows, casts):
+    params = {}
+    tuples = []
+    for i, row in enumerate(rows):
+        tuples.append("(" + ", ".join(_placeholder(col, i, casts) for col in columns) + ")")
+        for col in columns:
+            params[f"{col}_{i}"] = row.get(col)
+    return ", ".join(tuples), params
+
+
+def upsert_statement(table, columns, key, rows, update_columns=None, casts=None, accumulate=False, returning=None):
+    """Multi-row ``INSERT ... ON CONFLICT (key) DO UPDATE`` for ``rows``.
+
+    ``key`` may list several comma-separated columns. With ``accumulate`` the
+    update adds the new values to the stored ones instead of replacing them.
+    ``update_columns=[]`` keeps existing rows (``DO NOTHING``); ``returning``
+    is an optional ``RETURNING`` column list.
+    """
+    key_columns = [k.strip() for k in key.split(",")]
+    update_columns = [c for c in (columns if update_columns is None else update_columns) if c not in key_columns]
+    values, params = _values_clause(columns, rows, casts or {})
+    if accumulate:
+        assignments = ", ".join(f"{col} = {table}.{col} + EXCLUDED.{col}" for col in update_columns)
+    else:
+        assignments = ", ".join(f"{col} = EXCLUDED.{col}" for col in update_columns)
+    conflict = f"DO UPDATE SET {assignments}" if assignments else "DO NOTHING"
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+        f"ON CONFLICT ({key}) {conflict}"
+    )
+    if returning:
+        sql += f" RETURNING {returning}"
+    return text(sql), params
+
+
+def update_from_values_statement(table, key, columns, rows, casts=None):
+    """Single ``UPDATE ... FROM (VALUES ...)`` setting ``columns`` by ``key``."""
+    all_columns = [key] + [c for c in columns if c != key]
+    values, params = _values_clause(all_columns, rows, casts or {})
+    assignments = ", ".join(f"{col} = v.{col}" for col in all_columns[1:])
+    sql = (
+        f"UPDATE {table} AS t SET {assignments} "
+        f"FROM (VALUES {values}) AS v({', '.join(all_columns)}) "
+        f"WHERE t.{key} = v.{key}"
+    )
+    return text(sql), params
+
+
+# --- Change notifications ---
+OTOLITH_CHANGES_CHANNEL = "otolith_changes"
+# NOTIFY payloads are capped at 8000 bytes.
+NOTIFY_MAX_PAYLOAD = 7900
+
+
+def notify_changes(conn, image_ids, channel=OTOLITH_CHANGES_CHANNEL):
+    """NOTIFY listeners that ``image_ids`` changed, once the transaction commits."""
+    payload = json.dumps({"image_ids": list(image_ids)})
+    if len(payload) > NOTIFY_MAX_PAYLOAD:
+        # Too many ids for one message: listeners treat null as "everything".
+        payload = json.dumps({"image_ids": None})
+    conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+
+
+# --- Failed images ---
+RECORD_FAILURE = text("""
+    INSERT INTO otolith_failures (image_id, stage, reason) VALUES (:image_id, :stage, :reason)
+    ON CONFLICT (image_id) DO UPDATE SET
+        stage = EXCLUDED.stage, reason = EXCLUDED.reason, failed_at = CURRENT_TIMESTAMP
+""")
+CLEAR_FAILURES = text("DELETE FROM otolith_failures WHERE image_id = ANY(:image_ids)")
+
+
+def record_failure(image_id, stage, reason):
+    """Record that ``image_id`` was dead-lettered at ``stage`` and notify listeners.
+
+    Best effort: the database may well be why the message failed.
+    """
+    if not image_id:
+        return
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(RECORD_FAILURE, {"image_id": image_id, "stage": stage, "reason": str(reason)[:1000]})
+            notify_changes(conn, [image_id])
+    except Exception as e:
+        logger.error(f"Could not record the failure of {image_id}: {e}")
+
+
+def clear_failures(conn, image_ids):
+    """Forget earlier failures of images that are being written again (re-uploads)."""
+    conn.execute(CLEAR_FAILURES, {"image_ids": list(image_ids)})
+
+
+# --- Write-behind buffer ---
+class BulkWriter:
+    """Buffer rows and write them in one transaction on size or time thresholds.
+
+    ``write_rows(conn, rows)`` executes the statement(s) for a batch inside an
+    open transaction. ``prepare(rows)``, if given, runs just before the
+    transaction opens, for slow per-batch work (model inference) that should
+    not hold a database connection; an error there fails the batch like a
+    write error. ``on_flushed(rows, tags)`` runs after commit and
+    ``on_failed(rows, tags, error)`` after a rollback; both run on the thread
+    that called ``flush``, and each receives only the delivery tags of its own
+    rows. Rows sharing the same ``key`` value are collapsed to the last one,
+    since a multi-row upsert cannot touch a row twice, but every delivery tag
+    is kept.
+
+    A failed batch of several rows is retried in halves, each in its own
+    transaction, so one bad row (a value the column type rejects, say) fails
+    alone instead of taking its batch with it; ``on_flushed`` and
+    ``on_failed`` may then run several times per flush. Connection errors
+    (``CONNECTION_ERRORS``) fail the whole batch at once.
+
+    When ``connection`` (a pika BlockingConnection) is given, the time threshold
+    is enforced with ``connection.call_later`` so the flush, and therefore the
+    ack, happens on the connection's own thread.
+    """
+
+    def __init__(self, name, write_rows, max_rows=100, max_delay=0.5, key=None,
+                 on_flushed=None, on_failed=None, connection=None, prepare=None):
+        self.name = name
+        self.write_rows = write_rows
+        self.prepare = prepare
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.key = key
+        self.on_flushed = on_flushed
+        self.on_failed = on_failed
+        self.connection = connection
+        self._rows = {}
+        self._tags = {}
+        self._timer = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row, tag=None):
+        """Buffer ``row``; flushes immediately when the size threshold is hit."""
+        row_key = row[self.key] if self.key else len(self._rows)
+        self._rows.pop(row_key, None)
+        self._rows[row_key] = row
+        if tag is not None:
+            self._tags.setdefault(row_key, []).append(tag)
+        if len(self._rows) >= self.max_rows:
+            self.flush()
+        elif self._timer is None and self.connection is not None:
+            self._timer = self.connection.call_later(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Write all buffered rows, in one transaction unless some fail. Returns the rows written."""
+        if self._timer is not None:
+            self.connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._rows:
+            return 0
+        batch = [(row, self._tags.get(row_key, [])) for row_key, row in self._rows.items()]
+        self._rows, self._tags = {}, {}
+        return self._write(batch)
+
+    def _write(self, batch):
+        """Write ``(row, tags)`` pairs in one transaction, bisecting on a data error."""
+        rows = [row for row, _ in batch]
+        tags = [tag for _, row_tags in batch for tag in row_tags]
+        started = time.monotonic()
+        try:
+            if self.prepare:
+                self.prepare(rows)
+            with get_engine().begin() as conn:
+                self.write_rows(conn, rows)
+        except Exception as e:
+            # The driver's error, without the (long) multi-row statement.
+            reason = getattr(e, 'orig', None) or e
+            if len(batch) > 1 and not isinstance(e, CONNECTION_ERRORS):
+                logger.warning(f"[{self.name}] Flush of {len(rows)} rows failed, retrying in halves: {reason}")
+                half = len(batch) // 2
+                return self._write(batch[:half]) + self._write(batch[half:])
+            logger.error(f"[{self.name}] Flush of {len(rows)} rows failed: {reason}")
+            if self.on_failed:
+                self.on_failed(rows, tags, e)
+            return 0
+        logger.info(f"[{self.name}] Flushed {len(rows)} rows in {(time.monotonic() - started) * 1000:.1f} ms")
+        if self.on_flushed:
+            self.on_flushed(rows, tags)
+        return len(rows)
+
+    def discard(self):
+        """Drop buffered rows without writing, e.g. after the channel is lost; returns them."""
+        if self._timer is not None and self.connection is not None:
+            try:
+                self.connection.remove_timeout(self._timer)
+            except Exception:
+                pass
+        self._timer = None
+        rows = list(self._rows.values())
+        self._rows, self._tags = {}, {}
+        return rows
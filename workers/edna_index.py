@@ -0,0 +1,373 @@
+"""Array-backed k-mer index for assigning eDNA reads to reference taxa.
+
+Built offline from a local reference barcode FASTA (COI, 12S, ...) whose
+headers carry the taxon after the accession, e.g. ``>MN123456 Gadus morhua``
+or ``>MN123456|Gadus morhua``. Every sequence is cut into canonical k-mers
+(the smaller of the k-mer and its reverse complement, 2 bits per base, so
+``k <= 31`` fits a uint64); k-mers with ambiguous bases are skipped.
+
+The index is a sorted CSR layout in ``.npy`` files, memory-mapped at load:
+
+- ``keys``: the distinct k-mers, sorted (uint64);
+- ``offsets``: ``postings[offsets[i]:offsets[i + 1]]`` belong to ``keys[i]``;
+- ``postings``: ids of the taxa whose references contain the k-mer (uint32);
+
+plus ``index.json`` with ``k`` and the taxon names. Lookups are one
+``searchsorted`` per batch; nothing is unpickled and replicas share the pages
+through the OS cache.
+
+A read votes once for every taxon sharing each of its distinct k-mers. It is
+assigned to the taxon with the most votes, and its confidence is the lead over
+the runner-up as a fraction of the read's k-mers: 1.0 when every k-mer is
+unique to the winner, 0 for a tie. Reads below ``min_confidence`` stay
+unassigned (taxon id -1).
+
+    python edna_index.py build reference.fasta /app/edna_index -k 21
+    python edna_index.py bench /app/edna_index reads.fastq --processes 4
+"""
+import argparse
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+ARRAYS = ('keys', 'offsets', 'postings')
+META_FILE = 'index.json'
+DEFAULT_K = 21
+MAX_K = 31
+UNASSIGNED = -1
+
+# A/C/G/T (and U) to 0..3; anything else is ambiguous.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'TtUu')):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+_TWO = np.uint64(2)
+_THREE = np.uint64(3)
+
+
+# --- Sequence files ---
+def _open(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+
+
+def read_sequences(path):
+    """Yield ``(header, sequence)`` from a FASTA or FASTQ file (optionally gzipped)."""
+    with _open(path) as f:
+        first = f.readline()
+        if first.startswith('@'):
+            line = first
+            while line:
+                sequence = f.readline().strip()
+                f.readline()
+                f.readline()
+                yield line[1:].strip(), sequence
+                line = f.readline()
+            return
+        header, parts = None, []
+        for line in itertools.chain([first], f):
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(parts)
+                header, parts = line[1:].strip(), []
+            else:
+                parts.append(line.strip())
+        if header is not None:
+            yield header, ''.join(parts)
+
+
+def taxon_of(header):
+    """Taxon name of a reference header: what follows the accession."""
+    if '|' in header.split(None, 1)[0]:
+        fields = header.split('|')
+        return fields[1].strip()
+    parts = header.split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else parts[0]
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# --- k-mers ---
+def canonical_kmers(sequences, k):
+    """Canonical k-mers of ``sequences``, as ``(owner, kmers)`` arrays.
+
+    ``owner[i]`` is the index of the sequence that ``kmers[i]`` came from.
+    All sequences are encoded into one array (separated by an ambiguous base),
+    so the work is ``k`` vectorised passes regardless of the sequence count.
+    """
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    joined = 'N'.join(sequences) + 'N'
+    codes = BASE_CODES[np.frombuffer(joined.encode('ascii', 'replace'), dtype=np.uint8)]
+    windows = len(codes) - k + 1
+    if windows <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+
+    forward = codes.astype(np.uint64) & _THREE
+    complement = (_THREE - forward) & _THREE
+    fwd = np.zeros(windows, dtype=np.uint64)
+    rev = np.zeros(windows, dtype=np.uint64)
+    shifted = np.empty(windows, dtype=np.uint64)
+    for j in range(k):
+        fwd <<= _TWO
+        fwd |= forward[j:j + windows]
+        # The complement of base j is base k-1-j of the reverse complement.
+        np.left_shift(complement[j:j + windows], np.uint64(2 * j), out=shifted)
+        rev |= shifted
+
+    ambiguous = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = ambiguous[k:k + windows] == ambiguous[:windows]
+    owner = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths + 1)[:windows]
+    return owner[valid], np.minimum(fwd, rev)[valid]
+
+
+def _distinct_pairs(first, second):
+    """Sorted distinct ``(first, second)`` pairs."""
+    order = np.lexsort((second, first))
+    first, second = first[order], second[order]
+    keep = np.ones(len(first), dtype=bool)
+    keep[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+    return first[keep], second[keep]
+
+
+def _sorted_distinct(values):
+    """Sorted distinct ``values`` and how often each occurs."""
+    values = np.sort(values)
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+
+# --- Build ---
+def build_index(fasta_path, out_dir, k=DEFAULT_K, chunk_size=5000):
+    """Build the index for ``fasta_path`` into ``out_dir`` and return its metadata.
+
+    References are processed ``chunk_size`` at a time. The files are written
+    next to ``out_dir`` and swapped in at the end, so a worker reloading the
+    index never sees a partial one.
+    """
+    if not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be between 1 and {MAX_K}, got {k}")
+    taxa, n_references = {}, 0
+    kmer_chunks, taxon_chunks = [], []
+    for batch in _batches(read_sequences(fasta_path), chunk_size):
+        taxon_ids = np.array([taxa.setdefault(taxon_of(header), len(taxa)) for header, _ in batch], dtype=np.uint32)
+        owner, kmers = canonical_kmers([sequence for _, sequence in batch], k)
+        kmers, taxon = _distinct_pairs(kmers, taxon_ids[owner])
+        kmer_chunks.append(kmers)
+        taxon_chunks.append(taxon)
+        n_references += len(batch)
+
+    kmers, postings = _distinct_pairs(
+        np.concatenate(kmer_chunks or [np.empty(0, dtype=np.uint64)]),
+        np.concatenate(taxon_chunks or [np.empty(0, dtype=np.uint32)]),
+    )
+    keys, starts = np.unique(kmers, return_index=True)
+    arrays = {
+        'keys': keys.astype(np.uint64),
+        'offsets': np.append(starts, len(postings)).astype(np.int64),
+        'postings': postings.astype(np.uint32),
+    }
+    meta = {
+        'k': k,
+        'taxa': list(taxa),
+        'n_references': n_references,
+        'n_kmers': int(len(keys)),
+        'n_postings': int(len(postings)),
+        'source': os.path.basename(fasta_path),
+        'built_at': datetime.now(timezone.utc).isoformat(),
+    }
+
+    out_dir = os.path.abspath(out_dir)
+    staging, previous = out_dir + '.tmp', out_dir + '.old'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, f'{name}.npy'), array)
+    with open(os.path.join(staging, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, previous)
+    os.rename(staging, out_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    return meta
+
+
+# --- Lookup ---
+class KmerIndex:
+    """Read-only, memory-mapped index produced by ``build_index``."""
+
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode))
+        self.path = path
+        self.k = meta['k']
+        self.taxa = meta['taxa']
+        self.meta = meta
+
+    def classify(self, sequences, min_confidence=0.0):
+        """Assign each sequence to a taxon.
+
+        Returns ``(taxon_ids, confidence, kmers)`` arrays, one entry per
+        sequence; ``taxon_ids`` is ``UNASSIGNED`` where confidence is below
+        ``min_confidence`` or no k-mer matched.
+        """
+        n = len(sequences)
+        taxon_ids = np.full(n, UNASSIGNED, dtype=np.int64)
+        confidence = np.zeros(n, dtype=np.float64)
+        owner, kmers = canonical_kmers(sequences, self.k)
+        if not len(kmers) or not len(self.keys):
+            return taxon_ids, confidence, np.zeros(n, dtype=np.int64)
+
+        # Sorted queries keep searchsorted cache-friendly; each distinct k-mer
+        # of the batch is looked up once.
+        order = np.argsort(kmers)
+        kmers, owner = kmers[order], owner[order]
+        run_start = np.concatenate(([True], kmers[1:] != kmers[:-1]))
+        run = np.cumsum(run_start) - 1
+        distinct = kmers[run_start]
+        pos = np.minimum(np.searchsorted(self.keys, distinct), len(self.keys) - 1)
+        found = self.keys[pos] == distinct
+
+        # One vote per distinct k-mer of a read.
+        pairs, _ = _sorted_distinct(run * n + owner)
+        run, owner = pairs // n, pairs % n
+        read_kmers = np.bincount(owner, minlength=n)
+        hit = found[run]
+        owner, pos = owner[hit], pos[run[hit]]
+        starts = self.offsets[pos]
+        counts = self.offsets[pos + 1] - starts
+        # Expand each hit's postings range into (read, taxon) votes.
+        total = int(counts.sum())
+        if not total:
+            return taxon_ids, confidence, read_kmers
+        first_vote = np.cumsum(counts) - counts
+        idx = np.repeat(starts - first_vote, counts) + np.arange(total)
+        n_taxa = len(self.taxa)
+        pairs, votes = _sorted_distinct(np.repeat(owner, counts) * n_taxa + self.postings[idx])
+        reads, taxa = pairs // n_taxa, pairs % n_taxa
+
+        # Best and runner-up per read: sort by read, then votes descending.
+        order = np.argsort(reads * (votes.max() + 1) - votes)
+        reads, taxa, votes = reads[order], taxa[order], votes[order]
+        best = np.flatnonzero(np.concatenate(([True], reads[1:] != reads[:-1])))
+        runner = best + 1
+        has_runner = runner < len(reads)
+        has_runner[has_runner] = reads[runner[has_runner]] == reads[best[has_runner]]
+        runner_votes = np.where(has_runner, votes[np.minimum(runner, len(votes) - 1)], 0)
+
+        best_reads = reads[best]
+        confidence[best_reads] = (votes[best] - runner_votes) / read_kmers[best_reads]
+        assigned = (confidence[best_reads] > 0) & (confidence[best_reads] >= min_confidence)
+        taxon_ids[best_reads[assigned]] = taxa[best][assigned]
+        return taxon_ids, confidence, read_kmers
+
+    def taxon_name(self, taxon_id):
+        return self.taxa[taxon_id] if taxon_id != UNASSIGNED else None
+
+
+# --- Process pools ---
+# Each pool process maps the same files read-only, so the index is resident
+# once in the page cache however many processes classify against it.
+_pool_index = None
+
+
+def init_pool_process(index_path):
+    """Pool initializer: map the index in this process."""
+    global _pool_index
+    _pool_index = KmerIndex(index_path)
+
+
+def classify_in_pool(sequences, min_confidence=0.0):
+    """``KmerIndex.classify`` against the index mapped by ``init_pool_process``."""
+    return _pool_index.classify(sequences, min_confidence)
+
+
+def make_pool(index_path, processes):
+    return ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_pool_process, initargs=(index_path,),
+    )
+
+
+# --- Benchmark ---
+def bench(index_path, reads_path, batch_size=2000, limit=None, min_confidence=0.0, processes=1):
+    """Classify ``reads_path`` with the index and report reads/second."""
+    load_start = time.perf_counter()
+    index = KmerIndex(index_path)
+    load_ms = (time.perf_counter() - load_start) * 1000
+    reads = [sequence for _, sequence in read_sequences(reads_path)][:limit]
+    if not reads:
+        raise SystemExit(f"No reads in {reads_path}")
+    index.classify(reads[:batch_size])  # warm the page cache
+
+    pool = make_pool(index_path, processes) if processes > 1 else None
+    if pool is not None:
+        list(pool.map(classify_in_pool, [reads[:batch_size]] * processes))  # start and warm every process
+    assigned, confidence_sum = 0, 0.0
+    started = time.perf_counter()
+    batches = _batches(reads, batch_size)
+    if pool is None:
+        results = (index.classify(batch, min_confidence) for batch in batches)
+    else:
+        results = pool.map(classify_in_pool, batches, itertools.repeat(min_confidence))
+    for taxon_ids, confidence, _ in results:
+        assigned += int((taxon_ids != UNASSIGNED).sum())
+        confidence_sum += float(confidence.sum())
+    elapsed = time.perf_counter() - started
+    if pool is not None:
+        pool.shutdown()
+
+    print(f"index: k={index.k} taxa={len(index.taxa)} kmers={index.meta['n_kmers']} (loaded in {load_ms:.1f} ms)")
+    print(f"reads: {len(reads)} in batches of {batch_size} on {processes} process(es)")
+    print(f"time: {elapsed:.3f} s, {len(reads) / elapsed:,.0f} reads/s, {elapsed / len(reads) * 1000:.4f} ms/read")
+    print(f"assigned: {assigned / len(reads):.1%}, mean confidence {confidence_sum / len(reads):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or benchmark the eDNA k-mer index.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help="build an index from a reference FASTA")
+    build_cmd.add_argument('fasta')
+    build_cmd.add_argument('out_dir')
+    build_cmd.add_argument('-k', type=int, default=DEFAULT_K)
+    bench_cmd = commands.add_parser('bench', help="classify a FASTA/FASTQ of reads and report reads/second")
+    bench_cmd.add_argument('index_dir')
+    bench_cmd.add_argument('reads')
+    bench_cmd.add_argument('--batch-size', type=int, default=2000)
+    bench_cmd.add_argument('--limit', type=int, default=None)
+    bench_cmd.add_argument('--min-confidence', type=float, default=0.0)
+    bench_cmd.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        started = time.perf_counter()
+        meta = build_index(args.fasta, args.out_dir, args.k)
+        print(
+            f"Indexed {meta['n_references']} references ({len(meta['taxa'])} taxa, {meta['n_kmers']} k-mers) "
+            f"into {args.out_dir} in {time.perf_counter() - started:.1f} s"
+        )
+    else:
+        bench(args.index_dir, args.reads, args.batch_size, args.limit, args.min_confidence, args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,289 @@
+"""eDNA worker: assigns the reads in ``edna_queue`` messages to reference taxa.
+
+A message carries one batch of reads from a sample::
+
+    {"sample_id": "Reef_A_2025-09-03", "batch_id": "...", "sequences": [["ACGT...", 12], ...]}
+
+``sequences`` entries are ``[sequence, count]`` pairs (dereplicated reads) or
+bare sequences (count 1). Reads are classified against the k-mer index built
+offline by ``edna_index.py`` (``EDNA_INDEX_PATH``), then counted per taxon
+and added to ``edna_taxon_counts`` in one transaction; reads below
+``EDNA_MIN_CONFIDENCE`` are counted under taxon ``''``. The message is acked
+after commit. ``batch_id`` is recorded per sample in the same transaction, so
+a redelivered batch is not counted twice, and ``edna_changes`` is notified on
+commit so the API drops cached diversity results. A message that fails is
+retried after a delay through the retry queues (shared/work_queues.py), and
+dead-lettered once out of retries or if it is unusable.
+
+With ``EDNA_WORKER_PROCESSES`` > 1 (or 'auto'), each message is split into
+chunks of ``EDNA_CHUNK_SEQUENCES`` that are classified on a process pool.
+Every pool process maps the same index files read-only, so RAM holds one copy
+of the index. The chunk results are merged back on the consumer thread.
+"""
 import pika
 import json
 import os
+import sys
 import time
+import logging
+import functools
+from concurrent.futures.process import BrokenProcessPool
 
-def process_message(ch, method, properties, body):
-    """Callback function to process a message from the queue."""
-    data = json.loads(body)
-    print(f" [x] Received eDNA data: {data}")
-
-    # --- MOCK PROCESSING ---
-    # In a real application, you would use Biopython here to:
-    # 1. Fetch the sequence data for `data['sequence_id']`.
-    # 2. Run BLAST searches, sequence alignments, or other genetic analyses.
-    # 3. Store the findings in the database.
-    print("  - Simulating genetic analysis with Biopython...")
-    time.sleep(4) # Simulate a long-running task
-    print(f"  - Analysis complete for {data['sequence_id']}.")
-    # --- END MOCK ---
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(" [x] Done")
+import numpy as np
+from sqlalchemy import text
 
-def main():
-    rabbitmq_host = os.getenv('RABBITMQ_HOST', 'rabbitmq')
-    connection = None
+from db_writer import get_engine, upsert_statement
+from edna_index import UNASSIGNED, KmerIndex, classify_in_pool, make_pool
+from schema import wait_for_schema
+from work_queues import declare_work_queue, dead_letter, retry_or_dead_letter
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+EDNA_QUEUE = 'edna_queue'
+EDNA_INDEX_PATH = os.getenv('EDNA_INDEX_PATH', '/app/edna_index')
+EDNA_MIN_CONFIDENCE = float(os.getenv('EDNA_MIN_CONFIDENCE', '0.2'))
+EDNA_PREFETCH = int(os.getenv('EDNA_PREFETCH', '4'))
+
+# --- Parallel Classification ---
+# EDNA_WORKER_PROCESSES > 1 (or 'auto' for one per CPU) classifies on a pool
+# of processes sharing the memory-mapped index.
+EDNA_WORKER_PROCESSES = os.getenv('EDNA_WORKER_PROCESSES', '1')
+EDNA_CHUNK_SEQUENCES = int(os.getenv('EDNA_CHUNK_SEQUENCES', '500'))
+
+COUNT_COLUMNS = ['sample_id', 'taxon', 'read_count', 'sequence_count', 'confidence_sum']
+CLAIM_BATCH = text("""
+    INSERT INTO edna_batches (batch_id, sample_id) VALUES (:batch_id, :sample_id)
+    ON CONFLICT (sample_id, batch_id) DO NOTHING
+    RETURNING batch_id
+""")
+# Tells the API's response cache that the sample's abundances changed.
+NOTIFY_SAMPLE = text("SELECT pg_notify('edna_changes', :sample_id)")
+
+index = None
+executor = None
+consumer_channel = None
+
+def connect_to_rabbitmq():
+    """Connect to RabbitMQ with a retry mechanism."""
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+            logger.info("Successfully connected to RabbitMQ.")
+            return connection
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error(f"RabbitMQ not ready: {e}. Retrying in 5 seconds...")
+            time.sleep(5)
+
+def parse_message(body):
+    """Return ``((sample_id, batch_id, sequences, counts), None)``, or ``(None, reason)`` if unusable."""
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        return None, f"non-JSON message: {e}"
+    if not isinstance(data, dict) or not data.get('sample_id') or not data.get('sequences'):
+        return None, f"message without sample_id or sequences: {str(data)[:200]}"
+    sequences, counts = [], []
+    try:
+        for entry in data['sequences']:
+            sequence, count = (entry, 1) if isinstance(entry, str) else entry
+            sequences.append(sequence)
+            counts.append(int(count))
+    except (TypeError, ValueError) as e:
+        return None, f"invalid sequences entry in sample {data['sample_id']}: {e}"
+    return (data['sample_id'], data.get('batch_id'), sequences, np.array(counts, dtype=np.int64)), None
+
+def pool_size():
+    if EDNA_WORKER_PROCESSES == 'auto':
+        return os.cpu_count() or 1
+    return max(int(EDNA_WORKER_PROCESSES), 1)
+
+def make_executor():
+    """Classification pool, or None to classify inline on the consumer thread."""
+    size = pool_size()
+    if size <= 1:
+        return None
+    logger.info(f"Classifying reads on a {size}-process pool.")
+    return make_pool(EDNA_INDEX_PATH, size)
+
+def count_taxa(sample_id, taxon_ids, confidence, counts):
+    """Collapse per-sequence assignments into one ``edna_taxon_counts`` row per taxon."""
+    taxa, inverse = np.unique(taxon_ids, return_inverse=True)
+    reads = np.bincount(inverse, weights=counts)
+    unique_sequences = np.bincount(inverse)
+    confidence_sums = np.bincount(inverse, weights=confidence * counts)
+    return [
+        {
+            'sample_id': sample_id,
+            'taxon': index.taxon_name(int(taxon)) if taxon != UNASSIGNED else '',
+            'read_count': int(reads[i]),
+            'sequence_count': int(unique_sequences[i]),
+            'confidence_sum': float(confidence_sums[i]),
+        }
+        for i, taxon in enumerate(taxa)
+    ]
+
+def write_counts(conn, sample_id, batch_id, rows):
+    """Add ``rows`` to the sample's counts; False if ``batch_id`` was already counted."""
+    if batch_id and conn.execute(CLAIM_BATCH, {'batch_id': batch_id, 'sample_id': sample_id}).first() is None:
+        return False
+    stmt, params = upsert_statement('edna_taxon_counts', COUNT_COLUMNS, 'sample_id, taxon', rows, accumulate=True)
+    conn.execute(stmt, params)
+    conn.execute(NOTIFY_SAMPLE, {'sample_id': sample_id})
+    return True
 
-    for i in range(10):
+def save_counts(ch, tag, delivery, parsed, taxon_ids, confidence, started):
+    """Write the taxon counts of one classified message, then ack it.
+
+    ``delivery`` is the message's ``(properties, body)``, republished for a
+    retry if the write fails.
+    """
+    sample_id, batch_id, sequences, counts = parsed
+    classify_ms = (time.monotonic() - started) * 1000
+    rows = count_taxa(sample_id, taxon_ids, confidence, counts)
+    try:
+        with get_engine().begin() as conn:
+            written = write_counts(conn, sample_id, batch_id, rows)
+    except Exception as e:
+        logger.error(f"Failed to save batch {batch_id} of sample {sample_id}: {e}")
+        retry_or_dead_letter(ch, EDNA_QUEUE, tag, *delivery, e)
+        return
+    ch.basic_ack(delivery_tag=tag)
+
+    assigned = sum(row['read_count'] for row in rows if row['taxon'])
+    logger.info(
+        f"Sample {sample_id}: {len(sequences)} sequences ({int(counts.sum())} reads, {assigned} assigned) "
+        f"to {sum(1 for row in rows if row['taxon'])} taxa in {classify_ms:.1f} ms"
+        + ("" if written else f"; batch {batch_id} already counted")
+    )
+
+def restart_executor(broken):
+    """Replace a broken pool once, however many of its futures report the breakage."""
+    global executor
+    if broken is not executor:
+        return
+    logger.error("Classification pool died. Restarting pool.")
+    broken.shutdown(wait=False, cancel_futures=True)
+    executor = make_executor()
+
+def on_chunk_done(ch, tag, delivery, parsed, pending, position, get_result):
+    """Runs on the connection thread once one chunk of a message is classified (on ``pending['pool']``)."""
+    if ch is not consumer_channel or pending['failed']:
+        # Channel replaced after a reconnect (the broker redelivers), or the
+        # message was already settled by another chunk's failure.
+        return
+    try:
+        pending['results'][position] = get_result()
+    except BrokenProcessPool as e:
+        logger.error(f"Classification pool died on batch {parsed[1]} of sample {parsed[0]}: {e}")
+        restart_executor(pending['pool'])
+        pending['failed'] = True
+        retry_or_dead_letter(ch, EDNA_QUEUE, tag, *delivery, e)
+        return
+    except Exception as e:
+        logger.error(f"Failed to classify batch {parsed[1]} of sample {parsed[0]}: {e}")
+        pending['failed'] = True
+        retry_or_dead_letter(ch, EDNA_QUEUE, tag, *delivery, e)
+        return
+    pending['remaining'] -= 1
+    if pending['remaining'] == 0:
+        taxon_ids = np.concatenate([result[0] for result in pending['results']])
+        confidence = np.concatenate([result[1] for result in pending['results']])
+        save_counts(ch, tag, delivery, parsed, taxon_ids, confidence, pending['started'])
+
+def process_message(ch, method, properties, body):
+    """Classify one batch of reads and add its taxon counts to the database."""
+    tag = method.delivery_tag
+    delivery = (properties, body)
+    parsed, reason = parse_message(body)
+    if parsed is None:
+        dead_letter(ch, EDNA_QUEUE, tag, reason)
+        return
+    sample_id, batch_id, sequences, counts = parsed
+    started = time.monotonic()
+
+    if executor is None:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
-            break
-        except pika.exceptions.AMQPConnectionError:
-            print(f"Connection to RabbitMQ failed. Retrying in {i+2} seconds...")
-            time.sleep(i + 2)
-
-    if not connection:
-        print("Could not connect to RabbitMQ. Exiting.")
+            taxon_ids, confidence, _ = index.classify(sequences, EDNA_MIN_CONFIDENCE)
+        except Exception as e:
+            logger.error(f"Failed to classify batch {batch_id} of sample {sample_id}: {e}")
+            retry_or_dead_letter(ch, EDNA_QUEUE, tag, *delivery, e)
+            return
+        save_counts(ch, tag, delivery, parsed, taxon_ids, confidence, started)
         return
 
-    channel = connection.channel()
-    channel.queue_declare(queue='edna_queue', durable=True)
-    print(' [*] eDNA Worker: Waiting for messages. To exit press CTRL+C')
-    channel.basic_consume(queue='edna_queue', on_message_callback=process_message)
-    channel.start_consuming()
+    chunks = [sequences[i:i + EDNA_CHUNK_SEQUENCES] for i in range(0, len(sequences), EDNA_CHUNK_SEQUENCES)]
+    pending = {
+        'results': [None] * len(chunks), 'remaining': len(chunks), 'failed': False, 'started': started,
+        'pool': executor,
+    }
+    connection = ch.connection
+    for position, chunk in enumerate(chunks):
+        def on_future_done(future, position=position):
+            # Called on a pool thread: hand the result back to the pika I/O thread.
+            try:
+                connection.add_callback_threadsafe(
+                    functools.partial(on_chunk_done, ch, tag, delivery, parsed, pending, position, future.result)
+                )
+            except Exception as e:
+                logger.warning(f"Dropping result for sample {sample_id}, connection is gone: {e}")
+        try:
+            future = pending['pool'].submit(classify_in_pool, chunk, EDNA_MIN_CONFIDENCE)
+        except BrokenProcessPool as e:
+            # Broke before any of its futures reported it; chunks already submitted fail with it.
+            restart_executor(pending['pool'])
+            pending['failed'] = True
+            retry_or_dead_letter(ch, EDNA_QUEUE, tag, *delivery, e)
+            return
+        future.add_done_callback(on_future_done)
+
+def main():
+    """Main function to start the eDNA worker."""
+    global index, executor, consumer_channel
+    logger.info("Starting eDNA worker...")
+    wait_for_schema(get_engine())
+    try:
+        index = KmerIndex(EDNA_INDEX_PATH)
+    except FileNotFoundError:
+        logger.critical(f"No eDNA index at {EDNA_INDEX_PATH}; build one with 'python edna_index.py build'.")
+        sys.exit(1)
+    logger.info(f"Loaded eDNA index: k={index.k}, {len(index.taxa)} taxa, {index.meta['n_kmers']} k-mers.")
+    executor = make_executor()
+    while True:
+        connection = None
+        try:
+            connection = connect_to_rabbitmq()
+            channel = connection.channel()
+            declare_work_queue(channel, EDNA_QUEUE)
+            channel.basic_qos(prefetch_count=max(EDNA_PREFETCH, pool_size()))
+            consumer_channel = channel
+            channel.basic_consume(queue=EDNA_QUEUE, on_message_callback=process_message)
+            logger.info('Waiting for messages. To exit press CTRL+C')
+            channel.start_consuming()
+        except pika.exceptions.StreamLostError as e:
+            logger.error(f"Lost connection to RabbitMQ ({e}). Reconnecting in 5 seconds...")
+            time.sleep(5)
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error(f"AMQP Connection error ({e}). Reconnecting in 5 seconds...")
+            time.sleep(5)
+        except KeyboardInterrupt:
+            logger.info('Interrupted')
+            try:
+                sys.exit(0)
+            except SystemExit:
+                os._exit(0)
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}. Reconnecting in 5 seconds...")
+            # Closing hands the unacked deliveries back to the broker for redelivery.
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            time.sleep(5)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,88 @@
+"""Versioned model registry on the shared ``model_volume``.
+
+Layout::
+
+    registry/
+        CURRENT                      # name of the live version
+        versions/<version>/
+            species_classifier.pkl
+            species_classifier_forest/
+            manifest.json
+
+``train_model.py`` builds each version in a staging directory and renames it
+into ``versions/``, then swaps ``CURRENT`` with ``os.replace``. Both steps are
+atomic on one filesystem, so a reader never sees a half-written model. Workers
+poll ``CURRENT`` and load new versions between batches (see
+``species_model.maybe_reload``).
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+CURRENT_FILE = 'CURRENT'
+VERSIONS_DIR = 'versions'
+MANIFEST_FILE = 'manifest.json'
+PICKLE_NAME = 'species_classifier.pkl'
+FOREST_NAME = 'species_classifier_forest'
+
+
+def version_path(registry_path, version):
+    return os.path.join(registry_path, VERSIONS_DIR, version)
+
+
+def current_version(registry_path):
+    """Return the live version name, or None if nothing has been published."""
+    try:
+        with open(os.path.join(registry_path, CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def new_version_name():
+    """Sortable, UTC-timestamped version name."""
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+
+
+def staging_path(registry_path, version):
+    """Directory to write a version's artifacts into before ``publish``."""
+    path = os.path.join(registry_path, f'.staging-{version}')
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def publish(registry_path, version, staged_dir, manifest=None, keep=5):
+    """Move ``staged_dir`` into the registry as ``version`` and make it current."""
+    versions_dir = os.path.join(registry_path, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+    manifest = dict(manifest or {}, version=version, published_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    with open(os.path.join(staged_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(staged_dir, version_path(registry_path, version))
+
+    tmp = os.path.join(registry_path, f'.{CURRENT_FILE}.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(registry_path, CURRENT_FILE))
+    prune(registry_path, keep)
+    return version
+
+
+def prune(registry_path, keep):
+    """Delete all but the ``keep`` newest versions (the current one always stays).
+
+    Workers still memory-mapping a deleted version keep working: the files
+    stay alive until they are unmapped.
+    """
+    versions_dir = os.path.join(registry_path, VERSIONS_DIR)
+    current = current_version(registry_path)
+    versions = sorted(os.listdir(versions_dir), reverse=True)
+    for version in versions[keep:]:
+        if version != current:
+            shutil.rmtree(os.path.join(versions_dir, version), ignore_errors=True)
@@ -0,0 +1,72 @@
+"""Otolith image analysis (decode, threshold, contour metrics).
+
+Kept free of AMQP and database state so it can run inline on the consumer
+thread or inside a process/thread pool (see ``otolith_worker_ai.py``).
+"""
+import io
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class ImageAnalysisError(ValueError):
+    """The image is corrupted or cannot be decoded."""
+
+
+def init_pool_process():
+    """Pool initializer: one OpenCV thread per process to avoid oversubscription."""
+    cv2.setNumThreads(1)
+
+
+def validate_image_data(image_data):
+    """Validate image data before processing."""
+    try:
+        # Try to decode with PIL first to catch PNG corruption issues
+        image = Image.open(io.BytesIO(image_data))
+        image.verify()  # This will raise an exception if the image is corrupted
+        return True
+    except Exception as e:
+        logger.error(f"Image validation failed: {e}")
+        return False
+
+
+def compute_morphometrics(image_id, image_data):
+    """Return the morphometrics of the largest contour, or None if there is none.
+
+    Raises ``ImageAnalysisError`` for corrupted or undecodable images.
+    """
+    # Validate image data before processing
+    if not validate_image_data(image_data):
+        raise ImageAnalysisError(f"Corrupted image {image_id}")
+
+    # --- OpenCV Processing ---
+    np_arr = np.frombuffer(image_data, np.uint8)
+    img = cv2.imdecode(np_arr, cv2.IMREAD_GRAYSCALE)
+
+    # Check if image was successfully decoded
+    if img is None:
+        raise ImageAnalysisError(f"Failed to decode image {image_id}")
+
+    _, thresh = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+
+    main_contour = max(contours, key=cv2.contourArea)
+    area = cv2.contourArea(main_contour)
+    perimeter = cv2.arcLength(main_contour, True)
+    x, y, w, h = cv2.boundingRect(main_contour)
+    aspect_ratio = float(w) / h if h != 0 else 0
+
+    return {
+        "image_id": image_id,
+        "area": float(area),
+        "perimeter": float(perimeter),
+        "width": int(w),
+        "height": int(h),
+        "aspect_ratio": aspect_ratio
+    }
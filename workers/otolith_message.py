@@ -0,0 +1,43 @@
+"""Decoding of messages on ``otolith_queue``.
+
+Binary format (current): the AMQP body is the raw image file and ``image_id``
+plus optional ``latitude``/``longitude`` travel in the message headers, with
+the image MIME type in ``content_type``. The body is returned as-is so workers
+can wrap it with ``np.frombuffer`` without an extra copy.
+
+Legacy format: a JSON object with ``image_id`` and base64 ``image_data``. It is
+still accepted so messages already sitting in the queue drain after a deploy.
+"""
+import base64
+import json
+
+
+class OtolithMessageError(ValueError):
+    """The message does not carry a usable image."""
+
+
+def _header_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+def decode_otolith_message(properties, body):
+    """Return ``(image_id, image_bytes, metadata)`` for an otolith message."""
+    headers = (properties.headers if properties is not None else None) or {}
+    if 'image_id' in headers:
+        metadata = {'content_type': properties.content_type}
+        for key in ('latitude', 'longitude'):
+            if headers.get(key) is not None:
+                metadata[key] = float(headers[key])
+        if not body:
+            raise OtolithMessageError(f"Message for {_header_str(headers['image_id'])} has an empty body.")
+        return _header_str(headers['image_id']), body, metadata
+
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise OtolithMessageError(f"Message has no image_id header and is not JSON: {e}")
+    image_id = data.get('image_id')
+    image_data = data.get('image_data')
+    if not image_id or not image_data:
+        raise OtolithMessageError(f"Legacy message for {image_id} has no image data.")
+    return image_id, base64.b64decode(image_data), {'content_type': None}
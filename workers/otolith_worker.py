@@ -1,18 +1,17 @@
 import pika
-import json
 import os
 import time
-import base64
 import cv2
 import numpy as np
+from otolith_message import decode_otolith_message, OtolithMessageError
+from work_queues import declare_work_queue
 
 def process_message(ch, method, properties, body):
     """Callback function to process an otolith image from the queue."""
-    message = json.loads(body)
-    image_data_b64 = message.get("image_data")
-
-    if not image_data_b64:
-        print(" [!] Received message without image data. Acknowledging and skipping.")
+    try:
+        _, image_bytes, _ = decode_otolith_message(properties, body)
+    except OtolithMessageError as e:
+        print(f" [!] {e} Acknowledging and skipping.")
         ch.basic_ack(delivery_tag=method.delivery_tag)
         return
 
@@ -20,8 +19,7 @@ def process_message(ch, method, properties, body):
 
     try:
         # --- REAL PROCESSING with OpenCV ---
-        # 1. Decode Base64 string to bytes, then to a NumPy array
-        image_bytes = base64.b64decode(image_data_b64)
+        # 1. Wrap the raw image bytes in a NumPy array (no copy)
         np_arr = np.frombuffer(image_bytes, np.uint8)
         img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
@@ -83,7 +81,7 @@ def main():
         return
 
     channel = connection.channel()
-    channel.queue_declare(queue='otolith_queue', durable=True)
+    declare_work_queue(channel, 'otolith_queue')
     print(' [*] Otolith Worker: Waiting for messages. To exit press CTRL+C')
     channel.basic_consume(queue='otolith_queue', on_message_callback=process_message)
     channel.start_consuming()
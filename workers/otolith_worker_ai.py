@@ -1,15 +1,22 @@
 import pika
 import json
-import base64
-import cv2
-import numpy as np
 import time
 import os
 import sys
-from sqlalchemy import create_engine, text
-from PIL import Image
-import io
 import logging
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from otolith_message import decode_otolith_message, OtolithMessageError
+from otolith_analysis import compute_morphometrics, init_pool_process, ImageAnalysisError
+from ack_tracker import AckTracker
+from content_cache import ContentCache, content_hash
+from db_writer import BulkWriter, clear_failures, get_engine, notify_changes, record_failure, upsert_statement
+from schema import wait_for_schema
+from work_queues import declare_work_queue, dead_letter, schedule_retry
+import rollups
+import species_model
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,7 +25,43 @@ logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 RABBITMQ_HOST = 'rabbitmq'
-DATABASE_URL = "postgresql://postgres:postgres@db:5432/cmlre_data"
+OTOLITH_QUEUE = 'otolith_queue'
+AI_QUEUE = 'ai_queue'
+
+# Rows are written in batches of up to OTOLITH_FLUSH_ROWS, or after
+# OTOLITH_FLUSH_MS; prefetch must exceed the batch size to fill it.
+OTOLITH_FLUSH_ROWS = int(os.getenv('OTOLITH_FLUSH_ROWS', '16'))
+OTOLITH_FLUSH_MS = int(os.getenv('OTOLITH_FLUSH_MS', '200'))
+OTOLITH_PREFETCH = int(os.getenv('OTOLITH_PREFETCH', str(OTOLITH_FLUSH_ROWS * 2)))
+
+# --- Pipeline Mode ---
+# 'staged': save morphometrics here and let ai_worker predict via ai_queue.
+# 'fused':  load the classifier here and write metrics + species in one upsert.
+OTOLITH_PIPELINE_MODE = os.getenv('OTOLITH_PIPELINE_MODE', 'staged').lower()
+FUSED = OTOLITH_PIPELINE_MODE == 'fused'
+
+# --- Parallel Analysis ---
+# OTOLITH_WORKER_PROCESSES > 1 (or 'auto' for one per CPU) moves the OpenCV work
+# off the pika I/O thread into a pool; OTOLITH_EXECUTOR picks 'process' or
+# 'thread' (OpenCV releases the GIL for most of the pipeline).
+OTOLITH_WORKER_PROCESSES = os.getenv('OTOLITH_WORKER_PROCESSES', '1')
+OTOLITH_EXECUTOR = os.getenv('OTOLITH_EXECUTOR', 'process').lower()
+
+# --- Content Deduplication ---
+# Images already analysed (same bytes, new image_id) skip OpenCV and, when the
+# prediction is known, the model. OTOLITH_DEDUP_CACHE_SIZE=0 disables it;
+# OTOLITH_DEDUP_SHARED=1 also consults Postgres on a local miss.
+OTOLITH_DEDUP_CACHE_SIZE = int(os.getenv('OTOLITH_DEDUP_CACHE_SIZE', '10000'))
+OTOLITH_DEDUP_SHARED = os.getenv('OTOLITH_DEDUP_SHARED', '0') == '1'
+dedup_cache = ContentCache(OTOLITH_DEDUP_CACHE_SIZE, OTOLITH_DEDUP_SHARED) if OTOLITH_DEDUP_CACHE_SIZE > 0 else None
+
+# Per-channel state (recreated on reconnect) and the shared analysis pool
+consumer_channel = None
+writer = None
+tracker = None
+executor = None
+# (properties, body) of the deliveries in flight, kept to retry them on failure
+deliveries = {}
 
 def connect_to_rabbitmq():
     """Connect to RabbitMQ with a retry mechanism."""
@@ -31,117 +74,237 @@ def connect_to_rabbitmq():
             logger.error(f"RabbitMQ not ready: {e}. Retrying in 5 seconds...")
             time.sleep(5)
 
-def validate_image_data(image_data):
-    """Validate image data before processing."""
-    try:
-        # Try to decode with PIL first to catch PNG corruption issues
-        image = Image.open(io.BytesIO(image_data))
-        image.verify()  # This will raise an exception if the image is corrupted
-        return True
-    except Exception as e:
-        logger.error(f"Image validation failed: {e}")
-        return False
+def pool_size():
+    if OTOLITH_WORKER_PROCESSES == 'auto':
+        return os.cpu_count() or 1
+    return max(int(OTOLITH_WORKER_PROCESSES), 1)
 
-def process_message(ch, method, properties, body):
-    """Callback function to process a message from the queue."""
-    logger.info(f"Received message: {body}")
+def make_executor():
+    """Analysis pool, or None to analyse inline on the consumer thread."""
+    size = pool_size()
+    if size <= 1:
+        return None
+    logger.info(f"Analysing images on a {size}-worker {OTOLITH_EXECUTOR} pool.")
+    if OTOLITH_EXECUTOR == 'thread':
+        return ThreadPoolExecutor(max_workers=size, thread_name_prefix='otolith')
+    return ProcessPoolExecutor(
+        max_workers=size, mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_pool_process,
+    )
+
+def restart_executor(broken):
+    """Replace a broken pool once, however many of its futures report the breakage."""
+    global executor
+    if broken is not executor:
+        return
+    logger.error("Analysis pool died. Restarting pool.")
+    broken.shutdown(wait=False, cancel_futures=True)
+    executor = make_executor()
+
+def settle(channel, tags):
+    """Ack finished deliveries up to the oldest one still in flight."""
+    for tag in tags:
+        deliveries.pop(tag, None)
+    ack_upto = tracker.complete(tags)
+    if ack_upto is not None:
+        channel.basic_ack(delivery_tag=ack_upto, multiple=True)
+
+def delivery_image_id(tag):
     try:
-        data = json.loads(body)
-        image_id = data['image_id']
-        image_data = base64.b64decode(data['image_data'])
-        
-        logger.info(f"Processing image: {image_id}")
-
-        # Validate image data before processing
-        if not validate_image_data(image_data):
-            logger.warning(f"Skipping corrupted image {image_id}")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
-
-        # --- OpenCV Processing ---
-        np_arr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_GRAYSCALE)
-        
-        # Check if image was successfully decoded
-        if img is None:
-            logger.error(f"Failed to decode image {image_id}")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
-        
-        _, thresh = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY_INV)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if contours:
-            main_contour = max(contours, key=cv2.contourArea)
-            area = cv2.contourArea(main_contour)
-            perimeter = cv2.arcLength(main_contour, True)
-            x, y, w, h = cv2.boundingRect(main_contour)
-            aspect_ratio = float(w) / h if h != 0 else 0
-            
-            metrics = {
-                "image_id": image_id,
-                "area": area,
-                "perimeter": perimeter,
-                "width": w,
-                "height": h,
-                "aspect_ratio": aspect_ratio
-            }
-            logger.info(f"Calculated metrics for {image_id}: {metrics}")
-
-            # --- Save to Database ---
-            engine = create_engine(DATABASE_URL)
-            with engine.connect() as conn:
-                insert_sql = text("""
-                    INSERT INTO otolith_morphometrics (image_id, area, perimeter, width, height, aspect_ratio, latitude, longitude)
-                    VALUES (:image_id, :area, :perimeter, :width, :height, :aspect_ratio, :lat, :lon)
-                    ON CONFLICT (image_id) DO UPDATE SET
-                        area = EXCLUDED.area,
-                        perimeter = EXCLUDED.perimeter,
-                        width = EXCLUDED.width,
-                        height = EXCLUDED.height,
-                        aspect_ratio = EXCLUDED.aspect_ratio,
-                        latitude = EXCLUDED.latitude,
-                        longitude = EXCLUDED.longitude;
-                """)
-                # Add mock location data
-                params = {**metrics, "lat": 15.5 - (area % 1000) / 5000, "lon": -75.2 - (perimeter % 1000) / 5000}
-                conn.execute(insert_sql, params)
-                conn.commit()
-            logger.info(f"Saved metrics for {image_id} to database.")
-
-            # --- Trigger AI Worker ---
-            channel = ch.connection.channel()
-            channel.queue_declare(queue='ai_queue', durable=True)
-            ai_message = json.dumps(metrics)
+        return decode_otolith_message(*deliveries[tag])[0]
+    except (KeyError, OtolithMessageError):
+        return None
+
+def reject(channel, tag, reason):
+    """Dead-letter a delivery that can never be processed, and record its image as failed."""
+    image_id = delivery_image_id(tag)
+    deliveries.pop(tag, None)
+    tracker.forget([tag])
+    dead_letter(channel, OTOLITH_QUEUE, tag, reason)
+    record_failure(image_id, OTOLITH_QUEUE, reason)
+
+def fail(channel, tag, reason):
+    """Retry a failed delivery after a delay; dead-letter it once out of retries."""
+    properties, body = deliveries[tag]
+    if schedule_retry(channel, OTOLITH_QUEUE, properties, body, reason):
+        settle(channel, [tag])
+    else:
+        reject(channel, tag, f"out of retries; {reason}")
+
+MORPHOMETRIC_COLUMNS = [
+    'image_id', 'area', 'perimeter', 'width', 'height', 'aspect_ratio',
+    'latitude', 'longitude', 'content_hash', 'predicted_species', 'model_version',
+]
+
+def predict_missing_species(rows):
+    """Fused mode: one model call for the rows the content cache could not answer.
+
+    Runs before the batch's transaction opens; the predictions are written by
+    the same upsert as the morphometrics.
+    """
+    unpredicted = [row for row in rows if row.get('predicted_species') is None]
+    if unpredicted:
+        species_model.maybe_reload()
+        for row, species in zip(unpredicted, species_model.predict_species_batch(unpredicted)):
+            row['predicted_species'] = species
+            row['model_version'] = species_model.model_version
+
+def write_morphometrics(conn, rows):
+    """Upsert a batch of morphometric rows in one statement."""
+    stmt, params = upsert_statement('otolith_morphometrics', MORPHOMETRIC_COLUMNS, 'image_id', rows)
+    image_ids = [row['image_id'] for row in rows]
+    with rollups.track_changes(conn, image_ids):
+        conn.execute(stmt, params)
+    clear_failures(conn, image_ids)
+    notify_changes(conn, image_ids)
+
+def make_writer(connection, channel):
+    """Write-behind buffer for one channel: ack and trigger the AI worker after commit."""
+    def on_flushed(rows, tags):
+        if dedup_cache is not None:
+            for row in rows:
+                if row.get('predicted_species') is not None:
+                    dedup_cache.store(row['content_hash'], row)
+        # --- Trigger AI Worker (only for rows still missing a prediction) ---
+        pending = [row for row in rows if row.get('predicted_species') is None]
+        for row in pending:
+            ai_message = {key: row[key] for key in ('image_id', 'area', 'perimeter', 'width', 'height', 'aspect_ratio')}
             channel.basic_publish(
                 exchange='',
-                routing_key='ai_queue',
-                body=ai_message,
+                routing_key=AI_QUEUE,
+                body=json.dumps(ai_message),
                 properties=pika.BasicProperties(delivery_mode=2)
             )
-            logger.info(f"Sent metrics for {image_id} to AI queue.")
+        logger.info(f"Saved {len(rows)} rows, sent {len(pending)} to the AI queue.")
+        settle(channel, tags)
+
+    def on_failed(rows, tags, error):
+        for tag in tags:
+            fail(channel, tag, error)
 
+    return BulkWriter(
+        'otolith_morphometrics', write_morphometrics,
+        max_rows=OTOLITH_FLUSH_ROWS, max_delay=OTOLITH_FLUSH_MS / 1000, key='image_id',
+        on_flushed=on_flushed, on_failed=on_failed, connection=connection,
+        prepare=predict_missing_species if FUSED else None,
+    )
+
+def on_analysis_done(ch, tag, image_id, metadata, digest, get_result, pool=None):
+    """Runs on the connection thread once an image has been analysed (on ``pool``, if any)."""
+    if ch is not consumer_channel:
+        # The channel was replaced after a reconnect; the broker redelivers.
+        return
+    try:
+        metrics = get_result()
+    except ImageAnalysisError as e:
+        reject(ch, tag, e)
+        return
+    except BrokenProcessPool as e:
+        # Possibly caused by this very image: retried a bounded number of times.
+        logger.error(f"Analysis pool died while processing {image_id}: {e}")
+        restart_executor(pool)
+        fail(ch, tag, e)
+        return
     except Exception as e:
         logger.error(f"Error processing message: {e}")
+        fail(ch, tag, e)
+        return
+
+    if not metrics:
+        settle(ch, [tag])
+        return
+    logger.info(f"Calculated metrics for {image_id}: {metrics}")
+    if dedup_cache is not None:
+        dedup_cache.store(digest, metrics)
+
+    # --- Save to Database (write-behind; acked once the batch commits) ---
+    # Use the uploaded location if present, mock location data otherwise
+    row = {
+        **metrics,
+        "image_id": image_id,
+        "content_hash": digest,
+        "predicted_species": metrics.get("predicted_species"),
+        "model_version": metrics.get("model_version"),
+        "latitude": metadata.get("latitude", 15.5 - (metrics["area"] % 1000) / 5000),
+        "longitude": metadata.get("longitude", -75.2 - (metrics["perimeter"] % 1000) / 5000),
+    }
+    writer.add(row, tag)
+
+def process_message(ch, method, properties, body):
+    """Callback function to process a message from the queue."""
+    logger.info(f"Received message: {len(body)} bytes ({properties.content_type})")
+    tag = method.delivery_tag
+    tracker.delivered(tag)
+    deliveries[tag] = (properties, body)
+    try:
+        image_id, image_data, metadata = decode_otolith_message(properties, body)
+    except OtolithMessageError as e:
+        reject(ch, tag, f"undecodable message: {e}")
+        return
+
+    digest = content_hash(image_data)
+    # Predictions from a model version that has since been swapped out are not reused.
+    cached = dedup_cache.lookup(digest, species_model.live_version()) if dedup_cache is not None else None
+    if cached is not None:
+        logger.info(f"Content cache hit for {image_id} ({digest[:12]}); reusing stored analysis.")
+        on_analysis_done(ch, tag, image_id, metadata, digest, lambda: dict(cached))
+        return
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    logger.info(f"Processing image: {image_id}")
+    if executor is None:
+        on_analysis_done(ch, tag, image_id, metadata, digest, lambda: compute_morphometrics(image_id, image_data))
+        return
+
+    connection = ch.connection
+    pool = executor
+    def on_future_done(future):
+        # Called on a pool thread: hand the result back to the pika I/O thread.
+        try:
+            connection.add_callback_threadsafe(
+                functools.partial(on_analysis_done, ch, tag, image_id, metadata, digest, future.result, pool)
+            )
+        except Exception as e:
+            logger.warning(f"Dropping result for {image_id}, connection is gone: {e}")
+
+    try:
+        future = pool.submit(compute_morphometrics, image_id, image_data)
+    except BrokenProcessPool:
+        # Broke before any of its futures reported it.
+        restart_executor(pool)
+        pool = executor
+        future = pool.submit(compute_morphometrics, image_id, image_data)
+    future.add_done_callback(on_future_done)
 
 def main():
     """Main function to start the otolith worker with connection recovery."""
-    logger.info("Starting main function...")
+    global consumer_channel, writer, tracker, executor
+    logger.info(f"Starting main function in {OTOLITH_PIPELINE_MODE} mode...")
+    wait_for_schema(get_engine())
+    if FUSED:
+        species_model.load_model()
+    executor = make_executor()
+    prefetch = max(OTOLITH_PREFETCH, pool_size() * 2)
     while True:
         try:
             logger.info("Attempting to connect to RabbitMQ...")
             connection = connect_to_rabbitmq()
             logger.info("Creating channel...")
             channel = connection.channel()
-            logger.info("Declaring queue...")
-            channel.queue_declare(queue='otolith_queue', durable=True)
+            logger.info("Declaring queues...")
+            declare_work_queue(channel, OTOLITH_QUEUE)
+            if not FUSED:
+                declare_work_queue(channel, AI_QUEUE)
+            if writer is not None:
+                writer.discard()
+            consumer_channel = channel
+            tracker = AckTracker()
+            deliveries.clear()
+            writer = make_writer(connection, channel)
             
             logger.info("Setting QoS...")
-            channel.basic_qos(prefetch_count=1)
+            channel.basic_qos(prefetch_count=prefetch)
             logger.info("Setting up consumer...")
-            channel.basic_consume(queue='otolith_queue', on_message_callback=process_message)
+            channel.basic_consume(queue=OTOLITH_QUEUE, on_message_callback=process_message)
             
             logger.info('Waiting for messages. To exit press CTRL+C')
             channel.start_consuming()
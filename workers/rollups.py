@@ -0,0 +1,141 @@
+"""Incrementally maintained dashboard rollups.
+
+``otolith_rollups`` holds one row per (bucket size, bucket start, species) with
+a sample count and the sum of each morphometric, so the dashboard reads
+buckets instead of every otolith. Buckets are UTC hours and days of
+``created_at``. Unpredicted samples are counted under species ``''`` until
+``ai_worker`` fills in the prediction.
+
+Writers wrap their statement in ``track_changes``, inside the same
+transaction::
+
+    with rollups.track_changes(conn, image_ids):
+        conn.execute(upsert, params)
+
+It locks the affected ``image_id``s, snapshots their rows before and after the
+write and adds the difference (-1 for the old row, +1 for the new one) to the
+rollup rows. Inserts, re-deliveries and species updates are all handled the
+same way. The migration that creates the table (shared/schema.py) backfills it
+from ``otolith_morphometrics``.
+
+``otolith_geo_bins`` is maintained the same way for the map: per slippy-map
+tile at zooms ``0..GEO_MAX_ZOOM``, per species, a sample count and the sums of
+latitude and longitude (for the centroid). Tile numbers are computed in SQL
+(``TILE_X`` / ``TILE_Y`` in shared/schema.py), so the backfill bins rows identically.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timezone
+
+from sqlalchemy import text
+
+from db_writer import upsert_statement
+from schema import (
+    CLAMPED_LATITUDE, GEO_MAX_ZOOM, ROLLUP_BUCKET_SIZES as BUCKET_SIZES, ROLLUP_METRICS as METRICS, TILE_X, TILE_Y,
+)
+
+ROLLUP_COLUMNS = ['bucket_size', 'bucket_start', 'species', 'sample_count'] + [f'{m}_sum' for m in METRICS]
+ROLLUP_KEY = 'bucket_size, bucket_start, species'
+
+# Advisory lock namespace; serialises writers touching the same image_id so
+# each one's "before" snapshot is the committed state.
+LOCK_NAMESPACE = 41011
+
+LOCK_IMAGE_IDS = text("""
+    SELECT pg_advisory_xact_lock(:namespace, h)
+    FROM (
+        SELECT DISTINCT hashtext(image_id) AS h
+        FROM unnest(CAST(:image_ids AS text[])) AS image_id
+        ORDER BY h
+    ) AS keys;
+""")
+
+GEO_COLUMNS = ['zoom', 'tile_x', 'tile_y', 'species', 'sample_count', 'latitude_sum', 'longitude_sum']
+GEO_KEY = 'zoom, tile_x, tile_y, species'
+
+GEO_SNAPSHOT = text(f"""
+    SELECT z.zoom, {TILE_X} AS tile_x, {TILE_Y} AS tile_y,
+           COALESCE(predicted_species, '') AS species, latitude, longitude
+    FROM otolith_morphometrics
+    CROSS JOIN LATERAL (SELECT {CLAMPED_LATITUDE} AS lat) AS c
+    CROSS JOIN generate_series(0, :max_zoom) AS z(zoom)
+    WHERE image_id = ANY(:image_ids) AND created_at IS NOT NULL
+      AND latitude IS NOT NULL AND longitude IS NOT NULL;
+""")
+
+SNAPSHOT = text(f"""
+    SELECT image_id, predicted_species, created_at, {', '.join(METRICS)}
+    FROM otolith_morphometrics
+    WHERE image_id = ANY(:image_ids) AND created_at IS NOT NULL;
+""")
+
+
+def bucket_start(ts, size):
+    ts = ts.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if size == 'day' else ts
+
+
+def snapshot(conn, image_ids):
+    rows = [dict(row) for row in conn.execute(SNAPSHOT, {'image_ids': image_ids}).mappings()]
+    bins = [dict(row) for row in conn.execute(GEO_SNAPSHOT, {'image_ids': image_ids, 'max_zoom': GEO_MAX_ZOOM}).mappings()]
+    return rows, bins
+
+
+def deltas(before, after):
+    """Net rollup change per (bucket_size, bucket_start, species)."""
+    changes = defaultdict(lambda: defaultdict(float))
+    for rows, sign in ((before, -1), (after, 1)):
+        for row in rows:
+            for size in BUCKET_SIZES:
+                key = (size, bucket_start(row['created_at'], size), row['predicted_species'] or '')
+                change = changes[key]
+                change['sample_count'] += sign
+                for metric in METRICS:
+                    change[f'{metric}_sum'] += sign * (row[metric] or 0.0)
+    return [
+        {'bucket_size': size, 'bucket_start': start, 'species': species, **change}
+        for (size, start, species), change in changes.items()
+        # A row rewritten with identical values cancels out.
+        if any(change.values())
+    ]
+
+
+def geo_deltas(before, after):
+    """Net change per (zoom, tile_x, tile_y, species)."""
+    changes = defaultdict(lambda: defaultdict(float))
+    for bins, sign in ((before, -1), (after, 1)):
+        for row in bins:
+            change = changes[(row['zoom'], row['tile_x'], row['tile_y'], row['species'])]
+            change['sample_count'] += sign
+            change['latitude_sum'] += sign * row['latitude']
+            change['longitude_sum'] += sign * row['longitude']
+    return [
+        {'zoom': zoom, 'tile_x': x, 'tile_y': y, 'species': species, **change}
+        for (zoom, x, y, species), change in changes.items()
+        if any(change.values())
+    ]
+
+
+def _accumulate(conn, table, columns, key, rows):
+    if not rows:
+        return
+    for row in rows:
+        row['sample_count'] = int(row['sample_count'])
+    stmt, params = upsert_statement(table, columns, key, rows, accumulate=True)
+    conn.execute(stmt, params)
+
+
+def apply_deltas(conn, before, after):
+    (rows_before, bins_before), (rows_after, bins_after) = before, after
+    _accumulate(conn, 'otolith_rollups', ROLLUP_COLUMNS, ROLLUP_KEY, deltas(rows_before, rows_after))
+    _accumulate(conn, 'otolith_geo_bins', GEO_COLUMNS, GEO_KEY, geo_deltas(bins_before, bins_after))
+
+
+@contextmanager
+def track_changes(conn, image_ids):
+    """Fold the rows written inside the block into the rollup and geo-bin tables."""
+    image_ids = sorted(set(image_ids))
+    conn.execute(LOCK_IMAGE_IDS, {'namespace': LOCK_NAMESPACE, 'image_ids': image_ids})
+    before = snapshot(conn, image_ids)
+    yield
+    apply_deltas(conn, before, snapshot(conn, image_ids))
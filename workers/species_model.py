@@ -0,0 +1,146 @@
+"""Species classifier loading and batched prediction for the workers.
+
+Used by ``ai_worker.py`` and by ``otolith_worker_ai.py`` in fused mode, so both
+pipeline topologies classify with the same features and the same model file.
+
+The compiled, memory-mapped forest exported by ``train_model.py`` is preferred
+(see ``compiled_forest.py``); the pickled sklearn model is the fallback, or can
+be forced with ``MODEL_BACKEND=sklearn``.
+
+Models come from the versioned registry (``model_registry.py``) when one has
+been published, otherwise from the legacy flat paths as version ``legacy``.
+``maybe_reload`` swaps in a newly published version; workers call it between
+batches and record ``model_version`` with every prediction.
+"""
+import logging
+import os
+import time
+import warnings
+
+import joblib
+import numpy as np
+
+from compiled_forest import CompiledForest, is_compiled_forest
+import model_registry
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = os.getenv('MODEL_PATH', "/app/ai_model/species_classifier.pkl")
+FOREST_PATH = os.getenv('FOREST_PATH', "/app/ai_model/species_classifier_forest")
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'compiled').lower()
+MODEL_REGISTRY_PATH = os.getenv('MODEL_REGISTRY_PATH', "/app/ai_model/registry")
+MODEL_RELOAD_INTERVAL = float(os.getenv('MODEL_RELOAD_INTERVAL', '10'))
+LEGACY_VERSION = 'legacy'
+FEATURES = ['area', 'perimeter', 'width', 'height', 'aspect_ratio']
+
+# The model is trained on a DataFrame but fed a plain feature matrix here.
+warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+# Global variables to hold the model and the version it was loaded from
+model = None
+model_version = None
+_last_reload_check = 0.0
+_live_version = None
+_live_version_checked = 0.0
+
+
+def _load_artifacts(forest_path, pickle_path):
+    """Load the compiled forest or the pickle from one location, or return None."""
+    if MODEL_BACKEND == 'compiled' and is_compiled_forest(forest_path):
+        logger.info(f"Loading compiled forest from {forest_path}")
+        loaded = CompiledForest(forest_path)
+    elif os.path.exists(pickle_path):
+        logger.info(f"Loading model from {pickle_path}")
+        loaded = joblib.load(pickle_path)
+    else:
+        return None
+    check_feature_names(loaded)
+    return loaded
+
+
+def _load_version(version):
+    path = model_registry.version_path(MODEL_REGISTRY_PATH, version)
+    return _load_artifacts(
+        os.path.join(path, model_registry.FOREST_NAME),
+        os.path.join(path, model_registry.PICKLE_NAME),
+    )
+
+
+def load_model(max_retries=12, retry_delay=5):
+    """Load the trained model from disk with a retry mechanism."""
+    global model, model_version, _last_reload_check
+    for attempt in range(max_retries):
+        version = model_registry.current_version(MODEL_REGISTRY_PATH)
+        loaded = _load_version(version) if version else _load_artifacts(FOREST_PATH, MODEL_PATH)
+        if loaded is not None:
+            model, model_version = loaded, version or LEGACY_VERSION
+            _last_reload_check = time.monotonic()
+            logger.info(f"Model {model_version} loaded successfully.")
+            return model
+        logger.warning(f"No model found in {MODEL_REGISTRY_PATH} or at {MODEL_PATH}. Retrying in {retry_delay} seconds... ({attempt + 1}/{max_retries})")
+        time.sleep(retry_delay)
+
+    raise Exception("Could not load AI model after multiple retries. Shutting down.")
+
+
+def maybe_reload():
+    """Swap in a newly published registry version; returns True if it changed.
+
+    Checks at most every MODEL_RELOAD_INTERVAL seconds. Call it between
+    batches: the swap is a single assignment, so a batch never mixes models.
+    A version that fails to load is logged and the current model kept.
+    """
+    global model, model_version, _last_reload_check
+    now = time.monotonic()
+    if now - _last_reload_check < MODEL_RELOAD_INTERVAL:
+        return False
+    _last_reload_check = now
+    version = model_registry.current_version(MODEL_REGISTRY_PATH)
+    if not version or version == model_version:
+        return False
+    try:
+        loaded = _load_version(version)
+        if loaded is None:
+            raise FileNotFoundError(f"no artifacts for version {version}")
+    except Exception as e:
+        logger.error(f"Could not load model version {version}, keeping {model_version}: {e}")
+        return False
+    logger.info(f"Hot-swapped model {model_version} -> {version}")
+    model, model_version = loaded, version
+    return True
+
+
+def live_version():
+    """Version that new predictions come from.
+
+    The loaded model's when there is one; otherwise (a process that does not
+    predict itself) the registry's current version, read at most every
+    MODEL_RELOAD_INTERVAL seconds.
+    """
+    global _live_version, _live_version_checked
+    if model is not None:
+        return model_version
+    now = time.monotonic()
+    if _live_version is None or now - _live_version_checked >= MODEL_RELOAD_INTERVAL:
+        _live_version = model_registry.current_version(MODEL_REGISTRY_PATH) or LEGACY_VERSION
+        _live_version_checked = now
+    return _live_version
+
+
+def check_feature_names(loaded):
+    names = [str(name) for name in getattr(loaded, 'feature_names_in_', [])]
+    if names and names != FEATURES:
+        raise ValueError(f"Model was trained on features {names}, workers send {FEATURES}")
+
+
+def feature_vector(record):
+    """Extract the model features from a morphometrics dict (raises on bad input)."""
+    return [float(record[name]) for name in FEATURES]
+
+
+def predict_species_batch(records):
+    """Predicts species for a list of morphometric records in one model call."""
+    if model is None:
+        raise RuntimeError("Model is not loaded.")
+    features = np.array([feature_vector(record) for record in records], dtype=np.float64)
+    return [str(species) for species in model.predict(features)]
@@ -1,76 +1,240 @@
+"""Taxonomy worker: stores the taxa from ``taxonomy_queue`` in ``taxonomies``.
+
+A message is ``{"name": ..., "classification": ...}``; the first classification
+stored for a name wins. Messages are buffered by a ``BulkWriter`` and written
+with one multi-row ``INSERT ... ON CONFLICT (name) DO NOTHING`` per batch of
+``TAXONOMY_FLUSH_ROWS`` messages (or after ``TAXONOMY_FLUSH_MS``), then acked
+together with ``basic_ack(multiple=True)``.
+
+Names already written or buffered are remembered in a bounded LRU set
+(``TAXONOMY_KNOWN_NAMES``), so repeats within a checklist are acked, also in
+batches, without a database round trip. A name evicted from the set is simply left to the
+``ON CONFLICT`` clause. Newly inserted taxa are added to the rank hierarchy
+and their names sent on ``taxonomy_changes`` when the batch commits.
+
+Messages whose rows fail to commit are retried after a delay through the
+retry queues (shared/work_queues.py); a batch that fails is first split until
+the failing rows are isolated (``BulkWriter``), so the rest of it commits.
+Unusable messages are dead-lettered.
+"""
 import pika
 import json
 import os
+import sys
 import time
-import sqlalchemy
-from sqlalchemy.orm import sessionmaker
-
-# --- Database Setup ---
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db/mydatabase")
-
-# Define the table structure to match the one in main.py
-metadata = sqlalchemy.MetaData()
-taxonomies = sqlalchemy.Table(
-    "taxonomies",
-    metadata,
-    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
-    sqlalchemy.Column("name", sqlalchemy.String, unique=True, index=True),
-    sqlalchemy.Column("classification", sqlalchemy.String),
-)
-engine = sqlalchemy.create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+import logging
+from collections import OrderedDict
 
-def process_message(ch, method, properties, body):
-    """Callback function to process a message from the queue."""
-    data = json.loads(body)
-    print(f" [x] Received taxonomy data: {data}")
+from sqlalchemy import text
 
-    db = SessionLocal()
-    try:
-        # Check if the taxonomy already exists
-        existing = db.execute(taxonomies.select().where(taxonomies.c.name == data['name'])).first()
-        if existing:
-            print(f"  - Taxonomy '{data['name']}' already exists. Skipping.")
-        else:
-            # Insert new taxonomy data into the database
-            ins = taxonomies.insert().values(name=data['name'], classification=data['classification'])
-            db.execute(ins)
-            db.commit()
-            print(f"  - Successfully saved '{data['name']}' to the database.")
-    except Exception as e:
-        print(f"  - Error processing message: {e}")
-        db.rollback()
-    finally:
-        db.close()
-
-    # Acknowledge the message
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(" [x] Done")
+from ack_tracker import AckTracker
+from db_writer import NOTIFY_MAX_PAYLOAD, BulkWriter, get_engine, upsert_statement
+from schema import wait_for_schema
+from work_queues import declare_work_queue, dead_letter, schedule_retry
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+TAXONOMY_QUEUE = 'taxonomy_queue'
+TAXONOMY_CHANGES_CHANNEL = 'taxonomy_changes'
+INDEX_TAXA = text("SELECT index_taxa(CAST(:ids AS integer[]))")
+
+# --- Batching ---
+TAXONOMY_FLUSH_ROWS = int(os.getenv('TAXONOMY_FLUSH_ROWS', '500'))
+TAXONOMY_FLUSH_MS = int(os.getenv('TAXONOMY_FLUSH_MS', '200'))
+TAXONOMY_PREFETCH = int(os.getenv('TAXONOMY_PREFETCH', str(TAXONOMY_FLUSH_ROWS * 2)))
+TAXONOMY_KNOWN_NAMES = int(os.getenv('TAXONOMY_KNOWN_NAMES', '100000'))
+
+writer = None
+tracker = None
+# (properties, body) of the buffered deliveries, kept to retry them on failure
+deliveries = {}
+# Deliveries settled without a write, acked with the next batch.
+skipped = []
+skip_timer = None
+
+
+class KnownNames:
+    """Bounded LRU set of taxon names that need no further insert."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._names = OrderedDict()
+
+    def __contains__(self, name):
+        if name in self._names:
+            self._names.move_to_end(name)
+            return True
+        return False
+
+    def add(self, name):
+        self._names[name] = None
+        self._names.move_to_end(name)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
+
+    def discard(self, name):
+        self._names.pop(name, None)
+
+
+known_names = KnownNames(TAXONOMY_KNOWN_NAMES)
 
-def main():
-    rabbitmq_host = os.getenv('RABBITMQ_HOST', 'rabbitmq')
-    connection = None
 
-    # Retry connection to RabbitMQ
-    for i in range(10):
+def connect_to_rabbitmq():
+    """Connect to RabbitMQ with a retry mechanism."""
+    while True:
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
-            break
-        except pika.exceptions.AMQPConnectionError:
-            print(f"Connection to RabbitMQ failed. Retrying in {i+2} seconds...")
-            time.sleep(i + 2)
-
-    if not connection:
-        print("Could not connect to RabbitMQ. Exiting.")
-        return
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+            logger.info("Successfully connected to RabbitMQ.")
+            return connection
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error(f"RabbitMQ not ready: {e}. Retrying in 5 seconds...")
+            time.sleep(5)
+
+def parse_message(body):
+    """Return ``(row, None)`` with the ``taxonomies`` row in a message, or ``(None, reason)``."""
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        return None, f"non-JSON message: {e}"
+    if not isinstance(data, dict) or not data.get('name'):
+        return None, f"message without a name: {str(data)[:200]}"
+    # Checked here: a value the driver cannot adapt would fail the whole batch insert.
+    if not isinstance(data['name'], str):
+        return None, f"name is not a string: {str(data['name'])[:200]}"
+    classification = data.get('classification')
+    if classification is not None and not isinstance(classification, str):
+        return None, f"classification of {data['name'][:200]} is not a string"
+    return {'name': data['name'], 'classification': classification}, None
+
+def notify_names(conn, names):
+    """NOTIFY ``taxonomy_changes`` with the inserted names, once the transaction commits."""
+    payload = json.dumps({'names': names})
+    if len(payload) > NOTIFY_MAX_PAYLOAD:
+        # Too many names for one message: listeners treat null as "everything".
+        payload = json.dumps({'names': None})
+    conn.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': TAXONOMY_CHANGES_CHANNEL, 'payload': payload})
+
+def write_taxa(conn, rows):
+    """Insert a batch of taxa in one statement; existing names are left as they are.
+
+    New taxa are added to the hierarchy (``index_taxa``, shared/schema.py) in
+    the same transaction.
+    """
+    stmt, params = upsert_statement(
+        'taxonomies', ['name', 'classification'], 'name', rows, update_columns=[], returning='id, name',
+    )
+    inserted = conn.execute(stmt, params).all()
+    if inserted:
+        conn.execute(INDEX_TAXA, {'ids': [row.id for row in inserted]})
+        notify_names(conn, [row.name for row in inserted])
+    logger.info(f"Inserted {len(inserted)} of {len(rows)} taxa.")
+
+def settle(channel, tags):
+    """Ack finished deliveries, and any skipped ones, up to the oldest one still in flight."""
+    global skip_timer
+    if skip_timer is not None:
+        channel.connection.remove_timeout(skip_timer)
+        skip_timer = None
+    for tag in tags:
+        deliveries.pop(tag, None)
+    ack_upto = tracker.complete(tags + skipped)
+    skipped.clear()
+    if ack_upto is not None:
+        channel.basic_ack(delivery_tag=ack_upto, multiple=True)
+
+def skip(channel, tag):
+    """Settle a delivery that needs no write; acked with the next batch or after ``TAXONOMY_FLUSH_MS``."""
+    global skip_timer
+    skipped.append(tag)
+    if len(skipped) >= TAXONOMY_FLUSH_ROWS:
+        settle(channel, [])
+    elif skip_timer is None:
+        skip_timer = channel.connection.call_later(TAXONOMY_FLUSH_MS / 1000, lambda: settle(channel, []))
+
+def reject(channel, tag, reason):
+    """Dead-letter a delivery that can never be stored."""
+    deliveries.pop(tag, None)
+    tracker.forget([tag])
+    dead_letter(channel, TAXONOMY_QUEUE, tag, reason)
 
-    channel = connection.channel()
-    channel.queue_declare(queue='taxonomy_queue', durable=True)
-    print(' [*] Taxonomy Worker: Waiting for messages. To exit press CTRL+C')
+def make_writer(connection, channel):
+    """Write-behind buffer for one channel; the batch is acked only after commit."""
+    def on_flushed(rows, tags):
+        settle(channel, tags)
 
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue='taxonomy_queue', on_message_callback=process_message)
-    channel.start_consuming()
+    def on_failed(rows, tags, error):
+        # Let the retried messages through the known-names check again.
+        for row in rows:
+            known_names.discard(row['name'])
+        retried = []
+        for tag in tags:
+            properties, body = deliveries[tag]
+            if schedule_retry(channel, TAXONOMY_QUEUE, properties, body, error):
+                retried.append(tag)
+            else:
+                reject(channel, tag, f"out of retries; {error}")
+        settle(channel, retried)
+
+    return BulkWriter(
+        'taxonomies', write_taxa, max_rows=TAXONOMY_FLUSH_ROWS, max_delay=TAXONOMY_FLUSH_MS / 1000, key='name',
+        on_flushed=on_flushed, on_failed=on_failed, connection=connection,
+    )
+
+def process_message(ch, method, properties, body):
+    """Buffer one taxon for the next batch insert, or settle it straight away."""
+    tag = method.delivery_tag
+    tracker.delivered(tag)
+    row, reason = parse_message(body)
+    if row is None:
+        reject(ch, tag, reason)
+        return
+    if row['name'] in known_names:
+        skip(ch, tag)
+        return
+    # Claimed now so later messages for the same name keep the first classification.
+    known_names.add(row['name'])
+    deliveries[tag] = (properties, body)
+    writer.add(row, tag)
+
+def main():
+    """Main function to start the taxonomy worker."""
+    global writer, tracker, skip_timer
+    logger.info("Starting taxonomy worker...")
+    wait_for_schema(get_engine())
+    while True:
+        try:
+            connection = connect_to_rabbitmq()
+            channel = connection.channel()
+            declare_work_queue(channel, TAXONOMY_QUEUE)
+            if writer is not None:
+                # Unacked deliveries are redelivered; forget their claims.
+                for row in writer.discard():
+                    known_names.discard(row['name'])
+            tracker = AckTracker()
+            deliveries.clear()
+            skipped.clear()
+            skip_timer = None
+            writer = make_writer(connection, channel)
+            channel.basic_qos(prefetch_count=max(TAXONOMY_PREFETCH, TAXONOMY_FLUSH_ROWS))
+            channel.basic_consume(queue=TAXONOMY_QUEUE, on_message_callback=process_message)
+            logger.info(f'Waiting for messages (batches of {TAXONOMY_FLUSH_ROWS}, {TAXONOMY_FLUSH_MS} ms). To exit press CTRL+C')
+            channel.start_consuming()
+        except pika.exceptions.StreamLostError as e:
+            logger.error(f"Lost connection to RabbitMQ ({e}). Reconnecting in 5 seconds...")
+            time.sleep(5)
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error(f"AMQP Connection error ({e}). Reconnecting in 5 seconds...")
+            time.sleep(5)
+        except KeyboardInterrupt:
+            logger.info('Interrupted')
+            try:
+                sys.exit(0)
+            except SystemExit:
+                os._exit(0)
 
 if __name__ == '__main__':
     main()